@@ -4,12 +4,32 @@ import uuid
 import json
 import logging
 import re
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+import copy
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, Response, stream_with_context, g, has_request_context
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from bson import ObjectId
+from bson.errors import InvalidId
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from session_store import create_store
+from retrieval import DocumentIndex, select_across
+from pdf_extraction import PDF_AVAILABLE, iter_pdf_pages
+from response_cache import ResponseCache, SemanticCache, normalize_question
+from question_bank import QuestionBanks, parse_quiz_questions
+from prompt_builder import PromptBuilder
+from llm_gateway import LLMGateway, LLMUnavailable
+from audio_pipeline import AudioPipeline, load_backend
+from janitor import FileIndex, Janitor, LOCK_NAME
+from data_access import DataAccess, name_key
+from user_import import UserImporter, open_rows
+from mongo_connection import MongoConnection, LazyDatabase
+from metrics import Registry, RequestStats, MONGO_MONITORING_AVAILABLE, SIZE_BUCKETS, COUNT_BUCKETS, TOKEN_BUCKETS
 
 # Try to import Gemini AI (Google's API)
 try:
@@ -19,22 +39,6 @@ except ImportError:
     HAS_GEMINI = False
     logging.warning("Google Generative AI module not available. Advanced AI features will be disabled.")
 
-# Try to import optional modules
-try:
-    from gtts import gTTS
-    GTTS_AVAILABLE = True
-except ImportError:
-    GTTS_AVAILABLE = False
-    logging.warning("gTTS not available. Audio generation will be disabled.")
-
-# Try to import PDF reader
-try:
-    from PyPDF2 import PdfReader
-    PDF_AVAILABLE = True
-except ImportError:
-    PDF_AVAILABLE = False
-    logging.warning("PyPDF2 not available. PDF processing will be disabled.")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -47,13 +51,89 @@ app = Flask(__name__, static_folder='static', static_url_path='/static')
 CORS(app)  # Enable CORS for API calls
 app.secret_key = os.getenv("SECRET_KEY", "study_q_app_secret_key_2025")
 
+# Metrics, served in the Prometheus text format on /metrics
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() != 'false'
+metrics = Registry('studiq_')
+request_stats = RequestStats()
+request_seconds = metrics.histogram(
+    'http_request_seconds', "Time to handle a request (to the first byte for streamed responses)",
+    ('endpoint', 'method', 'status'))
+mongo_commands_per_request = metrics.histogram(
+    'mongo_commands_per_request', "MongoDB commands run by one request", ('endpoint',), COUNT_BUCKETS)
+mongo_seconds_per_request = metrics.histogram(
+    'mongo_seconds_per_request', "Time one request spent in MongoDB commands", ('endpoint',))
+gemini_call_seconds = metrics.histogram('gemini_call_seconds', "Gemini call latency per attempt", ('kind', 'outcome'))
+gemini_prompt_chars = metrics.histogram('gemini_prompt_chars', "Characters sent to Gemini per call", ('kind',), SIZE_BUCKETS)
+gemini_response_chars = metrics.histogram('gemini_response_chars', "Characters received from Gemini per call", ('kind',), SIZE_BUCKETS)
+prompt_section_tokens = metrics.histogram(
+    'prompt_section_tokens', "Estimated tokens per prompt section", ('prompt', 'section'), TOKEN_BUCKETS)
+pdf_page_seconds = metrics.histogram(
+    'pdf_page_seconds', "Time spent extracting each PDF page",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+tts_part_seconds = metrics.histogram('tts_part_seconds', "Speech synthesis time per chunk", ('outcome',))
+tts_part_chars = metrics.histogram('tts_part_chars', "Characters per synthesized speech chunk", buckets=SIZE_BUCKETS)
+
+def record_model_call(kind, seconds, prompt_chars, response_chars, error):
+    gemini_call_seconds.observe(seconds, kind=kind, outcome='ok' if error is None else type(error).__name__)
+    gemini_prompt_chars.observe(prompt_chars, kind=kind)
+    if error is None:
+        gemini_response_chars.observe(response_chars, kind=kind)
+
+def record_speech_part(seconds, characters, failed):
+    tts_part_seconds.observe(seconds, outcome='failed' if failed else 'ok')
+    tts_part_chars.observe(characters)
+
+def record_prompt_sections(kind, prompt):
+    if METRICS_ENABLED:
+        for section in prompt.sections:
+            prompt_section_tokens.observe(section['tokens'], prompt=kind, section=section['name'])
+
 # MongoDB setup
 mongo_uri = os.getenv('MONGO_URI', 'your mongo uri')
-client = MongoClient(mongo_uri)
-db = client['hack']  # Database name
+mongo_listeners = []
+if METRICS_ENABLED and MONGO_MONITORING_AVAILABLE:
+    from metrics import MongoCommandMetrics
+    mongo_listeners.append(MongoCommandMetrics(metrics, request_stats))
+mongo_checkout_wait_seconds = metrics.histogram(
+    'mongo_checkout_wait_seconds', "Time spent waiting for a MongoDB connection when none was idle",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+def record_mongo_checkout(seconds, waited):
+    if waited:
+        mongo_checkout_wait_seconds.observe(seconds)
+
+def optional_int(name, default):
+    """An integer setting where 0 (or empty) means no limit"""
+    value = int(os.getenv(name, default) or 0)
+    return value or None
+
+# Each gunicorn worker creates its own client (and connection pool) on first use.
+# Keep MONGO_MAX_POOL_SIZE x workers under the server's connection limit, and
+# at least the number of threads per worker so requests don't queue for a socket.
+mongo = MongoConnection(
+    mongo_uri,
+    'hack',  # Database name
+    event_listeners=mongo_listeners,
+    on_checkout=record_mongo_checkout if METRICS_ENABLED else None,
+    maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', 20)),
+    minPoolSize=int(os.getenv('MONGO_MIN_POOL_SIZE', 0)),
+    maxIdleTimeMS=optional_int('MONGO_MAX_IDLE_MS', 5 * 60 * 1000),
+    waitQueueTimeoutMS=optional_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000),
+    serverSelectionTimeoutMS=int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    connectTimeoutMS=int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+    socketTimeoutMS=optional_int('MONGO_SOCKET_TIMEOUT_MS', 30000),
+    readPreference=os.getenv('MONGO_READ_PREFERENCE', 'primary')
+)
+db = LazyDatabase(mongo)
 users_collection = db['users']  # Collection for users
 quiz_collection = db['quiz']  # Collection for quiz results
 
+# Indexed, projected queries; MONGO_DIAGNOSTICS=true logs collection scans found with explain()
+data = DataAccess(db, diagnostics=os.getenv('MONGO_DIAGNOSTICS', 'false').lower() == 'true')
+if os.getenv('MONGO_ENSURE_INDEXES', 'true').lower() != 'false':
+    # In the background so a slow or unreachable server doesn't hold up startup
+    threading.Thread(target=data.ensure_indexes, name='mongo-indexes', daemon=True).start()
+
 # Configure directories
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
@@ -78,9 +158,220 @@ if HAS_GEMINI:
         logger.error(f"Failed to configure Gemini API: {str(e)}")
         HAS_GEMINI = False
 
-# Simple in-memory storage for user sessions and documents
-user_sessions = {}
-document_content = {}
+# Session and document storage
+# Use SESSION_STORE_BACKEND=disk (one machine) or mongo (several machines) when
+# running more than one gunicorn worker, so every worker sees the same sessions.
+SESSION_STORE_BACKEND = os.getenv('SESSION_STORE_BACKEND', 'memory')
+SESSION_STORE_DIR = os.getenv('SESSION_STORE_DIR', 'session_store')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 24 * 60 * 60))  # 24 hours
+SESSION_STORE_MAX_SESSIONS = int(os.getenv('SESSION_STORE_MAX_SESSIONS', 10000))
+SESSION_STORE_MAX_DOCUMENTS = int(os.getenv('SESSION_STORE_MAX_DOCUMENTS', 500))
+DOCUMENT_CACHE_MAX_MB = int(os.getenv('DOCUMENT_CACHE_MAX_MB', 256))  # extracted text kept in the document cache
+DOCUMENT_INDEX_MAX_MB = int(os.getenv('DOCUMENT_INDEX_MAX_MB', 512))  # search indexes, rebuilt from the text when evicted
+
+def remove_cached_document(content_hash, document):
+    """Delete the stored upload and search index of an evicted document"""
+    filepath = document.get('filepath')
+    if filepath and os.path.exists(filepath):
+        os.remove(filepath)
+    document_indexes.delete(content_hash)
+
+user_sessions = create_store(
+    'sessions',
+    backend=SESSION_STORE_BACKEND,
+    ttl=SESSION_TTL,
+    max_entries=SESSION_STORE_MAX_SESSIONS,
+    directory=SESSION_STORE_DIR,
+    database=db
+)
+# Extracted documents keyed by the SHA-256 of the uploaded file, so identical
+# uploads from different users share one stored copy, text and index
+document_content = create_store(
+    'documents',
+    backend=SESSION_STORE_BACKEND,
+    ttl=SESSION_TTL,
+    max_entries=SESSION_STORE_MAX_DOCUMENTS,
+    on_evict=remove_cached_document,
+    directory=SESSION_STORE_DIR,
+    database=db,
+    max_bytes=DOCUMENT_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=lambda document: len(document['text'])
+)
+document_indexes = create_store(
+    'document_indexes',
+    backend=SESSION_STORE_BACKEND,
+    ttl=SESSION_TTL,
+    max_entries=SESSION_STORE_MAX_DOCUMENTS,
+    directory=SESSION_STORE_DIR,
+    database=db,
+    max_bytes=DOCUMENT_INDEX_MAX_MB * 1024 * 1024,
+    sizeof=lambda index: index.nbytes()
+)
+
+# Document retrieval settings
+CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 1200))  # characters per chunk
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 200))
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', 6))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))  # tokens of document text per prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 4000))  # whole prompt; history and documents are trimmed to fit
+CHAT_HISTORY_MESSAGES = int(os.getenv('CHAT_HISTORY_MESSAGES', 5))  # recent messages included in chat prompts
+
+# Identical prompts in flight share one Gemini call; with a shared store backend
+# this also works across workers
+LLM_COALESCE_SHARED = os.getenv('LLM_COALESCE_SHARED', 'true' if SESSION_STORE_BACKEND != 'memory' else 'false').lower() == 'true'
+llm_flights = create_store(
+    'llm_flights',
+    backend=SESSION_STORE_BACKEND,
+    ttl=5 * 60,
+    max_entries=1000,
+    directory=SESSION_STORE_DIR,
+    database=db
+) if LLM_COALESCE_SHARED else None
+
+# All Gemini calls go through the gateway (concurrency cap, deadlines, retries, circuit breaker)
+llm = LLMGateway(
+    model if HAS_GEMINI else None,
+    max_concurrent=int(os.getenv('GEMINI_MAX_CONCURRENT', 8)),  # in-flight calls per worker process
+    timeout=float(os.getenv('GEMINI_TIMEOUT', 30)),  # seconds per attempt (per chunk when streaming)
+    retries=int(os.getenv('GEMINI_RETRIES', 2)),
+    breaker_threshold=int(os.getenv('GEMINI_BREAKER_THRESHOLD', 5)),
+    breaker_reset=int(os.getenv('GEMINI_BREAKER_RESET', 30)),
+    queue_timeout=float(os.getenv('GEMINI_QUEUE_TIMEOUT', 5)),  # seconds to wait for a free slot
+    shared_store=llm_flights,
+    on_call=record_model_call if METRICS_ENABLED else None
+)
+
+# Cache of Gemini responses for repeated questions on the same documents
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() != 'false'
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60 * 60))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 2000))
+response_cache = ResponseCache(
+    create_store(
+        'responses',
+        backend=SESSION_STORE_BACKEND,
+        ttl=RESPONSE_CACHE_TTL,
+        max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+        directory=SESSION_STORE_DIR,
+        database=db
+    ),
+    enabled=RESPONSE_CACHE_ENABLED
+)
+
+# Reuse answers for reworded questions whose embeddings are close enough
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'true').lower() != 'false'
+semantic_cache = SemanticCache(
+    model_name=os.getenv('SEMANTIC_CACHE_MODEL', 'all-MiniLM-L6-v2'),
+    threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.92)),  # cosine similarity
+    max_entries=int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 500)),  # questions per document set and style
+    max_scopes=int(os.getenv('SEMANTIC_CACHE_MAX_SCOPES', 1000)),
+    enabled=RESPONSE_CACHE_ENABLED and SEMANTIC_CACHE_ENABLED
+)
+
+# Background ingestion of uploads (text extraction, chunking and indexing)
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 2))
+INGEST_MAX_PENDING = int(os.getenv('INGEST_MAX_PENDING', 16))  # queued + running jobs per worker process
+UPLOAD_JOB_TTL = int(os.getenv('UPLOAD_JOB_TTL', 60 * 60))  # keep job status for an hour
+upload_jobs = create_store(
+    'upload_jobs',
+    backend=SESSION_STORE_BACKEND,
+    ttl=UPLOAD_JOB_TTL,
+    max_entries=1000,
+    directory=SESSION_STORE_DIR,
+    database=db
+)
+ingestion_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+ingestion_slots = threading.BoundedSemaphore(INGEST_MAX_PENDING)
+
+# Per-user profile cache (quiz results and the personalization derived from them)
+PROFILE_CACHE_TTL = int(os.getenv('PROFILE_CACHE_TTL', 10 * 60))
+user_profiles = create_store(
+    'profiles',
+    backend=SESSION_STORE_BACKEND,
+    ttl=PROFILE_CACHE_TTL,
+    max_entries=int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', 10000)),
+    directory=SESSION_STORE_DIR,
+    database=db
+)
+
+# Disk budgets for uploads and generated audio, enforced by the janitor thread
+upload_files = FileIndex(
+    UPLOAD_FOLDER,
+    max_bytes=int(os.getenv('UPLOADS_MAX_MB', 1024)) * 1024 * 1024,
+    max_age=int(os.getenv('UPLOADS_MAX_AGE', SESSION_TTL))  # seconds since the file was last uploaded
+)
+audio_files = FileIndex(
+    AUDIO_FOLDER,
+    max_bytes=int(os.getenv('AUDIO_MAX_MB', 512)) * 1024 * 1024,
+    max_age=int(os.getenv('AUDIO_MAX_AGE', 6 * 60 * 60))  # seconds since the audio was last used
+)
+
+# Text-to-speech runs in the background; MP3s are shared by identical text.
+# Set TTS_BACKEND to "package.module:ClassName" to use another speech engine.
+audio_pipeline = AudioPipeline(
+    AUDIO_FOLDER,
+    load_backend(os.getenv('TTS_BACKEND', 'gtts')),
+    create_store(
+        'audio_jobs',
+        backend=SESSION_STORE_BACKEND,
+        ttl=int(os.getenv('TTS_JOB_TTL', 60 * 60)),
+        max_entries=5000,
+        directory=SESSION_STORE_DIR,
+        database=db
+    ),
+    workers=int(os.getenv('TTS_WORKERS', 4)),  # speech chunks synthesized in parallel
+    chunk_chars=int(os.getenv('TTS_CHUNK_CHARS', 300)),
+    on_file=audio_files.record,
+    on_part=record_speech_part if METRICS_ENABLED else None
+)
+
+# Pre-generated quiz questions per document, learning style and profile
+QUIZ_BANK_SIZE = int(os.getenv('QUIZ_BANK_SIZE', 40))  # most questions kept per bank
+QUIZ_BANK_MIN_SIZE = int(os.getenv('QUIZ_BANK_MIN_SIZE', 10))  # refill below this many questions
+QUIZ_BANK_BATCH = int(os.getenv('QUIZ_BANK_BATCH', 15))  # questions generated per Gemini call
+QUIZ_BANK_REUSE = int(os.getenv('QUIZ_BANK_REUSE', 3))  # refill after each question was served this often on average
+QUIZ_BANK_WAIT = int(os.getenv('QUIZ_BANK_WAIT', 60))  # seconds a request waits for an empty bank
+QUIZ_BANK_TTL = int(os.getenv('QUIZ_BANK_TTL', 7 * 24 * 60 * 60))
+quiz_bank_store = create_store(
+    'quiz_banks',
+    backend=SESSION_STORE_BACKEND,
+    ttl=QUIZ_BANK_TTL,
+    max_entries=int(os.getenv('QUIZ_BANK_MAX_BANKS', 2000)),
+    directory=SESSION_STORE_DIR,
+    database=db
+)
+quiz_bank_executor = ThreadPoolExecutor(max_workers=int(os.getenv('QUIZ_BANK_WORKERS', 2)), thread_name_prefix='quiz-bank')
+
+def evict_stale_sessions():
+    stale_sessions = user_sessions.evict_expired()
+    if stale_sessions:
+        logger.info(f"Cleaned up {stale_sessions} stale sessions")
+
+JANITOR_INTERVAL = int(os.getenv('JANITOR_INTERVAL', 60))
+
+def refresh_submission_summaries():
+    # One worker across all machines refreshes per interval (a lease in summary_state)
+    quizzes = data.refresh_submission_summaries(every=JANITOR_INTERVAL)
+    if quizzes:
+        logger.info(f"Refreshed submission summaries for {quizzes} quizzes")
+
+# Housekeeping runs on a background thread in each worker instead of on requests;
+# one worker per machine (holding the lock file) deletes files over budget
+janitor = Janitor(
+    [upload_files, audio_files],
+    tasks=[
+        evict_stale_sessions,
+        document_content.evict_expired,
+        document_indexes.evict_expired,
+        upload_jobs.evict_expired,
+        audio_pipeline.jobs.evict_expired,
+        response_cache.store.evict_expired,
+        quiz_bank_store.evict_expired,
+        user_profiles.evict_expired,
+        refresh_submission_summaries
+    ] + ([llm_flights.evict_expired] if llm_flights is not None else []),  # only kept with LLM_COALESCE_SHARED
+    interval=JANITOR_INTERVAL,
+    lock_path=os.path.join(UPLOAD_FOLDER, LOCK_NAME)
+)
 
 # Learning styles with detailed prompts
 LEARNING_STYLES = {
@@ -116,6 +407,14 @@ LEARNING_STYLES = {
     }
 }
 
+# Map quiz answers about how the user learns to learning styles
+QUIZ_STYLE_MAPPING = {
+    "Watching videos": "visual",
+    "Reading books": "reading",
+    "Listening to podcasts": "auditory",
+    "Doing it myself": "hands-on"
+}
+
 # Study environments and focus preferences
 STUDY_ENVIRONMENTS = {
     "Quiet room": "I'll structure my explanations for deep focus, with clear breaks and sections to help you concentrate in your quiet study space.",
@@ -174,24 +473,10 @@ def init_new_session(session_id):
     welcome_msg = "Hello! I'm your StudiQ AI tutor. How can I help you with your studies today?"
     
     # Get learning style if available from quiz data
-    learning_style = "blended"  # Default
-    
-    if 'user_email' in session:
-        quiz_data = quiz_collection.find_one({"user_email": session['user_email']})
-        
-        if quiz_data:
-            # Map quiz responses to learning styles
-            style_mapping = {
-                "Watching videos": "visual",
-                "Reading books": "reading",
-                "Listening to podcasts": "auditory",
-                "Doing it myself": "hands-on"
-            }
-            
-            if 'learningStyle' in quiz_data:
-                learning_style = style_mapping.get(quiz_data['learningStyle'], "blended")
+    profile = get_user_profile(session.get('user_email'))
+    learning_style = profile['learning_style'] if profile else "blended"
     
-    user_sessions[session_id] = {
+    session_data = {
         'learning_style': learning_style,
         'documents': [],
         'chat_history': [
@@ -203,43 +488,107 @@ def init_new_session(session_id):
         ],
         'last_active': time.time()
     }
-    return user_sessions[session_id]
+    user_sessions[session_id] = session_data
+    return session_data
+
+# Change a session and save it
+def update_session(session_id, mutate, attempts=10):
+    """Apply mutate() to the latest stored copy of a session and save it
+    
+    The write is a compare-and-set against the copy that was read, so a change
+    saved meanwhile by another request or background job (a chat reply, an
+    upload attaching its document) makes this one start over on the new copy
+    instead of being overwritten. mutate() may therefore run more than once.
+    Returns None if the session no longer exists.
+    """
+    for _ in range(attempts):
+        current = user_sessions.get(session_id)
+        if current is None:
+            return None
+        # Mutate a copy: the memory store hands out the stored object itself
+        session_data = copy.deepcopy(current)
+        mutate(session_data)
+        if user_sessions.compare_and_set(session_id, current, session_data):
+            return session_data
+    # Still contended after every attempt: save this change over the latest copy
+    logger.warning(f"Session {session_id} kept changing during an update, saving without a check")
+    session_data = user_sessions.get(session_id)
+    if session_data is None:
+        return None
+    mutate(session_data)
+    user_sessions[session_id] = session_data
+    return session_data
+
+# Cached user profiles
+def get_user_profile(email):
+    """Get a user's quiz results with their precomputed personalization, or None if not logged in
+    
+    Profiles are cached in the user_profiles store and memoized for the current
+    request. Treat the returned dict as read-only.
+    """
+    if not email:
+        return None
+    memo = g.setdefault('user_profiles', {}) if has_request_context() else {}
+    profile = memo.get(email)
+    if profile is None:
+        profile = user_profiles.get(email)
+    if profile is None:
+        quiz_data = data.find_quiz_results(email)
+        profile = {
+            'completed': quiz_data is not None,
+            'quiz_data': quiz_data or {},
+            'learning_style': QUIZ_STYLE_MAPPING.get((quiz_data or {}).get('learningStyle'), "blended"),
+            'personalization': generate_personalized_prompt(quiz_data),
+            'quiz_modifiers': get_quiz_modifiers(quiz_data)
+        }
+        user_profiles[email] = profile
+    memo[email] = profile
+    return profile
+
+def invalidate_user_profile(email):
+    """Forget a cached profile after the user's quiz results change"""
+    user_profiles.delete(email)
+    if has_request_context():
+        g.setdefault('user_profiles', {}).pop(email, None)
 
 # Check if user has completed the quiz
 def has_completed_quiz(email):
     """Check if a user has completed the quiz"""
     if not email:
         return False
-    quiz_result = quiz_collection.find_one({"user_email": email})
-    return quiz_result is not None
+    # Use a cached profile if there is one, otherwise an index-only existence check
+    memo = g.get('user_profiles', {}) if has_request_context() else {}
+    profile = memo.get(email) or user_profiles.get(email)
+    if profile is not None:
+        return profile['completed']
+    return data.has_quiz_results(email)
 
 # File processing functions
-def extract_text_from_pdf(pdf_path):
+def extract_text_from_pdf(pdf_path, progress=None):
     """Extract text from PDF file"""
     if not PDF_AVAILABLE:
         return "PDF processing is not available."
         
     try:
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text
-        return text
+        # Pages are extracted in parallel for large files and arrive in order
+        on_page = pdf_page_seconds.observe if METRICS_ENABLED else None
+        return "\n".join(iter_pdf_pages(pdf_path, progress=progress, on_page=on_page))
     except Exception as e:
         logger.error(f"Error extracting text from PDF: {str(e)}")
         return ""
 
-def process_file(file_path):
-    """Process uploaded file to extract text"""
+def process_file(file_path, progress=None):
+    """Process uploaded file to extract text
+    
+    progress, if given, is called as progress(done, total) while pages or slides are read.
+    """
     if not os.path.exists(file_path):
         return "File not found"
         
     ext = os.path.splitext(file_path)[1].lower()
     
     if ext == '.pdf':
-        return extract_text_from_pdf(file_path)
+        return extract_text_from_pdf(file_path, progress)
     elif ext in ['.txt', '.md', '.csv']:
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
@@ -252,50 +601,175 @@ def process_file(file_path):
         try:
             from pptx import Presentation
             prs = Presentation(file_path)
-            text = ""
+            total = len(prs.slides)
+            parts = []
             for i, slide in enumerate(prs.slides):
-                text += f"\nSlide {i+1}:\n"
+                parts.append(f"\nSlide {i+1}:\n")
                 for shape in slide.shapes:
                     if hasattr(shape, "text"):
-                        text += shape.text + "\n"
-            return text
+                        parts.append(shape.text + "\n")
+                if progress:
+                    progress(i + 1, total)
+            return "".join(parts)
         except Exception as e:
             logger.error(f"Error reading PowerPoint file: {str(e)}")
             return f"Error processing PowerPoint: {str(e)}"
     else:
         return f"Unsupported file format: {ext}"
 
-# Audio generation function
-def generate_audio_from_text(text, session_id=None):
-    """Generate audio file from text using gTTS"""
-    if not GTTS_AVAILABLE:
+# Save an upload while hashing it
+def save_upload(file, filename):
+    """Stream an uploaded file to disk, returning its SHA-256 and the path of the stored copy"""
+    ext = os.path.splitext(filename)[1].lower()
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".{uuid.uuid4()}.part")
+    digest = hashlib.sha256()
+    
+    with open(tmp_path, 'wb') as out:
+        while True:
+            block = file.stream.read(64 * 1024)
+            if not block:
+                break
+            digest.update(block)
+            out.write(block)
+    
+    # Keep a single copy of each unique file
+    content_hash = digest.hexdigest()
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{content_hash}{ext}")
+    if os.path.exists(filepath):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, filepath)
+    upload_files.record(filepath)
+    return content_hash, filepath
+
+# Split a document into chunks and build its search index
+def ingest_document(content_hash, text):
+    """Chunk and index extracted document text"""
+    index = DocumentIndex.from_text(text, CHUNK_SIZE, CHUNK_OVERLAP)
+    document_indexes[content_hash] = index
+    logger.info(f"Indexed document {content_hash[:12]} into {len(index.chunks)} chunks")
+    return index
+
+def get_document_index(content_hash):
+    """Get the search index for a document, rebuilding it from the text if needed"""
+    index = document_indexes.get(content_hash)
+    # Searching a document counts as using it, so its text and file don't expire while it is in use
+    if index is not None and document_content.touch(content_hash):
+        return index
+    document = document_content.get(content_hash)
+    if not document:
+        # The text expired (taking its file with it); don't keep serving an orphaned index
+        document_indexes.delete(content_hash)
         return None
-        
+    return ingest_document(content_hash, document['text'])
+
+def find_session_document(session_id, document_id):
+    """Look up one of a session's documents by its id"""
+    session_data = user_sessions.get(session_id) or {}
+    for doc in session_data.get('documents', []):
+        if doc['id'] == document_id:
+            return doc
+    return None
+
+def attach_document(session_id, content_hash, filename, filepath):
+    """Add a processed document to a session with a system message about the upload"""
+    doc_id = str(uuid.uuid4())
+    
+    def add_document(session_data):
+        session_data['documents'].append({
+            'id': doc_id,
+            'content_hash': content_hash,
+            'filename': filename,
+            'filepath': filepath,
+            'upload_time': time.time()
+        })
+        session_data['chat_history'].append({
+            'role': 'assistant',
+            'content': f"I've processed your document \"{filename}\". You can now ask me questions about it!",
+            'timestamp': time.time()
+        })
+    
+    if update_session(session_id, add_document) is None:
+        logger.warning(f"Session {session_id} expired before {filename} was added")
+    return doc_id
+
+# Find the passages most relevant to a question across all of a session's documents
+def retrieve_passages(documents, query):
+    """Return (filename, passage) pairs from every uploaded document, best matches first in budget"""
+    sources = []
+    for doc in documents:
+        index = get_document_index(doc['content_hash'])
+        if index:
+            sources.append((doc['filename'], index))
+    if not sources:
+        return []
+    
+    passages = select_across(sources, query, CONTEXT_TOKEN_BUDGET, RETRIEVAL_TOP_K)
+    if not passages:
+        # Nothing matched the question, so give an overview of the most recent document
+        filename, index = sources[-1]
+        passages = [(filename, chunk) for chunk in index.overview(CONTEXT_TOKEN_BUDGET)]
+    return passages
+
+# Background ingestion jobs
+def update_job(job_id, **fields):
+    """Update the stored status of an upload job"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return None
+    job.update(fields)
+    job['updated'] = time.time()
+    upload_jobs[job_id] = job
+    return job
+
+def run_ingestion_job(job_id, session_id, content_hash, filepath, filename, quiz_bank=None):
+    """Extract, chunk and index an uploaded file, then add it to the session
+    
+    quiz_bank, if given, is the (key, params) of a question bank to build once the file is indexed.
+    """
     try:
-        # Clean text for audio (remove markdown, etc.)
-        clean_text = text
-        clean_text = re.sub(r'\*\*(.*?)\*\*', r'\1', clean_text)  # Remove bold
-        clean_text = re.sub(r'\*(.*?)\*', r'\1', clean_text)       # Remove italic
-        clean_text = re.sub(r'#{1,6}\s+(.*?)\n', r'\1. ', clean_text)  # Convert headers to sentences
-        
-        # Generate unique filename
-        filename = f"{session_id or uuid.uuid4()}_audio_{int(time.time())}.mp3"
-        file_path = os.path.join(AUDIO_FOLDER, filename)
-        
-        # Generate audio
-        tts = gTTS(text=clean_text, lang='en', slow=False)
-        tts.save(file_path)
-        
-        # Return URL for the audio file
-        audio_url = f"/audio/{filename}"
-        
-        return {
-            "url": audio_url,
-            "file_path": file_path
-        }
+        document = document_content.get(content_hash)
+        
+        # Only extract if an identical upload has not been processed in the meantime
+        if document is None:
+            update_job(job_id, status='processing', stage='extracting', progress=0)
+            
+            # Extraction is reported as the first 80% of the job, throttled to 5% steps
+            last_reported = [0]
+            def report_extraction(done, total):
+                percent = int(80 * done / max(total, 1))
+                if percent - last_reported[0] >= 5:
+                    last_reported[0] = percent
+                    update_job(job_id, progress=percent)
+            
+            text = process_file(filepath, progress=report_extraction)
+            
+            if not text:
+                # The file is shared by every upload with the same content, so it
+                # is left for the janitor to age out rather than deleted here
+                update_job(job_id, status='failed', error="Failed to extract text from file")
+                return
+            
+            update_job(job_id, stage='indexing', progress=80)
+            
+            # Store document info
+            document = {'text': text, 'filepath': filepath}
+            ingest_document(content_hash, text)
+            document_content[content_hash] = document
+        
+        doc_id = attach_document(session_id, content_hash, filename, filepath)
+        if quiz_bank:
+            quiz_banks.ensure(*quiz_bank)
+        
+        update_job(job_id, status='ready', stage='done', progress=100,
+                   document_id=doc_id, text_length=len(document['text']))
+        logger.info(f"Upload job {job_id} finished: {filename}")
+        
     except Exception as e:
-        logger.error(f"Error generating audio: {str(e)}")
-        return None
+        logger.error(f"Error in upload job {job_id}: {str(e)}")
+        update_job(job_id, status='failed', error="An error occurred while processing the file")
+    finally:
+        ingestion_slots.release()
 
 # Visual enhancements for visual learners
 def add_visual_elements(text):
@@ -333,6 +807,34 @@ def add_visual_elements(text):
     
     return text
 
+def stream_visual_elements(chunks):
+    """Apply add_visual_elements to streamed text one completed line at a time"""
+    pending = ""
+    first_line = True
+    
+    def process_line(line):
+        processed = add_visual_elements(line)
+        # Section dividers normally match "\n## ", so emit them for every heading after the first line
+        divider = re.match(r'#{2,3} ', processed)
+        if divider and not first_line:
+            processed = "\n---\n\n## " + processed[divider.end():]
+        return processed
+    
+    for chunk in chunks:
+        pending += chunk
+        if "\n" not in pending:
+            continue
+        lines = pending.split("\n")
+        pending = lines.pop()
+        out = []
+        for line in lines:
+            out.append(process_line(line) + "\n")
+            first_line = False
+        yield "".join(out)
+    
+    if pending:
+        yield process_line(pending)
+
 def generate_visual_prompt(base_prompt, learning_style="visual"):
     """Enhance the prompt for visual learners"""
     visual_addition = """
@@ -355,14 +857,7 @@ def generate_personalized_prompt(quiz_data):
     
     # Learning style
     if 'learningStyle' in quiz_data:
-        style_mapping = {
-            "Watching videos": "visual",
-            "Reading books": "reading",
-            "Listening to podcasts": "auditory",
-            "Doing it myself": "hands-on"
-        }
-        
-        learning_style = style_mapping.get(quiz_data['learningStyle'], "blended")
+        learning_style = QUIZ_STYLE_MAPPING.get(quiz_data['learningStyle'], "blended")
         personalization.append(f"Your primary learning style appears to be: {learning_style}.")
     
     # Study environment
@@ -444,7 +939,7 @@ def login():
             return redirect(url_for('loginpage'))
 
         # Check if user exists and password matches
-        user = users_collection.find_one({"email": email})
+        user = data.find_user_for_login(email)
 
         if user and check_password_hash(user["password"], password):
             # Store user info in session
@@ -453,9 +948,7 @@ def login():
             session['user_name'] = user['full_name']
             
             # Check if user has completed the quiz
-            quiz_result = quiz_collection.find_one({"user_email": email})
-            
-            if quiz_result:
+            if has_completed_quiz(email):
                 # User has completed the quiz, redirect to main app
                 return redirect(url_for('app_dashboard'))
             else:
@@ -493,7 +986,7 @@ def signup():
             return redirect(url_for('loginpage'))
 
         # Check if user already exists
-        if users_collection.find_one({"email": email}):
+        if data.user_exists(email):
             flash('Email already exists. Please sign in.', 'error')
             return redirect(url_for('loginpage'))
 
@@ -503,13 +996,18 @@ def signup():
         # Create a new user document
         user = {
             "full_name": full_name,
+            "name_key": name_key(full_name),
             "email": email,
             "password": hashed_password,
             "role": role
         }
 
-        # Insert the user into the database
-        result = users_collection.insert_one(user)
+        # Insert the user into the database (the unique email index catches concurrent signups)
+        try:
+            result = users_collection.insert_one(user)
+        except DuplicateKeyError:
+            flash('Email already exists. Please sign in.', 'error')
+            return redirect(url_for('loginpage'))
 
         if result.inserted_id:
             # Store user info in session
@@ -578,6 +1076,7 @@ def save_quiz_results():
         {'$set': quiz_doc}, 
         upsert=True
     )
+    invalidate_user_profile(session['user_email'])
 
     return jsonify({'success': True})
 
@@ -613,8 +1112,100 @@ def serve_static(path):
 def serve_audio(filename):
     return send_from_directory(AUDIO_FOLDER, filename)
 
+# Progressive audio stream
+@app.route('/audio/stream/<audio_id>.mp3')
+def stream_audio(audio_id):
+    """Stream a response's audio, sentence by sentence, while it is still being generated"""
+    if not re.fullmatch(r'[0-9a-f]{64}', audio_id):
+        return jsonify({"error": "Audio not found"}), 404
+    audio = audio_pipeline.status(audio_id)
+    if audio is None:
+        return jsonify({"error": "Audio not found"}), 404
+    if audio['status'] == 'ready':
+        return send_from_directory(AUDIO_FOLDER, f"{audio_id}.mp3")
+    return Response(
+        stream_with_context(audio_pipeline.iter_audio(audio_id)),
+        mimetype='audio/mpeg',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Audio generation status endpoint
+@app.route('/api/audio/<audio_id>', methods=['GET'])
+def audio_status(audio_id):
+    """Report whether the audio for a response is ready to play"""
+    if not re.fullmatch(r'[0-9a-f]{64}', audio_id):
+        return jsonify({"error": "Audio not found"}), 404
+    audio = audio_pipeline.status(audio_id)
+    if audio is None:
+        return jsonify({"error": "Audio not found"}), 404
+    return jsonify(audio)
+
 # API Routes
 
+# Values read when /metrics is scraped
+metrics.counter('cache_lookups_total', "Response cache lookups", ('cache', 'result'), function=lambda: {
+    ('response', 'hit'): response_cache.hits,
+    ('response', 'miss'): response_cache.misses,
+    ('semantic', 'hit'): semantic_cache.hits,
+    ('semantic', 'miss'): semantic_cache.misses
+})
+metrics.gauge('cache_hit_ratio', "Share of response cache lookups that were hits", ('cache',), function=lambda: {
+    'response': response_cache.stats()['hit_ratio'],
+    'semantic': semantic_cache.stats()['hit_ratio']
+})
+# Disk stores report the count from the janitor's last pass instead of listing their directory per scrape
+metrics.gauge('store_entries', "Entries in the session and document stores", ('store',), function=lambda: {
+    'sessions': user_sessions.count(),
+    'documents': document_content.count()
+})
+metrics.counter('gemini_gateway_events_total', "Gemini gateway calls, retries, rejections and coalesced requests",
+                ('event',), function=lambda: {
+                    name: value for name, value in llm.stats().items()
+                    if isinstance(value, int) and name != 'consecutive_failures'
+                })
+metrics.gauge('gemini_circuit_open', "1 while the Gemini circuit breaker is open",
+              function=lambda: int(llm.stats()['circuit'] == 'open'))
+metrics.gauge('disk_files_bytes', "Bytes of indexed files (reported by the worker that sweeps them)",
+              ('directory',), function=lambda: {index.name: index.stats()['bytes'] for index in janitor.indexes})
+
+def mongo_checkout_counts(stats):
+    counts = {'checked_out': stats.get('checkouts', 0), 'waited': stats.get('checkout_waits', 0)}
+    for reason, count in stats.get('checkout_failures', {}).items():
+        counts[f"failed_{reason}"] = count
+    return counts
+
+metrics.gauge('mongo_pool_connections', "MongoDB connections in this worker's pool", ('state',), function=lambda: {
+    'open': mongo.stats().get('connections_open', 0),
+    'in_use': mongo.stats().get('connections_in_use', 0)
+})
+metrics.counter('mongo_pool_checkouts_total', "MongoDB connection checkouts, those that waited, and failures",
+                ('result',), function=lambda: mongo_checkout_counts(mongo.stats()))
+
+@app.before_request
+def start_request_metrics():
+    if METRICS_ENABLED:
+        g.request_started = time.perf_counter()
+        request_stats.reset()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        request_seconds.observe(time.perf_counter() - started, endpoint=endpoint,
+                                method=request.method, status=response.status_code)
+        mongo_commands_per_request.observe(request_stats.mongo_commands, endpoint=endpoint)
+        mongo_seconds_per_request.observe(request_stats.mongo_seconds, endpoint=endpoint)
+    return response
+
+# Prometheus metrics endpoint
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose request, Gemini, MongoDB, extraction, TTS, cache and store metrics for this worker"""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Health check endpoint
 @app.route('/api/healthcheck', methods=['GET'])
 def healthcheck():
@@ -623,13 +1214,18 @@ def healthcheck():
         "status": "ok", 
         "timestamp": time.time(),
         "gemini_available": HAS_GEMINI,
-        "tts_available": GTTS_AVAILABLE
+        "tts_available": audio_pipeline.available,
+        "llm": llm.stats(),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "janitor": janitor.stats(),
+        "mongo_pool": mongo.stats()
     })
 
 # File upload endpoint
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """Upload and process a document"""
+    """Upload a document and queue it for background processing"""
     # Check if user is logged in
     if 'user_email' not in session:
         return jsonify({"error": "You must be logged in to upload files"}), 401
@@ -647,120 +1243,110 @@ def upload_file():
             
         # Secure the filename
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{session_id}_{filename}")
         
-        # Save the file
-        file.save(filepath)
+        # Save the file, hashing its content on the way
+        content_hash, filepath = save_upload(file, filename)
         logger.info(f"File saved: {filepath}")
         
-        # Process file to extract text
-        text = process_file(filepath)
-        
-        if not text:
-            # Delete the file if we couldn't extract text
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            return jsonify({"error": "Failed to extract text from file"}), 400
+        # Prepare the quiz question bank for this document and the user's learning style
+        session_data = user_sessions.get(session_id) or {}
+        quiz_bank = get_quiz_bank(content_hash, session_data.get('learning_style', 'blended'),
+                                  get_user_profile(session['user_email'])['quiz_modifiers'])
         
-        # Store document info
-        doc_id = str(uuid.uuid4())
-        document_content[doc_id] = text
+        # Reuse the text and index of an identical file uploaded before
+        document = document_content.get(content_hash)
+        if document:
+            doc_id = attach_document(session_id, content_hash, filename, filepath)
+            quiz_banks.ensure(*quiz_bank)
+            return jsonify({
+                "success": True,
+                "status": "ready",
+                "document_id": doc_id,
+                "filename": filename,
+                "text_length": len(document['text'])
+            })
         
-        # Add to user session
-        user_sessions[session_id]['documents'].append({
-            'id': doc_id,
-            'filename': filename,
-            'filepath': filepath,
-            'upload_time': time.time()
-        })
+        # Refuse new work when this worker's ingestion queue is full
+        if not ingestion_slots.acquire(blocking=False):
+            return jsonify({"error": "The server is busy processing other uploads. Please try again shortly."}), 503
         
-        # Add system message about document upload
-        user_sessions[session_id]['chat_history'].append({
-            'role': 'assistant',
-            'content': f"I've processed your document \"{filename}\". You can now ask me questions about it!",
-            'timestamp': time.time()
-        })
+        try:
+            # Queue extraction and indexing; clients poll /api/upload/<job_id>
+            job_id = str(uuid.uuid4())
+            upload_jobs[job_id] = {
+                'id': job_id,
+                'session_id': session_id,
+                'filename': filename,
+                'status': 'queued',
+                'stage': 'queued',
+                'progress': 0,
+                'document_id': None,
+                'error': None,
+                'created': time.time(),
+                'updated': time.time()
+            }
+            ingestion_executor.submit(run_ingestion_job, job_id, session_id, content_hash, filepath, filename, quiz_bank)
+        except Exception:
+            ingestion_slots.release()
+            raise
         
         return jsonify({
             "success": True,
-            "document_id": doc_id,
-            "filename": filename,
-            "text_length": len(text)
-        })
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": url_for('upload_status', job_id=job_id),
+            "filename": filename
+        }), 202
         
     except Exception as e:
         logger.error(f"Error in upload_file: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-# Chat API endpoint
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    """Handle chat messages with improved formatting and learning style adaptations"""
+# Upload job status endpoint
+@app.route('/api/upload/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    """Report the status and progress of a background upload job"""
     try:
         session_id = get_session_id()
-        session_data = user_sessions[session_id]
+        job = upload_jobs.get(job_id)
         
-        # Parse request data
-        data = request.json
-        if not data or 'message' not in data:
-            return jsonify({"error": "No message provided"}), 400
-            
-        user_message = data['message']
-        learning_style = session_data.get('learning_style', 'blended')
+        if not job or job['session_id'] != session_id:
+            return jsonify({"error": "Upload job not found"}), 404
         
-        # Add user message to history
-        session_data['chat_history'].append({
-            'role': 'user',
-            'content': user_message,
-            'timestamp': time.time()
+        return jsonify({
+            "job_id": job_id,
+            "filename": job['filename'],
+            "status": job['status'],
+            "stage": job['stage'],
+            "progress": job['progress'],
+            "document_id": job.get('document_id'),
+            "text_length": job.get('text_length'),
+            "error": job.get('error')
         })
         
-        # If Gemini is not available, return a fallback response
-        if not HAS_GEMINI:
-            fallback_response = "I'm sorry, but the advanced AI model is not available right now. Please check the API key configuration or try again later."
-            session_data['chat_history'].append({
-                'role': 'assistant',
-                'content': fallback_response,
-                'timestamp': time.time()
-            })
-            return jsonify({
-                "response": fallback_response,
-                "timestamp": time.time()
-            })
-        
-        # Prepare context from documents
-        context = ""
-        has_document = False
-        if session_data['documents']:
-            # Use the most recent document as context
-            doc_id = session_data['documents'][-1]['id']
-            if doc_id in document_content:
-                context = document_content[doc_id][:5000]  # Limit context size
-                has_document = True
-        
-        # Prepare chat history for context
-        chat_context = ""
-        for msg in session_data['chat_history'][-5:]:  # Use last 5 messages
-            if msg['role'] == 'user':
-                chat_context += f"User: {msg['content']}\n"
-            else:
-                chat_context += f"AI: {msg['content']}\n"
-        
-        # Get user quiz data for personalization
-        personalized_instruction = "I'll adapt to your learning style as we interact."
-        if 'user_email' in session:
-            quiz_data = quiz_collection.find_one({"user_email": session['user_email']})
-            if quiz_data:
-                personalized_instruction = generate_personalized_prompt(quiz_data)
-        
-        # Prepare prompt for Gemini with formatting instructions
-        # Get learning style specific instructions
-        style_info = LEARNING_STYLES.get(learning_style, LEARNING_STYLES['blended'])
-        learning_instruction = style_info["prompt"]
-        model_instruction = style_info["model_instruction"]
-        
-        # Base prompt
-        base_prompt = f"""
+    except Exception as e:
+        logger.error(f"Error in upload_status: {str(e)}")
+        return jsonify({"error": "An error occurred. Please try again."}), 500
+
+# Build the Gemini prompt for a chat message
+# Get the current user's personalization text
+def get_personalized_instruction():
+    """Describe the logged-in user's learning preferences from their quiz results"""
+    profile = get_user_profile(session.get('user_email'))
+    if profile:
+        return profile['personalization']
+    return "I'll adapt to your learning style as we interact."
+
+@lru_cache(maxsize=1024)
+def chat_prompt_prefix(learning_style, personalized_instruction):
+    """Build the instructions that start every chat prompt for a learning style and profile"""
+    # Get learning style specific instructions
+    style_info = LEARNING_STYLES.get(learning_style, LEARNING_STYLES['blended'])
+    learning_instruction = style_info["prompt"]
+    model_instruction = style_info["model_instruction"]
+    
+    # Base prompt
+    base_prompt = f"""
 You are a helpful AI tutor assistant named StudiQ. Be conversational, friendly, and helpful.
 Learning style: {learning_style}
 Instructions: {learning_instruction}
@@ -776,85 +1362,287 @@ Format your response properly using Markdown:
 
 """
 
-        # Enhance prompt based on learning style
-        if learning_style == "visual":
-            prompt = generate_visual_prompt(base_prompt)
-        else:
-            prompt = base_prompt
+    # Enhance prompt based on learning style
+    if learning_style == "visual":
+        return generate_visual_prompt(base_prompt)
+    return base_prompt
 
-        if context:
-            prompt += f"""
-Recent document content:
-{context}
-
-"""
-        else:
-            # No document, set expectations for basic chat
-            prompt += """
+def build_chat_prompt(session_data, user_message, learning_style, personalized_instruction):
+    """Assemble the tutor prompt and return it with the file names it quotes from"""
+    # Prepare context from the passages most relevant to the question, from any document
+    passages = retrieve_passages(session_data['documents'], user_message)
+    
+    builder = PromptBuilder(PROMPT_TOKEN_BUDGET)
+    builder.add('instructions', chat_prompt_prefix(learning_style, personalized_instruction))
+    
+    if passages:
+        builder.add_parts(
+            'documents',
+            [f"[Source: {filename}]\n{passage}" for filename, passage in passages],
+            priority=2,
+            header="\nRelevant document content:\n",
+            footer="\n\n",
+            separator="\n\n"
+        )
+    else:
+        # No document, set expectations for basic chat
+        builder.add('documents', """
 The user has not uploaded any documents yet, so please respond to general questions.
 If they ask about specific content, politely suggest they upload a document first.
 
-"""
-
-        if chat_context:
-            prompt += f"""
-Recent conversation:
-{chat_context}
-
-"""
-
-        prompt += f"""
+""")
+    
+    # Prepare chat history for context; the oldest messages go first when over budget
+    builder.add_parts(
+        'history',
+        [f"{'User' if msg['role'] == 'user' else 'AI'}: {msg['content']}"
+         for msg in session_data['chat_history'][-CHAT_HISTORY_MESSAGES:]],
+        priority=1,
+        header="\nRecent conversation:\n",
+        footer="\n\n\n",
+        drop_from='start'
+    )
+    
+    question = f"""
 User's question: {user_message}
 
 Please respond directly to the user's question.
 """
-
-        if has_document:
-            prompt += " If the question is about the document content, refer to it in your answer."
-        
-        prompt += """
+    if passages:
+        question += " If the question is about the document content, refer to it in your answer and cite the source file name."
+    question += """
 Make your response well-structured and easy to read with proper formatting.
 """
-
-        # Call Gemini model
-        response = model.generate_content(prompt)
-        ai_response = response.text
-        
-        # Post-process response based on learning style
-        if learning_style == "visual":
-            ai_response = add_visual_elements(ai_response)
-        
-        # Generate audio for auditory learners
-        audio_url = None
-        if learning_style == "auditory" and GTTS_AVAILABLE:
-            try:
-                logger.info(f"Generating audio for session {session_id}")
-                audio_result = generate_audio_from_text(ai_response, session_id)
-                if audio_result:
-                    audio_url = audio_result["url"]
-                    logger.info(f"Audio generated successfully: {audio_url}")
-            except Exception as e:
-                logger.error(f"Error generating audio: {str(e)}")
-        
-        # Add AI response to history
+    builder.add('question', question)
+    
+    prompt = builder.build()
+    logger.debug(f"Chat prompt: {prompt.tokens} tokens ({prompt.describe()})")
+    record_prompt_sections('chat', prompt)
+    
+    # Only cite the passages that survived trimming
+    kept = prompt.section('documents')['parts'] if passages else 0
+    sources = list(dict.fromkeys(filename for filename, _ in passages[:kept]))
+    return prompt.text, sources
+
+# Record a finished AI response in the session
+def finalize_chat_response(session_id, ai_response, learning_style, sources=None):
+    """Queue audio if needed, append the response to chat history and return the audio handle
+    
+    The handle is {"id", "status", "url", "stream_url", "status_url"}. stream_url
+    plays straight away while the audio is still being generated; url works
+    once status_url reports "ready".
+    """
+    # Generate audio for auditory learners in the background
+    audio = None
+    if learning_style == "auditory" and audio_pipeline.available:
+        try:
+            audio = audio_pipeline.request(ai_response)
+            audio['status_url'] = url_for('audio_status', audio_id=audio['id'])
+        except Exception as e:
+            logger.error(f"Error queueing audio: {str(e)}")
+    
+    # Add AI response to history and update last active time
+    def add_response(session_data):
         session_data['chat_history'].append({
             'role': 'assistant',
             'content': ai_response,
             'timestamp': time.time(),
-            'audio_url': audio_url
+            'audio_url': audio['stream_url'] if audio else None,
+            'sources': sources or []
         })
-        
-        # Update last active time
         session_data['last_active'] = time.time()
+    
+    update_session(session_id, add_response)
+    
+    return audio
+
+def add_audio_fields(payload, audio):
+    """Attach an audio handle to a chat response; audio_url is only set once the MP3 exists"""
+    if audio:
+        payload["audio"] = audio
+        if audio['status'] == 'ready':
+            payload["audio_url"] = audio['url']
+    return payload
+
+# Format a server-sent event
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+# Stream a chat response as server-sent events
+def lookup_chat_cache(chat_cache, user_message):
+    """Find a cached answer for this exact question, or failing that a similar one"""
+    cached = response_cache.get(chat_cache['key'])
+    if cached is None and semantic_cache.enabled:
+        chat_cache['vector'] = semantic_cache.embed(user_message)
+        # Questions whose answers have expired are dropped from the index as they are found;
+        # candidates are peeked at so only the exact lookup counts towards the response cache's hit ratio
+        cached = semantic_cache.lookup(chat_cache['scope'], chat_cache['vector'], load=response_cache.peek)
+    return cached
+
+def store_chat_response(chat_cache, ai_response, sources):
+    """Cache an answer under its exact key and index the question for similar lookups"""
+    response_cache.set(chat_cache['key'], {"response": ai_response, "sources": sources})
+    semantic_cache.add(chat_cache['scope'], chat_cache.get('vector'), chat_cache['key'])
+
+def stream_chat_response(session_id, prompt, learning_style, sources, chat_cache=None):
+    """Forward Gemini output as it arrives and record the full response when done"""
+    parts = []
+    try:
+        chunks = llm.stream(prompt)
+        
+        # Post-process response based on learning style
+        if learning_style == "visual":
+            chunks = stream_visual_elements(chunks)
+        
+        for text in chunks:
+            if text:
+                parts.append(text)
+                yield sse_event({"delta": text})
+        
+        ai_response = "".join(parts)
+        if chat_cache:
+            store_chat_response(chat_cache, ai_response, sources)
+        audio = finalize_chat_response(session_id, ai_response, learning_style, sources)
         
-        # Return the response with audio URL if available
-        response_data = {
+        done = {
+            "done": True,
             "response": ai_response,
+            "sources": sources,
             "timestamp": time.time()
         }
+        yield sse_event(add_audio_fields(done, audio))
         
-        if audio_url:
-            response_data["audio_url"] = audio_url
+    except LLMUnavailable as e:
+        logger.warning(f"Gemini unavailable for chat stream: {str(e)}")
+        if parts:
+            yield sse_event({"error": "An error occurred. Please try again."})
+        else:
+            fallback_response = record_fallback_response(session_id)
+            yield sse_event({"delta": fallback_response})
+            yield sse_event({"done": True, "response": fallback_response, "timestamp": time.time()})
+    except Exception as e:
+        logger.error(f"Error in chat stream: {str(e)}")
+        yield sse_event({"error": "An error occurred. Please try again."})
+
+# Answer when Gemini can't be reached
+FALLBACK_RESPONSE = "I'm sorry, but the advanced AI model is not available right now. Please check the API key configuration or try again later."
+
+def record_fallback_response(session_id):
+    """Add the fallback answer to the chat history and return it"""
+    update_session(session_id, lambda s: s['chat_history'].append({
+        'role': 'assistant',
+        'content': FALLBACK_RESPONSE,
+        'timestamp': time.time()
+    }))
+    return FALLBACK_RESPONSE
+
+# Chat API endpoint
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    """Handle chat messages with improved formatting and learning style adaptations
+    
+    Send {"stream": true} to receive the answer as server-sent events: a series of
+    {"delta": ...} events followed by a final {"done": true, "response": ...} event.
+    Send {"cache": false} to skip the response cache.
+    """
+    try:
+        session_id = get_session_id()
+        
+        # Parse request data
+        data = request.json
+        if not data or 'message' not in data:
+            return jsonify({"error": "No message provided"}), 400
+            
+        user_message = data['message']
+        
+        # Add user message to history
+        session_data = update_session(session_id, lambda s: s['chat_history'].append({
+            'role': 'user',
+            'content': user_message,
+            'timestamp': time.time()
+        }))
+        learning_style = session_data.get('learning_style', 'blended')
+        
+        # If Gemini is not available, return a fallback response
+        if not llm.available:
+            return jsonify({
+                "response": record_fallback_response(session_id),
+                "timestamp": time.time()
+            })
+        
+        personalized_instruction = get_personalized_instruction()
+        
+        # Questions on the same documents, style, profile and recent conversation
+        # share answers; the earlier turns in the prompt's history window are part
+        # of the scope, so a follow-up never gets an answer given in another context
+        chat_cache = None
+        cached = None
+        if data.get('cache', True):
+            earlier_turns = [(msg['role'], msg['content'])
+                             for msg in session_data['chat_history'][-CHAT_HISTORY_MESSAGES:][:-1]]
+            scope = ResponseCache.make_key(
+                'scope',
+                [doc['content_hash'] for doc in session_data['documents']],
+                learning_style,
+                personalized_instruction,
+                earlier_turns
+            )
+            chat_cache = {
+                'key': ResponseCache.make_key('chat', normalize_question(user_message), scope),
+                'scope': scope
+            }
+            cached = lookup_chat_cache(chat_cache, user_message)
+        
+        if cached:
+            ai_response = cached['response']
+            sources = cached['sources']
+        else:
+            prompt, sources = build_chat_prompt(session_data, user_message, learning_style, personalized_instruction)
+            
+            # Stream partial text back as it is generated
+            if data.get('stream'):
+                return Response(
+                    stream_with_context(stream_chat_response(session_id, prompt, learning_style, sources, chat_cache)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+
+            # Call Gemini model
+            try:
+                ai_response = llm.generate(prompt)
+            except LLMUnavailable as e:
+                logger.warning(f"Gemini unavailable for chat: {str(e)}")
+                return jsonify({
+                    "response": record_fallback_response(session_id),
+                    "timestamp": time.time()
+                })
+            
+            # Post-process response based on learning style
+            if learning_style == "visual":
+                ai_response = add_visual_elements(ai_response)
+            
+            if chat_cache:
+                store_chat_response(chat_cache, ai_response, sources)
+        
+        audio = finalize_chat_response(session_id, ai_response, learning_style, sources)
+        
+        # Return the response with the audio handle if audio was requested
+        response_data = add_audio_fields({
+            "response": ai_response,
+            "sources": sources,
+            "timestamp": time.time()
+        }, audio)
+        
+        if cached:
+            response_data["cached"] = True
+            if data.get('stream'):
+                # Send the whole cached answer as a single delta
+                done = dict(response_data, done=True)
+                return Response(
+                    sse_event({"delta": ai_response}) + sse_event(done),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'}
+                )
         
         return jsonify(response_data)
         
@@ -883,7 +1671,7 @@ def set_learning_style():
         previous_style = user_sessions[session_id].get('learning_style', 'blended')
         
         # Update session
-        user_sessions[session_id]['learning_style'] = style
+        update_session(session_id, lambda s: s.update(learning_style=style))
         
         # If user is logged in, update their quiz data
         if 'user_email' in session:
@@ -904,6 +1692,7 @@ def set_learning_style():
                 {'$set': {'learningStyle': quiz_value}},
                 upsert=True
             )
+            invalidate_user_profile(session['user_email'])
         
         # Add a message to the chat history if the style has changed
         if style != previous_style:
@@ -913,21 +1702,21 @@ def set_learning_style():
             message = f"Learning style changed to **{style}**. I'll now adapt my responses for {style_description}."
             
             # Add information about special features
-            if style == "auditory" and GTTS_AVAILABLE:
+            if style == "auditory" and audio_pipeline.available:
                 message += " I'll generate audio for my responses that you can play back."
             elif style == "visual":
                 message += " I'll use visual organization, diagrams, and spatial cues in my explanations."
             
-            user_sessions[session_id]['chat_history'].append({
+            update_session(session_id, lambda s: s['chat_history'].append({
                 'role': 'assistant',
                 'content': message,
                 'timestamp': time.time()
-            })
+            }))
         
         return jsonify({
             "success": True,
             "learning_style": style,
-            "tts_available": GTTS_AVAILABLE if style == "auditory" else None
+            "tts_available": audio_pipeline.available if style == "auditory" else None
         })
         
     except Exception as e:
@@ -982,16 +1771,13 @@ def get_user_preferences():
         if 'user_email' not in session:
             return jsonify({"error": "Not logged in"}), 401
             
-        quiz_data = quiz_collection.find_one({"user_email": session['user_email']})
+        profile = get_user_profile(session['user_email'])
         
-        if not quiz_data:
+        if not profile['completed']:
             return jsonify({"error": "No quiz data found"}), 404
             
-        # Remove MongoDB ID and email for security
-        if '_id' in quiz_data:
-            del quiz_data['_id']
-        if 'user_email' in quiz_data:
-            del quiz_data['user_email']
+        # Remove email for security (the cached copy has no MongoDB ID)
+        quiz_data = {key: value for key, value in profile['quiz_data'].items() if key != 'user_email'}
             
         return jsonify({
             "preferences": quiz_data
@@ -1001,56 +1787,11 @@ def get_user_preferences():
         logger.error(f"Error in get_user_preferences: {str(e)}")
         return jsonify({"error": "An error occurred. Please try again."}), 500
 
-# Cleanup function for stale sessions
+# Start the janitor in each worker process (a no-op once it is running)
 @app.before_request
-def cleanup_sessions():
-    """Clean up stale sessions (run periodically)"""
-    now = time.time()
-    # Only run cleanup every 5 minutes
-    if now % 300 < 10:
-        try:
-            stale_threshold = now - (24 * 60 * 60)  # 24 hours
-            stale_sessions = []
-            
-            # Identify stale sessions
-            for session_id, session_data in user_sessions.items():
-                if session_data['last_active'] < stale_threshold:
-                    stale_sessions.append(session_id)
-                    
-            # Clean up stale sessions
-            for session_id in stale_sessions:
-                if session_id in user_sessions:
-                    # Delete files
-                    for doc in user_sessions[session_id].get('documents', []):
-                        filepath = doc.get('filepath')
-                        if filepath and os.path.exists(filepath):
-                            os.remove(filepath)
-                    
-                    # Delete audio files
-                    for entry in user_sessions[session_id].get('chat_history', []):
-                        if 'audio_url' in entry and entry['audio_url']:
-                            audio_file = entry['audio_url'].split('/')[-1]
-                            audio_path = os.path.join(AUDIO_FOLDER, audio_file)
-                            if os.path.exists(audio_path):
-                                os.remove(audio_path)
-                            
-                    # Delete session data
-                    del user_sessions[session_id]
-                    
-            if stale_sessions:
-                logger.info(f"Cleaned up {len(stale_sessions)} stale sessions")
-                
-            # Also clean up old audio files (older than 6 hours)
-            audio_threshold = now - (6 * 60 * 60)
-            if os.path.exists(AUDIO_FOLDER):
-                for filename in os.listdir(AUDIO_FOLDER):
-                    filepath = os.path.join(AUDIO_FOLDER, filename)
-                    if os.path.isfile(filepath) and os.path.getmtime(filepath) < audio_threshold:
-                        os.remove(filepath)
-                        logger.info(f"Cleaned up old audio file: {filepath}")
-                
-        except Exception as e:
-            logger.error(f"Error in cleanup_sessions: {str(e)}")
+def start_janitor():
+    janitor.start()
+
 # Add these new routes to app.py
 
 # Teacher dashboard route
@@ -1081,6 +1822,61 @@ def create_quiz():
     
     return render_template('create_quiz.html')
 
+# Submission reports read the summaries kept by data_access, one page at a time
+TEACHER_REPORT_PAGE_SIZE = int(os.getenv('TEACHER_REPORT_PAGE_SIZE', 20))
+TEACHER_REPORT_MAX_PAGE_SIZE = 200
+
+def page_limit(default, maximum):
+    """Page size from ?limit=, clamped to 1..maximum; raises ValueError if it isn't a number"""
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        raise ValueError("limit must be a number")
+    return min(max(limit, 1), maximum)
+
+def parse_object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
+
+def round_percent(value):
+    return round(value, 1) if value is not None else None
+
+def quiz_report_page(teacher_email, limit, after=None):
+    """A page of a teacher's quizzes with their submission summaries, and the next page's cursor"""
+    quizzes, next_cursor = data.teacher_quiz_page(teacher_email, limit, after)
+    summaries = data.find_quiz_summaries([quiz['_id'] for quiz in quizzes])
+    rows = []
+    for quiz in quizzes:
+        summary = summaries.get(quiz['_id'], {})
+        rows.append({
+            "quiz_id": str(quiz['_id']),
+            "title": quiz.get('title') or 'Untitled quiz',
+            "subject": quiz.get('subject', ''),
+            "students": summary.get('students', 0),
+            "submissions": summary.get('submissions', 0),
+            "average_percent": round_percent(summary.get('average_percent')),
+            "average_best_percent": round_percent(summary.get('average_best_percent')),
+            "best_percent": round_percent(summary.get('best_percent')),
+            "last_submitted_at": summary.get('last_submitted_at')
+        })
+    return rows, str(next_cursor) if next_cursor is not None else None
+
+def grade_quiz_answers(quiz, answers):
+    """Score and number of gradable questions for answers given as option indexes"""
+    score = total = 0
+    for number, question in enumerate(quiz.get('questions', [])):
+        options = question.get('options') or []
+        if not any(option.get('is_correct') for option in options):
+            continue  # short answers have no marked option to check against
+        total += 1
+        answer = answers[number] if number < len(answers) else None
+        if isinstance(answer, int) and not isinstance(answer, bool) and 0 <= answer < len(options) \
+                and options[answer].get('is_correct'):
+            score += 1
+    return score, total
+
 # View student submissions route
 @app.route('/student_submissions')
 def student_submissions():
@@ -1088,13 +1884,89 @@ def student_submissions():
         flash('Please login as a teacher to access this page.', 'error')
         return redirect(url_for('loginpage'))
     
-    # Fetch submissions that are for this teacher's quizzes
-    teacher_quizzes = list(db.quizzes.find({"teacher_email": session['user_email']}))
-    quiz_ids = [q['_id'] for q in teacher_quizzes]
+    # First page of quizzes with their summaries; the page loads more from /api/teacher/quiz_report
+    quizzes, next_cursor = quiz_report_page(session['user_email'], TEACHER_REPORT_PAGE_SIZE)
     
-    submissions = list(db.quiz_submissions.find({"quiz_id": {"$in": quiz_ids}}))
-    
-    return render_template('student_submissions.html', submissions=submissions, quizzes=teacher_quizzes)
+    return render_template('student_submissions.html', quizzes=quizzes, next_cursor=next_cursor,
+                           page_size=TEACHER_REPORT_PAGE_SIZE)
+
+# Quiz report API
+@app.route('/api/teacher/quiz_report', methods=['GET'])
+def teacher_quiz_report():
+    """Submission counts and average scores for a page of the teacher's quizzes; ?after=<next_cursor> for the next"""
+    if 'user_email' not in session or session.get('user_role') != 'teacher':
+        return jsonify({"error": "Teacher access required"}), 403
+    try:
+        limit = page_limit(TEACHER_REPORT_PAGE_SIZE, TEACHER_REPORT_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    after = None
+    if request.args.get('after'):
+        after = parse_object_id(request.args['after'])
+        if after is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+    try:
+        quizzes, next_cursor = quiz_report_page(session['user_email'], limit, after)
+        return jsonify({"quizzes": quizzes, "next_cursor": next_cursor})
+    except Exception as e:
+        logger.error(f"Error in teacher_quiz_report: {str(e)}")
+        return jsonify({"error": "Could not load the quiz report"}), 500
+
+# Per-student quiz results API
+@app.route('/api/teacher/quiz_report/<quiz_id>/students', methods=['GET'])
+def teacher_quiz_students(quiz_id):
+    """Each student's attempts and scores on one of the teacher's quizzes, a page at a time"""
+    if 'user_email' not in session or session.get('user_role') != 'teacher':
+        return jsonify({"error": "Teacher access required"}), 403
+    try:
+        limit = page_limit(TEACHER_REPORT_PAGE_SIZE, TEACHER_REPORT_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    quiz_object_id = parse_object_id(quiz_id)
+    if quiz_object_id is None:
+        return jsonify({"error": "Quiz not found"}), 404
+    try:
+        if data.find_quiz(quiz_object_id, session['user_email'], {'_id': 1}) is None:
+            return jsonify({"error": "Quiz not found"}), 404
+        students, next_cursor = data.student_summary_page(quiz_object_id, limit, request.args.get('after') or None)
+        for student in students:
+            for field in ('best_percent', 'last_percent', 'average_percent'):
+                student[field] = round_percent(student.get(field))
+        return jsonify({"students": students, "next_cursor": next_cursor})
+    except Exception as e:
+        logger.error(f"Error in teacher_quiz_students: {str(e)}")
+        return jsonify({"error": "Could not load the quiz results"}), 500
+
+# Quiz submission API
+@app.route('/api/quizzes/<quiz_id>/submit', methods=['POST'])
+def submit_quiz(quiz_id):
+    """Grade a student's answers (one option index per question) to a teacher's quiz and store them"""
+    if 'user_email' not in session:
+        return jsonify({"error": "Not logged in"}), 401
+    quiz_object_id = parse_object_id(quiz_id)
+    if quiz_object_id is None:
+        return jsonify({"error": "Quiz not found"}), 404
+    answers = (request.get_json(silent=True) or {}).get('answers')
+    if not isinstance(answers, list):
+        return jsonify({"error": "answers must be a list"}), 400
+    try:
+        quiz = data.find_quiz(quiz_object_id, fields={'questions': 1, 'teacher_email': 1})
+        if quiz is None:
+            return jsonify({"error": "Quiz not found"}), 404
+        score, total = grade_quiz_answers(quiz, answers)
+        data.add_submission({
+            "quiz_id": quiz_object_id,
+            "teacher_email": quiz.get('teacher_email'),
+            "student_email": session['user_email'],
+            "student_name": session.get('user_name', ''),
+            "answers": answers[:len(quiz.get('questions', []))],
+            "score": score,
+            "total": total
+        })
+        return jsonify({"success": True, "score": score, "total": total})
+    except Exception as e:
+        logger.error(f"Error in submit_quiz: {str(e)}")
+        return jsonify({"error": "Could not save your answers. Please try again."}), 500
 
 # Create syllabus plan route
 @app.route('/create_syllabus', methods=['GET', 'POST'])
@@ -1115,16 +1987,177 @@ def create_syllabus():
     return render_template('create_syllabus.html')
 
 
+# Admin user listing: pages in email order, fetched with the email (or role+email) index
+USER_ROLES = ('student', 'teacher', 'admin')
+ADMIN_USERS_PAGE_SIZE = int(os.getenv('ADMIN_USERS_PAGE_SIZE', 50))
+ADMIN_USERS_MAX_PAGE_SIZE = 500
+ADMIN_USERS_BATCH_SIZE = int(os.getenv('ADMIN_USERS_BATCH_SIZE', 500))  # documents per MongoDB round trip when streaming
+
+def admin_user_filters():
+    """Search text, role and page size from the query string; raises ValueError if invalid"""
+    search = request.args.get('q', '').strip()[:100] or None
+    role = request.args.get('role') or None
+    if role is not None and role not in USER_ROLES:
+        raise ValueError(f"Unknown role: {role}")
+    return search, role, page_limit(ADMIN_USERS_PAGE_SIZE, ADMIN_USERS_MAX_PAGE_SIZE)
+
 @app.route('/admin')
 def admin_dashboard():
     if 'user_email' not in session or session.get('user_role') != 'admin':
         flash('Please login as admin to access this page.', 'error')
         return redirect(url_for('loginpage'))
     
-    # Get all users for admin view
-    all_users = list(users_collection.find({}, {'password': 0}))  # Exclude password field
+    # First page only; the page loads the rest from /api/admin/users
+    try:
+        search, role, limit = admin_user_filters()
+    except ValueError:
+        search, role, limit = None, None, ADMIN_USERS_PAGE_SIZE
+    users, next_cursor = data.page_users(limit, search=search, role=role)  # Name, email and role only
     
-    return render_template('admin_dashboard.html', users=all_users)
+    return render_template('admin_dashboard.html', users=users, next_cursor=next_cursor,
+                           search=search or '', role=role or '', roles=USER_ROLES, page_size=limit)
+
+# Admin user listing API
+@app.route('/api/admin/users', methods=['GET'])
+def admin_list_users():
+    """One page of users matching ?q= (email prefix or name) and ?role=; pass ?after=<next_cursor> for the next"""
+    if 'user_email' not in session or session.get('user_role') != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    try:
+        search, role, limit = admin_user_filters()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        users, next_cursor = data.page_users(limit, request.args.get('after') or None, search, role)
+        return jsonify({"users": users, "next_cursor": next_cursor})
+    except Exception as e:
+        logger.error(f"Error listing users: {str(e)}")
+        return jsonify({"error": "Could not list users"}), 500
+
+# Streamed admin user export
+@app.route('/api/admin/users/stream', methods=['GET'])
+def admin_stream_users():
+    """Every user matching ?q= and ?role= as newline-delimited JSON"""
+    if 'user_email' not in session or session.get('user_role') != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    try:
+        search, role, _ = admin_user_filters()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        lines = []
+        try:
+            for user in data.iter_users(search, role, ADMIN_USERS_BATCH_SIZE):
+                lines.append(json.dumps(user))
+                if len(lines) >= 100:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+        except Exception as e:
+            logger.error(f"Error streaming users: {str(e)}")
+            lines.append(json.dumps({"error": "The user list was cut short"}))
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename=users.jsonl', 'X-Accel-Buffering': 'no'}
+    )
+
+# Bulk user import and bulk changes
+USER_IMPORT_BATCH_SIZE = int(os.getenv('USER_IMPORT_BATCH_SIZE', 500))  # rows per existence check and insert_many
+ADMIN_BULK_MAX_USERS = int(os.getenv('ADMIN_BULK_MAX_USERS', 5000))
+# Password hashing is CPU-bound but runs outside the GIL, so imports hash on several cores
+password_hash_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)), thread_name_prefix='password-hash')
+user_importer = UserImporter(data, is_valid_email, generate_password_hash, password_hash_executor, USER_ROLES,
+                             batch_size=USER_IMPORT_BATCH_SIZE)
+
+# Admin bulk user import
+@app.route('/api/admin/users/import', methods=['POST'])
+def admin_import_users():
+    """Create users from an uploaded CSV or JSONL file (full_name, email, password, optional role)
+
+    Streams one JSON line per row ({"row", "email", "status", "error"}; rejected
+    rows come back before the rest of their batch) and a final
+    {"summary": {status: count}} line.
+    """
+    if 'user_email' not in session or session.get('user_role') != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    upload = request.files.get('file')
+    if upload is None or upload.filename == '':
+        return jsonify({"error": "No file uploaded"}), 400
+    if not upload.filename.lower().endswith(('.csv', '.jsonl', '.ndjson')):
+        return jsonify({"error": "Upload a .csv or .jsonl file"}), 400
+    try:
+        rows = open_rows(upload.stream, upload.filename)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        summary = {}
+        try:
+            for result in user_importer.run(rows):
+                summary[result['status']] = summary.get(result['status'], 0) + 1
+                yield json.dumps(result) + "\n"
+        except UnicodeDecodeError:
+            yield json.dumps({"error": "The file is not UTF-8 text; rows after this point were not imported"}) + "\n"
+        except Exception as e:
+            logger.error(f"Error importing users: {str(e)}")
+            yield json.dumps({"error": "The import stopped early; rows after this point were not imported"}) + "\n"
+        logger.info(f"Admin {session.get('user_email')} imported users: {summary}")
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
+
+# Admin bulk role change and delete
+@app.route('/api/admin/users/bulk', methods=['POST'])
+def admin_bulk_users():
+    """Apply {"action": "set_role" or "delete", "emails": [...], "role": ...} to many users in one write"""
+    if 'user_email' not in session or session.get('user_role') != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    body = request.get_json(silent=True) or {}
+    action = body.get('action')
+    emails = body.get('emails')
+    role = body.get('role')
+    if action not in ('set_role', 'delete'):
+        return jsonify({"error": "action must be set_role or delete"}), 400
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return jsonify({"error": "emails must be a list of email addresses"}), 400
+    if len(emails) > ADMIN_BULK_MAX_USERS:
+        return jsonify({"error": f"At most {ADMIN_BULK_MAX_USERS} users per request"}), 400
+    if action == 'set_role' and role not in USER_ROLES:
+        return jsonify({"error": f"role must be one of {', '.join(USER_ROLES)}"}), 400
+
+    try:
+        emails = list(dict.fromkeys(emails))
+        existing = data.existing_emails(emails)
+        results = []
+        targets = []
+        for email in emails:
+            if email == session['user_email']:
+                # Admins can't delete or demote their own account
+                results.append({"email": email, "status": "skipped", "error": "This is your own account"})
+            elif email not in existing:
+                results.append({"email": email, "status": "not_found"})
+            else:
+                targets.append(email)
+                results.append({"email": email, "status": "deleted" if action == 'delete' else "updated"})
+
+        changed = 0
+        if targets:
+            if action == 'delete':
+                changed = data.delete_users(targets)
+                for email in targets:
+                    invalidate_user_profile(email)
+            else:
+                changed = data.set_roles(targets, role)
+        return jsonify({"success": True, "changed": changed, "results": results})
+    except Exception as e:
+        logger.error(f"Error in admin_bulk_users: {str(e)}")
+        return jsonify({"error": "The bulk change failed. Please try again."}), 500
 
 # Admin edit user route
 @app.route('/admin/edit_user/<user_email>', methods=['GET', 'POST'])
@@ -1143,6 +2176,7 @@ def admin_edit_user(user_email):
         update_data = {
             "email": new_email,
             "full_name": new_name,
+            "name_key": name_key(new_name),
             "role": new_role
         }
         
@@ -1152,10 +2186,14 @@ def admin_edit_user(user_email):
             update_data["password"] = generate_password_hash(new_password)
         
         # Update user in database
-        users_collection.update_one(
-            {"email": user_email},
-            {"$set": update_data}
-        )
+        try:
+            users_collection.update_one(
+                {"email": user_email},
+                {"$set": update_data}
+            )
+        except DuplicateKeyError:
+            flash('Email already exists. Please use a different email.', 'error')
+            return redirect(url_for('admin_edit_user', user_email=user_email))
         
         # If email is being changed, we need to update related records
         if new_email != user_email:
@@ -1164,6 +2202,8 @@ def admin_edit_user(user_email):
                 {"user_email": user_email},
                 {"$set": {"user_email": new_email}}
             )
+            invalidate_user_profile(user_email)
+            invalidate_user_profile(new_email)
             
             # Update any other collections that reference user email
             
@@ -1171,7 +2211,7 @@ def admin_edit_user(user_email):
         return redirect(url_for('admin_dashboard'))
     
     # Get user data for edit form
-    user = users_collection.find_one({"email": user_email})
+    user = data.find_user(user_email)
     if not user:
         flash('User not found.', 'error')
         return redirect(url_for('admin_dashboard'))
@@ -1206,7 +2246,7 @@ def admin_create_user():
             return redirect(url_for('admin_create_user'))
         
         # Check if user already exists
-        if users_collection.find_one({"email": email}):
+        if data.user_exists(email):
             flash('Email already exists. Please use a different email.', 'error')
             return redirect(url_for('admin_create_user'))
         
@@ -1216,13 +2256,18 @@ def admin_create_user():
         # Create new user
         new_user = {
             "full_name": full_name,
+            "name_key": name_key(full_name),
             "email": email,
             "password": hashed_password,
             "role": role
         }
         
         # Insert into database
-        users_collection.insert_one(new_user)
+        try:
+            users_collection.insert_one(new_user)
+        except DuplicateKeyError:
+            flash('Email already exists. Please use a different email.', 'error')
+            return redirect(url_for('admin_create_user'))
         
         flash('User created successfully.', 'success')
         return redirect(url_for('admin_dashboard'))
@@ -1246,89 +2291,160 @@ def admin_delete_user(user_email):
     
     # Delete related user data
     quiz_collection.delete_many({"user_email": user_email})
+    invalidate_user_profile(user_email)
     
     flash('User deleted successfully.', 'success')
     return redirect(url_for('admin_dashboard'))
 
 # Quiz generation API
+# Quiz generation
+def get_quiz_modifiers(quiz_results):
+    """Prompt lines that adapt quiz questions to a user's learning preference quiz"""
+    modifiers = []
+    if quiz_results:
+        interaction_style = quiz_results.get('chatbotInteraction', '')
+        if interaction_style == 'Witty and humorous':
+            modifiers.append("Add a light touch of humor to the questions where appropriate.")
+        
+        struggle_help = quiz_results.get('struggleHelp', '')
+        if struggle_help == 'Hints or clues':
+            modifiers.append("Include subtle hints within the options for challenging questions.")
+        
+        focus_duration = quiz_results.get('studyDuration', '')
+        if focus_duration == 'less than 15 minutes':
+            modifiers.append("Keep questions concise and straightforward.")
+        elif focus_duration == 'More than an hour':
+            modifiers.append("Include some more complex, multi-step thinking questions.")
+    return modifiers
+
+@lru_cache(maxsize=256)
+def quiz_prompt_prefix(question_count, learning_style, modifiers):
+    """Build the quiz instructions for a question count, learning style and profile modifiers"""
+    prompt_parts = [
+        f"Generate {question_count} multiple-choice quiz questions about the following content.",
+        "Each question should have exactly 4 options with one correct answer.",
+        f"Format the response as a JSON array of objects with the structure: [{{'question': 'Question text', 'options': ['option1', 'option2', 'option3', 'option4'], 'correct_answer': 0}}] where correct_answer is the index (0-3) of the correct option.",
+    ]
+    
+    # Add learning style specific instructions
+    if learning_style == 'visual':
+        prompt_parts.append("Make the questions focused on relationships, patterns, and visual concepts.")
+    elif learning_style == 'auditory':
+        prompt_parts.append("Phrase questions conversationally, focusing on dialogue and verbal concepts.")
+    elif learning_style == 'hands-on':
+        prompt_parts.append("Focus questions on practical applications, problem-solving, and step-by-step processes.")
+    elif learning_style == 'reading':
+        prompt_parts.append("Create detailed, text-focused questions that test comprehension and analytical reading skills.")
+    
+    prompt_parts.extend(modifiers)
+    return "\n".join(prompt_parts)
+
+def build_quiz_prompt(chunks, question_count, learning_style, modifiers):
+    """Build the Gemini prompt for a set of multiple-choice questions about document chunks"""
+    builder = PromptBuilder(PROMPT_TOKEN_BUDGET)
+    builder.add('instructions', quiz_prompt_prefix(question_count, learning_style, tuple(modifiers)))
+    builder.add_parts('content', chunks, priority=1, header="\n\nContent:\n", separator="\n\n")
+    prompt = builder.build()
+    logger.debug(f"Quiz prompt: {prompt.tokens} tokens ({prompt.describe()})")
+    record_prompt_sections('quiz', prompt)
+    return prompt.text
+
+def quiz_bank_key(params):
+    return ResponseCache.make_key('quiz_bank', params['content_hash'], params['learning_style'], params['modifiers'])
+
+def get_quiz_bank(content_hash, learning_style, modifiers):
+    """Return the (key, params) of the question bank for a document, style and profile modifiers"""
+    params = {
+        'content_hash': content_hash,
+        'learning_style': learning_style,
+        'modifiers': modifiers
+    }
+    return quiz_bank_key(params), params
+
+def generate_bank_questions(params):
+    """Ask Gemini for a new batch of questions for a question bank"""
+    if not llm.available:
+        return []
+    index = get_document_index(params['content_hash'])
+    if not index:
+        return []
+    
+    # Start with an even spread of the document, then vary the passages so refills cover new ground
+    if quiz_bank_store.get(quiz_bank_key(params)) is None:
+        chunks = index.overview(CONTEXT_TOKEN_BUDGET)
+    else:
+        chunks = index.sample(CONTEXT_TOKEN_BUDGET)
+    prompt = build_quiz_prompt(chunks, QUIZ_BANK_BATCH, params['learning_style'], params['modifiers'])
+    
+    questions = parse_quiz_questions(llm.generate(prompt))
+    if not questions:
+        logger.error(f"Failed to parse generated questions for document {params['content_hash'][:12]}")
+    return questions
+
+quiz_banks = QuestionBanks(
+    quiz_bank_store,
+    generate_bank_questions,
+    quiz_bank_executor,
+    min_size=QUIZ_BANK_MIN_SIZE,
+    max_size=QUIZ_BANK_SIZE,
+    reuse=QUIZ_BANK_REUSE
+)
+
 @app.route('/api/generate_quiz', methods=['POST'])
 def generate_quiz_api():
+    """Serve quiz questions from the document's question bank
+    
+    Send {"cache": false} to generate a fresh set with Gemini instead.
+    """
     if 'user_email' not in session:
         return jsonify({"error": "You must be logged in to use this feature"}), 401
         
     try:
         data = request.get_json()
         document_id = data.get('document_id')
+        # The style picks the question bank and shapes the prompt, so only known styles are accepted
         learning_style = data.get('learning_style', 'blended')
-        question_count = data.get('question_count', 5)
+        if not isinstance(learning_style, str) or learning_style not in LEARNING_STYLES:
+            return jsonify({"error": f"Invalid learning style. Choose from: {', '.join(LEARNING_STYLES)}"}), 400
+        question_count = max(1, min(int(data.get('question_count', 5)), QUIZ_BANK_SIZE))
         
-        # Fetch the document content
-        doc_content = document_content.get(document_id, '')
-        
-        if not doc_content:
+        doc = find_session_document(get_session_id(), document_id)
+        index = get_document_index(doc['content_hash']) if doc else None
+        if not index or not index.chunks:
             return jsonify({"error": "Document not found or empty"}), 404
         
         # Get user's quiz results for personalization
-        quiz_results = quiz_collection.find_one({"user_email": session['user_email']})
-        
-        # Build prompt for Gemini API based on learning style and preferences
-        prompt_parts = [
-            f"Generate {question_count} multiple-choice quiz questions about the following content.",
-            "Each question should have exactly 4 options with one correct answer.",
-            f"Format the response as a JSON array of objects with the structure: [{{'question': 'Question text', 'options': ['option1', 'option2', 'option3', 'option4'], 'correct_answer': 0}}] where correct_answer is the index (0-3) of the correct option.",
-        ]
-        
-        # Add learning style specific instructions
-        if learning_style == 'visual':
-            prompt_parts.append("Make the questions focused on relationships, patterns, and visual concepts.")
-        elif learning_style == 'auditory':
-            prompt_parts.append("Phrase questions conversationally, focusing on dialogue and verbal concepts.")
-        elif learning_style == 'hands-on':
-            prompt_parts.append("Focus questions on practical applications, problem-solving, and step-by-step processes.")
-        elif learning_style == 'reading':
-            prompt_parts.append("Create detailed, text-focused questions that test comprehension and analytical reading skills.")
-        
-        # Add personalization based on quiz results
-        if quiz_results:
-            interaction_style = quiz_results.get('chatbotInteraction', '')
-            if interaction_style == 'Witty and humorous':
-                prompt_parts.append("Add a light touch of humor to the questions where appropriate.")
-            
-            struggle_help = quiz_results.get('struggleHelp', '')
-            if struggle_help == 'Hints or clues':
-                prompt_parts.append("Include subtle hints within the options for challenging questions.")
-            
-            focus_duration = quiz_results.get('studyDuration', '')
-            if focus_duration == 'less than 15 minutes':
-                prompt_parts.append("Keep questions concise and straightforward.")
-            elif focus_duration == 'More than an hour':
-                prompt_parts.append("Include some more complex, multi-step thinking questions.")
-        
-        # Combine prompt parts
-        prompt = "\n".join(prompt_parts) + "\n\nContent:\n" + doc_content[:5000]  # Limit content length
+        modifiers = get_user_profile(session['user_email'])['quiz_modifiers']
+        
+        if data.get('cache', True):
+            bank_key, bank_params = get_quiz_bank(doc['content_hash'], learning_style, modifiers)
+            questions = quiz_banks.sample(bank_key, bank_params, question_count, timeout=QUIZ_BANK_WAIT)
+            if questions:
+                return jsonify({
+                    "success": True,
+                    "questions": questions
+                })
+            if quiz_banks.building(bank_key):
+                return jsonify({"error": "Questions are still being generated. Please try again shortly."}), 503
+            # The bank build produced nothing; generate this quiz directly instead
         
         # Call Gemini API
-        if HAS_GEMINI:
-            response = model.generate_content(prompt)
-            response_text = response.text
-            
-            # Extract JSON from response
+        if llm.available:
+            # Fetch passages spread across the whole document
+            prompt = build_quiz_prompt(index.overview(CONTEXT_TOKEN_BUDGET), question_count, learning_style, modifiers)
             try:
-                # Find JSON array in the response
-                json_match = re.search(r'\[\s*\{.*\}\s*\]', response_text, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(0)
-                    questions = json.loads(json_str)
-                    
-                    return jsonify({
-                        "success": True,
-                        "questions": questions
-                    })
-                else:
-                    return jsonify({"error": "Failed to parse generated questions"}), 500
-            except Exception as e:
-                logger.error(f"Error parsing quiz questions: {str(e)}")
-                return jsonify({"error": "Failed to parse generated questions"}), 500
+                response_text = llm.generate(prompt)
+            except LLMUnavailable as e:
+                logger.warning(f"Gemini unavailable for quiz: {str(e)}")
+                return jsonify({"error": "AI model is not available"}), 503
+            
+            questions = parse_quiz_questions(response_text)
+            if questions:
+                return jsonify({
+                    "success": True,
+                    "questions": questions
+                })
+            return jsonify({"error": "Failed to parse generated questions"}), 500
         else:
             return jsonify({"error": "AI model is not available"}), 503
             
@@ -0,0 +1,298 @@
+import os
+import re
+import time
+import shutil
+import uuid
+import hashlib
+import logging
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Try to import gTTS, the default speech backend
+try:
+    from gtts import gTTS
+    GTTS_AVAILABLE = True
+except ImportError:
+    GTTS_AVAILABLE = False
+    logging.warning("gTTS not available. Audio generation will be disabled.")
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+# Anchored at line starts: an unanchored lazy match tried at every '#' is quadratic
+HEADING = re.compile(r'^#{1,6}[ \t]+([^\n]*)\n', re.MULTILINE)
+
+
+def clean_text_for_speech(text):
+    """Strip Markdown that shouldn't be read aloud"""
+    clean_text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Remove bold
+    clean_text = re.sub(r'\*(.*?)\*', r'\1', clean_text)       # Remove italic
+    clean_text = HEADING.sub(r'\1. ', clean_text)  # Convert headers to sentences
+    return clean_text
+
+
+def split_for_speech(text, max_chars=300):
+    """Split cleaned text into chunks at line (heading, list item) and sentence boundaries
+
+    The first chunk is a single sentence so playback can start as early as
+    possible; later chunks pack whole sentences up to max_chars.
+    """
+    sentences = []
+    for line in text.splitlines():
+        for sentence in SENTENCE_END.split(line.strip()):
+            # Break up run-on sentences at word boundaries
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(' ', 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                sentences.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if sentence:
+                sentences.append(sentence)
+
+    chunks = []
+    current = []
+    current_len = 0
+    for sentence in sentences:
+        if current and (len(chunks) == 0 or current_len + len(sentence) + 1 > max_chars):
+            chunks.append("\n".join(current))
+            current = []
+            current_len = 0
+        current.append(sentence)
+        current_len += len(sentence) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class GTTSBackend:
+    """Google Translate text-to-speech"""
+
+    name = 'gtts'
+
+    def __init__(self, lang='en', slow=False):
+        self.lang = lang
+        self.slow = slow
+        self.available = GTTS_AVAILABLE
+
+    def synthesize(self, text, path):
+        gTTS(text=text, lang=self.lang, slow=self.slow).save(path)
+
+
+def load_backend(spec):
+    """Create a speech backend from 'gtts' or a 'package.module:ClassName' path"""
+    if not spec or spec == 'gtts':
+        return GTTSBackend()
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class AudioPipeline:
+    """Background text-to-speech with MP3s cached by a hash of the spoken text
+
+    request() returns a handle straight away. The text is split into sentence
+    chunks that are synthesized in parallel on a bounded thread pool, and the
+    parts are joined into one MP3 (MP3 frames concatenate cleanly) once all
+    are done. iter_audio() streams the parts in order as they become ready, so
+    playback starts after the first sentence instead of the whole answer.
+
+    Identical text maps to the same file, so it is synthesized once and shared
+    by every response that says it. Job status lives in a session_store store;
+    its add() makes sure only one worker synthesizes a given text, and a
+    failed job is retried with compare_and_set() so only one request restarts
+    it. Each run has its own token, used for its part files and its count of
+    parts left, and a job is only marked failed once all of its parts are done.
+    """
+
+    def __init__(self, directory, backend, jobs, workers=4, chunk_chars=300, part_timeout=30, url_prefix='/audio',
+                 on_file=None, on_part=None):
+        self.directory = directory
+        self.backend = backend
+        self.jobs = jobs
+        self.chunk_chars = chunk_chars
+        self.part_timeout = part_timeout
+        self.url_prefix = url_prefix
+        self.on_file = on_file  # called with the path of each MP3 written or reused
+        self.on_part = on_part  # called with (seconds, characters, failed) for each synthesized chunk
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tts')
+        self._remaining = {}  # run token -> [parts left, any part failed]
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def available(self):
+        return getattr(self.backend, 'available', True)
+
+    def audio_id(self, clean_text):
+        key = f"{getattr(self.backend, 'name', type(self.backend).__name__)}\n{clean_text}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def path(self, audio_id):
+        return os.path.join(self.directory, f"{audio_id}.mp3")
+
+    def part_path(self, audio_id, run, number):
+        return os.path.join(self.directory, f"{audio_id}.{run}.part{number}.mp3")
+
+    def handle(self, audio_id, status, error=None):
+        handle = {
+            'id': audio_id,
+            'status': status,
+            'url': f"{self.url_prefix}/{audio_id}.mp3",
+            'stream_url': f"{self.url_prefix}/stream/{audio_id}.mp3"
+        }
+        if error:
+            handle['error'] = error
+        return handle
+
+    def request(self, text):
+        """Queue speech for text and return its handle ({'id', 'status', 'url', 'stream_url'})"""
+        clean_text = clean_text_for_speech(text)
+        audio_id = self.audio_id(clean_text)
+        path = self.path(audio_id)
+
+        if os.path.exists(path):
+            # Reused audio counts as recently used for cleanup
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            if self.on_file:
+                self.on_file(path)
+            return self.handle(audio_id, 'ready')
+
+        chunks = split_for_speech(clean_text, self.chunk_chars)
+        if not chunks:
+            return self.handle(audio_id, 'failed', "Nothing to read aloud")
+        job = {'status': 'pending', 'parts': len(chunks), 'run': uuid.uuid4().hex, 'created': time.time()}
+        if not self.jobs.add(audio_id, job):
+            existing = self.jobs.get(audio_id)
+            if existing is None or existing['status'] != 'failed':
+                return self.handle(audio_id, existing['status'] if existing else 'pending')
+            # Try a failed synthesis again; if another request got there first, it is pending
+            if not self.jobs.compare_and_set(audio_id, existing, job):
+                return self.handle(audio_id, 'pending')
+
+        with self._lock:
+            self._remaining[job['run']] = [len(chunks), False]
+        queued = 0
+        try:
+            # Parts are queued in order, so the first sentence is synthesized first
+            for number, chunk in enumerate(chunks):
+                self.executor.submit(self._synthesize_part, audio_id, job, number, chunk)
+                queued += 1
+        except Exception as e:
+            logger.error(f"Could not queue audio {audio_id[:12]}: {str(e)}")
+            # The job is marked failed once the parts already queued are done
+            self._parts_done(audio_id, job, len(chunks) - queued, True)
+            return self.handle(audio_id, 'failed', str(e))
+        return self.handle(audio_id, 'pending')
+
+    def status(self, audio_id):
+        """Return the handle for an audio id, or None if it was never requested"""
+        if os.path.exists(self.path(audio_id)):
+            return self.handle(audio_id, 'ready')
+        job = self.jobs.get(audio_id)
+        if job is None:
+            return None
+        handle = self.handle(audio_id, job['status'], job.get('error'))
+        if job['status'] == 'pending':
+            handle['parts'] = job['parts']
+            handle['parts_ready'] = sum(os.path.exists(self.part_path(audio_id, job['run'], n)) for n in range(job['parts']))
+        return handle
+
+    def iter_audio(self, audio_id, block_size=64 * 1024):
+        """Yield the MP3 bytes for an audio id, waiting for parts that are still being synthesized"""
+        path = self.path(audio_id)
+        job = self.jobs.get(audio_id)
+        parts = job.get('parts', 0) if job and job['status'] == 'pending' else 0
+        sent = 0
+        for number in range(parts):
+            part_path = self.part_path(audio_id, job['run'], number)
+            deadline = time.time() + self.part_timeout
+            while not os.path.exists(part_path):
+                if os.path.exists(path):
+                    # The parts were joined (and removed) meanwhile; continue from the full file
+                    yield from self._read_file(path, block_size, offset=sent)
+                    return
+                current = self.jobs.get(audio_id)
+                if current is None or current.get('run') != job['run'] or current['status'] == 'failed' or time.time() > deadline:
+                    logger.warning(f"Audio stream {audio_id[:12]} stopped waiting for part {number + 1} of {parts}")
+                    return
+                time.sleep(0.1)
+            try:
+                for block in self._read_file(part_path, block_size):
+                    sent += len(block)
+                    yield block
+            except FileNotFoundError:
+                yield from self._read_file(path, block_size, offset=sent)
+                return
+        if not parts and os.path.exists(path):
+            yield from self._read_file(path, block_size)
+
+    def _read_file(self, path, block_size, offset=0):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    return
+                yield block
+
+    def _synthesize_part(self, audio_id, job, number, text):
+        part_path = self.part_path(audio_id, job['run'], number)
+        tmp_path = f"{part_path}.{os.getpid()}.tmp"
+        started = time.time()
+        failed = False
+        try:
+            self.backend.synthesize(text, tmp_path)
+            os.replace(tmp_path, part_path)
+        except Exception as e:
+            logger.error(f"Error generating audio part {number + 1} of {audio_id[:12]}: {str(e)}")
+            failed = True
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self.on_part:
+            try:
+                self.on_part(time.time() - started, len(text), failed)
+            except Exception as e:
+                logger.error(f"Error in audio part observer: {str(e)}")
+        self._parts_done(audio_id, job, 1, failed)
+
+    def _parts_done(self, audio_id, job, count, failed):
+        """Count parts of a run as done, finishing the run after its last one"""
+        with self._lock:
+            remaining = self._remaining[job['run']]
+            remaining[0] -= count
+            remaining[1] = remaining[1] or failed
+            done = remaining[0] == 0
+            if done:
+                del self._remaining[job['run']]
+        if done:
+            self._finish(audio_id, job, remaining[1])
+
+    def _finish(self, audio_id, job, failed):
+        """Join the parts into the cached MP3 once every part is done"""
+        parts = [self.part_path(audio_id, job['run'], n) for n in range(job['parts'])]
+        status = {'status': 'failed', 'error': "Audio generation failed", 'created': time.time()}
+        try:
+            if not failed:
+                path = self.path(audio_id)
+                tmp_path = f"{path}.{job['run']}.tmp"
+                with open(tmp_path, 'wb') as out:
+                    for part_path in parts:
+                        with open(part_path, 'rb') as f:
+                            shutil.copyfileobj(f, out)
+                os.replace(tmp_path, path)
+                if self.on_file:
+                    self.on_file(path)
+                status = {'status': 'ready', 'parts': job['parts'], 'created': time.time()}
+                logger.info(f"Audio {audio_id[:12]} generated from {len(parts)} parts")
+        except Exception as e:
+            logger.error(f"Error joining audio {audio_id[:12]}: {str(e)}")
+        finally:
+            # Only settle this run's job, not one started after it expired from the store
+            self.jobs.compare_and_set(audio_id, job, status)
+            for part_path in parts:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
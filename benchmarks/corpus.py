@@ -0,0 +1,101 @@
+import os
+import random
+import logging
+
+# Sample documents for the upload benchmark.
+#
+# Text is generated from a fixed vocabulary and seed, so every run uploads
+# the same bytes. Each variant has different content (and so a different
+# content hash), which makes the first upload of a variant go through
+# extraction and indexing; later uploads of it hit the document cache.
+
+WORDS = (
+    "energy system cell membrane protein reaction equation force motion graph "
+    "theory model data sample variable function derivative integral vector matrix "
+    "history empire trade culture language author argument evidence source claim "
+    "market price demand supply policy growth rate experiment result method error"
+).split()
+
+
+def make_paragraphs(rng, paragraphs, sentences=6):
+    text = []
+    for _ in range(paragraphs):
+        sentence_list = []
+        for _ in range(sentences):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(8, 18))]
+            sentence_list.append(" ".join(words).capitalize() + ".")
+        text.append(" ".join(sentence_list))
+    return text
+
+
+def make_txt(rng, pages):
+    return "\n\n".join(make_paragraphs(rng, pages * 4)).encode('utf-8')
+
+
+def make_pdf(rng, pages):
+    """A plain PDF with one paragraph of Helvetica text per page"""
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(f"{4 + 2 * i} 0 R" for i in range(pages)), pages),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for i in range(pages):
+        lines = []
+        for paragraph in make_paragraphs(rng, 2, sentences=3):
+            words = paragraph.split()
+            lines.extend(" ".join(words[j:j + 12]) for j in range(0, len(words), 12))
+        text = " T* ".join(f"({line})'" if k else f"({line}) Tj" for k, line in enumerate(lines))
+        stream = f"BT /F1 10 Tf 14 TL 50 750 Td {text} ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects):
+        offsets.append(len(out))
+        out += f"{number + 1} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode('latin-1')
+
+
+def make_pptx(rng, slides, path):
+    from pptx import Presentation
+
+    presentation = Presentation()
+    layout = presentation.slide_layouts[1]
+    for number in range(slides):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f"Slide {number + 1}: {rng.choice(WORDS).capitalize()}"
+        slide.placeholders[1].text = "\n".join(make_paragraphs(rng, 3, sentences=1))
+    presentation.save(path)
+
+
+def write_corpus(directory, variants=10, pages=8, kinds=('txt', 'pdf', 'pptx'), seed=0):
+    """Write the sample documents and return their paths grouped by kind"""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    corpus = {}
+    for kind in kinds:
+        paths = []
+        for variant in range(variants):
+            path = os.path.join(directory, f"sample{variant}.{kind}")
+            if kind == 'txt':
+                with open(path, 'wb') as f:
+                    f.write(make_txt(rng, pages))
+            elif kind == 'pdf':
+                with open(path, 'wb') as f:
+                    f.write(make_pdf(rng, pages))
+            elif kind == 'pptx':
+                try:
+                    make_pptx(rng, pages, path)
+                except Exception as e:
+                    logging.warning(f"Skipping PPTX samples, python-pptx is not usable: {str(e)}")
+                    break
+            paths.append(path)
+        if paths:
+            corpus[kind] = paths
+    return corpus
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import time
+import types
+import random
+import logging
+
+# Deterministic stand-ins for the services app.py talks to.
+#
+# install() must run before app is imported: it puts a fake
+# google.generativeai module in sys.modules and points pymongo.MongoClient at
+# mongomock, so the real app code runs without network access or API keys.
+# The fake model sleeps for BENCH_GEMINI_LATENCY seconds (plus jitter) per
+# call and returns the same kind of text Gemini would for chat and quiz
+# prompts.
+
+BENCH_PASSWORD = 'benchmark-password'
+BENCH_USERS = int(os.getenv('BENCH_USERS', 64))
+
+CHAT_ANSWER = (
+    "## Key idea\n"
+    "The passage explains how **energy** moves between parts of a system. "
+    "Think of it as a flow from a source to a sink.\n"
+    "- First, energy is stored.\n"
+    "- Then it is transferred.\n"
+    "- Finally some of it is lost as heat.\n"
+    "Does that match what you expected?"
+)
+
+
+def bench_email(number):
+    return f"bench{number}@example.com"
+
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """Answers like Gemini after a configurable delay"""
+
+    def __init__(self, model_name='fake', latency=None, jitter=None, chunk_delay=None, **kwargs):
+        self.model_name = model_name
+        self.latency = float(os.getenv('BENCH_GEMINI_LATENCY', 0.2)) if latency is None else latency
+        self.jitter = float(os.getenv('BENCH_GEMINI_JITTER', 0.05)) if jitter is None else jitter
+        self.chunk_delay = float(os.getenv('BENCH_GEMINI_CHUNK_DELAY', 0.01)) if chunk_delay is None else chunk_delay
+        self._random = random.Random(int(os.getenv('BENCH_SEED', 0)))
+
+    def _wait(self):
+        time.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+    def _answer(self, prompt):
+        prompt = str(prompt)
+        if 'correct_answer' in prompt:
+            count = 5
+            first_line = prompt.split('\n', 1)[0].split()
+            if len(first_line) > 1 and first_line[1].isdigit():
+                count = int(first_line[1])
+            return json.dumps([
+                {
+                    'question': f"Benchmark question {number + 1} ({self._random.random():.6f})?",
+                    'options': ['Option A', 'Option B', 'Option C', 'Option D'],
+                    'correct_answer': number % 4
+                }
+                for number in range(count)
+            ])
+        return CHAT_ANSWER
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        self._wait()
+        text = self._answer(prompt)
+        if not stream:
+            return _Response(text)
+        return self._stream(text)
+
+    def _stream(self, text):
+        for start in range(0, len(text), 40):
+            time.sleep(self.chunk_delay)
+            yield _Response(text[start:start + 40])
+
+
+class FakeTTS:
+    """Speech backend (TTS_BACKEND=benchmarks.fakes:FakeTTS) that writes silent MP3 frames"""
+
+    name = 'fake'
+    available = True
+    # One MPEG-1 Layer III frame header followed by padding
+    FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+    def synthesize(self, text, path):
+        time.sleep(float(os.getenv('BENCH_TTS_LATENCY', 0.05)))
+        with open(path, 'wb') as f:
+            f.write(self.FRAME * max(1, len(text) // 20))
+
+
+def install():
+    """Replace Gemini and MongoDB before app.py is imported"""
+    import mongomock
+    import pymongo
+
+    genai = types.ModuleType('google.generativeai')
+    genai.configure = lambda **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    google = sys.modules.get('google') or types.ModuleType('google')
+    if not hasattr(google, '__path__'):
+        google.__path__ = []
+    google.generativeai = genai
+    sys.modules['google'] = google
+    sys.modules['google.generativeai'] = genai
+
+    # Every worker process gets its own in-memory database, seeded identically by seed()
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ.setdefault('MONGO_URI', 'mongodb://benchmark')
+    os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+    os.environ.setdefault('SEMANTIC_CACHE_ENABLED', 'false')
+    os.environ.setdefault('TTS_BACKEND', 'benchmarks.fakes:FakeTTS')
+
+
+def seed(app_module, users=BENCH_USERS):
+    """Create the benchmark users, each with a completed learning style quiz"""
+    from werkzeug.security import generate_password_hash
+
+    password = generate_password_hash(BENCH_PASSWORD)
+    app_module.users_collection.insert_many([
+        {'full_name': f"Bench User {number}", 'email': bench_email(number), 'password': password, 'role': 'student'}
+        for number in range(users)
+    ])
+    app_module.quiz_collection.insert_many([
+        {
+            'user_email': bench_email(number),
+            'learningStyle': 'Watching videos',
+            'studyEnv': 'Quiet room',
+            'retainInfo': 'Writing notes',
+            'newTopicPreference': 'Start with a broad overview',
+            'studyDuration': '15-30 minutes',
+            'struggleHelp': 'Step-by-step guidance',
+            'chatbotInteraction': 'Friendly and casual'
+        }
+        for number in range(users)
+    ])
+    logging.info(f"Seeded {users} benchmark users")
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import statistics
+
+# Micro-benchmarks for the text processing that runs on every chat, upload
+# and quiz request.
+#
+# Each case runs a function on synthetic inputs from 10 KB to 5 MB and
+# records the median time and peak traced allocation. Pathological cases
+# feed inputs built to trigger regex backtracking or quadratic loops at
+# growing sizes and flag any that grow much faster than their input. Save a
+# run with --save-baseline and compare later runs with --baseline; changes
+# above --threshold are reported as regressions and exit with status 1.
+#
+#   python -m benchmarks.micro --save-baseline benchmarks/results/micro-baseline.json
+#   python -m benchmarks.micro --baseline benchmarks/results/micro-baseline.json --threshold 0.25
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fakes  # noqa: E402
+from benchmarks.corpus import WORDS, make_paragraphs, make_pdf  # noqa: E402
+
+fakes.install()
+logging.disable(logging.WARNING)  # keep the report free of app log lines
+
+import app  # noqa: E402
+from audio_pipeline import clean_text_for_speech, split_for_speech  # noqa: E402
+from question_bank import parse_quiz_questions  # noqa: E402
+from retrieval import DocumentIndex  # noqa: E402
+
+KB = 1024
+MB = 1024 * KB
+SIZES = [10 * KB, 100 * KB, 1 * MB, 5 * MB]
+PATHOLOGICAL_SIZES = [10 * KB, 40 * KB, 160 * KB]
+# A pathological case is flagged when 4x the input takes this many times longer
+SUPERLINEAR_RATIO = 8
+
+HEADINGS = ["Math example", "Step by step process", "Ancient history timeline", "Biology summary", "Overview"]
+
+
+# Synthetic inputs
+
+def markdown_response(size, seed=0):
+    """A model response with headings, lists, bold and italic text"""
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        block = [f"## {rng.choice(HEADINGS)}"]
+        block.extend(f"- **{rng.choice(WORDS)}** is *{rng.choice(WORDS)}* {rng.choice(WORDS)}" for _ in range(4))
+        block.extend(make_paragraphs(rng, 2, sentences=3))
+        text = "\n".join(block) + "\n\n"
+        parts.append(text)
+        length += len(text)
+    return "".join(parts)[:size]
+
+
+def document_text(size, seed=0):
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        paragraph = make_paragraphs(rng, 1)[0] + "\n\n"
+        parts.append(paragraph)
+        length += len(paragraph)
+    return "".join(parts)[:size]
+
+
+def quiz_response(size, seed=0):
+    """Prose around a JSON array of questions, the way Gemini tends to answer"""
+    rng = random.Random(seed)
+    questions = []
+    length = 0
+    while length < size:
+        question = {
+            'question': " ".join(rng.choice(WORDS) for _ in range(12)) + "?",
+            'options': [" ".join(rng.choice(WORDS) for _ in range(3)) for _ in range(4)],
+            'correct_answer': rng.randint(0, 3)
+        }
+        questions.append(question)
+        length += len(json.dumps(question))
+    return "Here are your questions:\n```json\n" + json.dumps(questions, indent=2) + "\n```\nGood luck!"
+
+
+def quiz_answers():
+    return {
+        'learningStyle': 'Watching videos',
+        'studyEnv': 'Quiet room',
+        'retainInfo': 'Writing notes',
+        'newTopicPreference': 'Start with a broad overview',
+        'studyDuration': '15-30 minutes',
+        'struggleHelp': 'Step-by-step guidance',
+        'chatbotInteraction': 'Friendly and casual'
+    }
+
+
+def repeat_to(unit, size):
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+class Files:
+    """Temporary documents for process_file"""
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='studiq-micro-')
+
+    def txt(self, size):
+        path = os.path.join(self.directory, f"doc{size}.txt")
+        if not os.path.exists(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(document_text(size))
+        return path
+
+    def pdf(self, size):
+        path = os.path.join(self.directory, f"doc{size}.pdf")
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                # Each generated page holds a little under 1 KB of text
+                f.write(make_pdf(random.Random(0), max(1, size // KB)))
+        return path
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def drain(iterator):
+    for _ in iterator:
+        pass
+
+
+def stream_in_chunks(text, chunk=40):
+    return (text[i:i + chunk] for i in range(0, len(text), chunk))
+
+
+def cases(files):
+    """(name, function of the prepared input, input factory, sizes, pathological)"""
+    return [
+        ('add_visual_elements', app.add_visual_elements, markdown_response, SIZES, False),
+        ('stream_visual_elements', lambda text: drain(app.stream_visual_elements(stream_in_chunks(text))),
+         markdown_response, SIZES, False),
+        ('clean_text_for_speech', clean_text_for_speech, markdown_response, SIZES, False),
+        ('split_for_speech', split_for_speech, lambda size: clean_text_for_speech(markdown_response(size)), SIZES, False),
+        ('generate_personalized_prompt', lambda answers: [app.generate_personalized_prompt(answers) for _ in range(1000)],
+         lambda size: quiz_answers(), [1000], False),
+        ('parse_quiz_questions', parse_quiz_questions, quiz_response, SIZES, False),
+        ('process_file_txt', app.process_file, files.txt, SIZES, False),
+        ('process_file_pdf', app.process_file, files.pdf, SIZES[:3], False),
+        ('document_index', DocumentIndex.from_text, document_text, SIZES, False),
+
+        # Inputs meant to make regexes backtrack or loops go quadratic
+        ('visual_hashes', app.add_visual_elements, lambda size: "#" * size, PATHOLOGICAL_SIZES, True),
+        ('visual_headings', app.add_visual_elements, lambda size: repeat_to("# ", size), PATHOLOGICAL_SIZES, True),
+        ('speech_unclosed_headings', clean_text_for_speech, lambda size: repeat_to("# ", size), PATHOLOGICAL_SIZES, True),
+        ('speech_asterisks', clean_text_for_speech, lambda size: repeat_to("*a", size), PATHOLOGICAL_SIZES, True),
+        ('speech_unclosed_bold', clean_text_for_speech, lambda size: repeat_to("**a ", size), PATHOLOGICAL_SIZES, True),
+        ('split_one_long_word', split_for_speech, lambda size: "a" * size, PATHOLOGICAL_SIZES, True),
+        ('quiz_open_brackets', parse_quiz_questions, lambda size: "[" * size, PATHOLOGICAL_SIZES, True),
+        ('quiz_unclosed_objects', parse_quiz_questions, lambda size: repeat_to('[{"question": "a", ', size), PATHOLOGICAL_SIZES, True),
+        ('quiz_unclosed_arrays', parse_quiz_questions, lambda size: repeat_to("[1, 2, ", size), PATHOLOGICAL_SIZES, True),
+    ]
+
+
+def measure(function, value, repeat, min_time):
+    """Median seconds per call, then the peak traced allocation of one more call"""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < repeat or (time.perf_counter() - started < min_time and len(timings) < 100):
+        call_started = time.perf_counter()
+        function(value)
+        timings.append(time.perf_counter() - call_started)
+        if timings[-1] > 5:
+            break  # one slow call is enough to measure
+    tracemalloc.start()
+    try:
+        function(value)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(timings), peak, len(timings)
+
+
+def size_label(size):
+    if size < KB:
+        return f"x{size}"
+    return f"{size // MB}MB" if size >= MB and size % MB == 0 else f"{size // KB}KB"
+
+
+def run(args):
+    files = Files()
+    results = {}
+    flagged = []
+    try:
+        for name, function, make_input, sizes, pathological in cases(files):
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+            previous = None
+            for size in sizes:
+                if size > args.max_size:
+                    continue
+                value = make_input(size)
+                seconds, peak, runs = measure(function, value, args.repeat, args.min_time)
+                key = f"{name}[{size_label(size)}]"
+                results[key] = {
+                    'seconds': round(seconds, 6),
+                    'peak_alloc_bytes': peak,
+                    'runs': runs,
+                    'pathological': pathological
+                }
+                print(f"{key:40} {seconds * 1000:10.3f} ms  {peak / MB:8.2f} MB peak", flush=True)
+                if pathological and previous and seconds > 0.001:
+                    growth = seconds / previous[1]
+                    if growth > SUPERLINEAR_RATIO * (size / previous[0]) / 4:
+                        flagged.append(f"{key} took {growth:.1f}x longer for {size // previous[0]}x the input")
+                previous = (size, max(seconds, 1e-9))
+    finally:
+        files.close()
+    return results, flagged
+
+
+def compare(results, baseline_path, threshold):
+    """Return a list of regressions against an earlier run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for key, result in sorted(results.items()):
+        old = baseline.get(key)
+        if not old:
+            continue
+        # Ignore noise on calls that take less than a millisecond
+        if result['seconds'] > 0.001 and result['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append(f"{key}: time {old['seconds'] * 1000:.2f} ms -> {result['seconds'] * 1000:.2f} ms")
+        if result['peak_alloc_bytes'] > 64 * KB and result['peak_alloc_bytes'] > old['peak_alloc_bytes'] * (1 + threshold):
+            regressions.append(f"{key}: peak allocation {old['peak_alloc_bytes']} -> {result['peak_alloc_bytes']} bytes")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the text processing hot paths")
+    parser.add_argument('--only', type=lambda v: v.split(','), default=None, help="run cases whose name contains one of these")
+    parser.add_argument('--max-size', type=int, default=5 * MB, help="skip inputs larger than this many bytes")
+    parser.add_argument('--repeat', type=int, default=3, help="calls per input, at least")
+    parser.add_argument('--min-time', type=float, default=0.2, help="keep calling fast functions for this many seconds")
+    parser.add_argument('--baseline', default=None, help="earlier result file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown or allocation growth (0.25 = 25%%)")
+    parser.add_argument('--save-baseline', default=None, help="write this run's results to a file")
+    args = parser.parse_args()
+
+    results, flagged = run(args)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+
+    problems = [f"superlinear: {message}" for message in flagged]
+    if args.baseline:
+        problems.extend(f"regression: {message}" for message in compare(results, args.baseline, args.threshold))
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+from http.cookies import SimpleCookie
+
+# Load benchmark for the Flask API.
+#
+# For every worker/thread combination the app is started with fake backends
+# (see benchmarks/server.py) and each scenario is driven by a fixed number of
+# concurrent clients for a fixed time. Results (latency percentiles,
+# requests per second, peak RSS of the server processes) are written as JSON;
+# pass an earlier result file with --compare to see the change.
+#
+#   python -m benchmarks.run --workers 1,4 --threads 1,8 --duration 20
+#   python -m benchmarks.run --compare benchmarks/results/before.json
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.corpus import write_corpus  # noqa: E402
+from benchmarks.fakes import BENCH_PASSWORD, BENCH_USERS, bench_email  # noqa: E402
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCENARIOS = ('login', 'chat', 'upload', 'quiz')
+
+QUESTIONS = [
+    "What is the main idea of this document?",
+    "Can you explain the second section in simpler terms?",
+    "How does energy move through the system?",
+    "Give me an example of the method in practice.",
+    "What are the key terms I should remember?",
+    "Summarize the evidence for the main claim."
+]
+
+try:
+    import gunicorn  # noqa: F401
+    GUNICORN_AVAILABLE = True
+except ImportError:
+    GUNICORN_AVAILABLE = False
+
+
+class Client:
+    """One user: a keep-alive connection plus the Flask session cookie"""
+
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for header in response.headers.get_all('Set-Cookie') or []:
+            cookie = SimpleCookie()
+            cookie.load(header)
+            for key, morsel in cookie.items():
+                self.cookies[key] = morsel.value
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+        return response.status, data
+
+    def json(self, method, path, payload):
+        return self.json_response(self.request(method, path, json.dumps(payload), {'Content-Type': 'application/json'}))
+
+    def login(self, number):
+        body = f"login-email={bench_email(number).replace('@', '%40')}&login-password={BENCH_PASSWORD}"
+        status, _ = self.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+        return status == 302 and 'session' in self.cookies
+
+    def upload(self, path):
+        boundary = uuid.uuid4().hex
+        with open(path, 'rb') as f:
+            content = f.read()
+        body = (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{os.path.basename(path)}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode('utf-8') + content + f"\r\n--{boundary}--\r\n".encode('utf-8')
+        return self.json_response(self.request('POST', '/api/upload', body,
+                                               {'Content-Type': f"multipart/form-data; boundary={boundary}"}))
+
+    def json_response(self, result):
+        status, data = result
+        try:
+            return status, json.loads(data)
+        except ValueError:
+            return status, None
+
+    def wait_for_upload(self, job_id, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status, job = self.json_response(self.request('GET', f"/api/upload/{job_id}"))
+            if status != 200 or job['status'] in ('ready', 'failed'):
+                return job if status == 200 else None
+            time.sleep(0.05)
+        return None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'max_ms': ms(latencies[-1]) if latencies else None
+    }
+
+
+def process_tree(pid):
+    """The pid and all its descendants (Linux /proc)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RSSSampler:
+    """Record the peak combined RSS of the server processes"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.supported = os.path.isdir('/proc')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if self.supported:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.supported:
+            self._thread.join()
+
+    def reset(self):
+        self.peak = rss_bytes(self.pid) if self.supported else 0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, threads, port, workdir, env):
+    if GUNICORN_AVAILABLE:
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                   '-b', f"127.0.0.1:{port}", '--timeout', '300', '--log-level', 'warning',
+                   '--chdir', workdir, '--pythonpath', ROOT, 'benchmarks.server:app']
+    else:
+        command = [sys.executable, '-m', 'benchmarks.server', '--port', str(port)]
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}, see {log.name}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/healthcheck')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server did not start within 120s, see {log.name}")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def prepare_clients(port, concurrency, corpus):
+    """Log every client in and give it one processed document for quizzes"""
+    clients = []
+    for number in range(concurrency):
+        client = Client(port)
+        if not client.login(number % BENCH_USERS):
+            raise RuntimeError(f"Benchmark user {number} could not log in")
+        status, result = client.upload(corpus['txt'][number % len(corpus['txt'])])
+        if status == 202:
+            result = client.wait_for_upload(result['job_id'])
+        if not result or not result.get('document_id'):
+            raise RuntimeError(f"Setup upload failed for client {number}: {result}")
+        client.document_id = result['document_id']
+        clients.append(client)
+    return clients
+
+
+def run_scenario(name, clients, duration, corpus, args):
+    latencies = []
+    ingest_latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    uploads = [path for kind in sorted(corpus) for path in corpus[kind]]
+
+    def work(number, client):
+        step = 0
+        while time.time() < deadline:
+            step += 1
+            started = time.perf_counter()
+            ingest = None
+            try:
+                if name == 'login':
+                    ok = client.login((number + step) % BENCH_USERS)
+                elif name == 'chat':
+                    payload = {'message': f"{QUESTIONS[step % len(QUESTIONS)]} ({number}-{step})", 'cache': args.cache}
+                    if args.stream:
+                        payload['stream'] = True
+                    status, _ = client.request('POST', '/api/chat', json.dumps(payload),
+                                               {'Content-Type': 'application/json'})
+                    ok = status == 200
+                elif name == 'upload':
+                    status, result = client.upload(uploads[(number * 7 + step) % len(uploads)])
+                    ok = status in (200, 202)
+                    if ok and status == 202 and args.wait_ingest:
+                        queued = time.perf_counter()
+                        ok = (client.wait_for_upload(result['job_id']) or {}).get('status') == 'ready'
+                        ingest = time.perf_counter() - queued
+                elif name == 'quiz':
+                    status, result = client.json('POST', '/api/generate_quiz', {
+                        'document_id': client.document_id,
+                        'question_count': 5,
+                        'cache': args.cache
+                    })
+                    ok = status == 200 and bool(result and result.get('questions'))
+            except Exception as e:
+                logger.debug(f"{name} request failed: {str(e)}")
+                ok = False
+            elapsed = time.perf_counter() - started - (ingest or 0)
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                    if ingest is not None:
+                        ingest_latencies.append(ingest)
+                else:
+                    errors[0] += 1
+
+    started = time.time()
+    threads = [threading.Thread(target=work, args=(number, client)) for number, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    result = summarize(latencies, errors[0], elapsed)
+    if ingest_latencies:
+        result['ingest'] = summarize(ingest_latencies, 0, elapsed)
+    return result
+
+
+def run_configuration(workers, threads, args, corpus):
+    workdir = tempfile.mkdtemp(prefix=f"studiq-bench-w{workers}t{threads}-")
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+        # Workers only share sessions through a disk (or mongo) store
+        'SESSION_STORE_BACKEND': env.get('SESSION_STORE_BACKEND', 'disk' if workers > 1 else 'memory'),
+        'SESSION_STORE_DIR': os.path.join(workdir, 'session_store'),
+        'BENCH_GEMINI_LATENCY': str(args.gemini_latency),
+        'BENCH_TTS_LATENCY': str(args.tts_latency)
+    })
+    logger.info(f"Starting server: {workers} workers x {threads} threads ({'gunicorn' if GUNICORN_AVAILABLE else 'werkzeug'})")
+    process = start_server(workers, threads, port, workdir, env)
+    run = {
+        'workers': workers,
+        'threads': threads,
+        'server': 'gunicorn' if GUNICORN_AVAILABLE else 'werkzeug',
+        'scenarios': {}
+    }
+    try:
+        with RSSSampler(process.pid) as sampler:
+            clients = prepare_clients(port, args.concurrency, corpus)
+            for name in args.scenarios:
+                sampler.reset()
+                result = run_scenario(name, clients, args.duration, corpus, args)
+                result['peak_rss_mb'] = round(sampler.peak / (1024 * 1024), 1) if sampler.supported else None
+                run['scenarios'][name] = result
+                logger.info(f"  {name}: {result['rps']} req/s, p50 {result['p50_ms']} ms, "
+                            f"p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, errors {result['errors']}")
+            for client in clients:
+                client.close()
+        run['peak_rss_mb'] = round(sampler.peak / (1024 * 1024), 1) if sampler.supported else None
+    finally:
+        stop_server(process)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return run
+
+
+def compare(current, baseline_path):
+    """Print the change in throughput and latency against an earlier result file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(run['workers'], run['threads']): run for run in baseline['runs']}
+    change = lambda new, old: f"{(new - old) / old * 100:+.1f}%" if new is not None and old else "n/a"
+    print(f"\nCompared with {baseline_path}:")
+    for run in current['runs']:
+        old_run = before.get((run['workers'], run['threads']))
+        if not old_run:
+            continue
+        for name, result in run['scenarios'].items():
+            old = old_run['scenarios'].get(name)
+            if not old:
+                continue
+            print(f"  w{run['workers']} t{run['threads']} {name:7} rps {change(result['rps'], old['rps']):>8}  "
+                  f"p50 {change(result['p50_ms'], old['p50_ms']):>8}  p95 {change(result['p95_ms'], old['p95_ms']):>8}  "
+                  f"p99 {change(result['p99_ms'], old['p99_ms']):>8}  rss {change(result['peak_rss_mb'], old['peak_rss_mb']):>8}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the StudiQ API with fake Gemini, MongoDB and TTS")
+    parser.add_argument('--workers', type=int_list, default=[1, 2], help="comma-separated worker process counts")
+    parser.add_argument('--threads', type=int_list, default=[1, 8], help="comma-separated threads per worker")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--duration', type=float, default=15, help="seconds per scenario")
+    parser.add_argument('--scenarios', type=lambda v: v.split(','), default=list(SCENARIOS))
+    parser.add_argument('--gemini-latency', type=float, default=0.2, help="seconds per fake Gemini call")
+    parser.add_argument('--tts-latency', type=float, default=0.05, help="seconds per fake speech chunk")
+    parser.add_argument('--corpus-variants', type=int, default=10, help="distinct documents per file type")
+    parser.add_argument('--corpus-pages', type=int, default=8)
+    parser.add_argument('--cache', action='store_true', help="let chat and quiz requests use the caches")
+    parser.add_argument('--stream', action='store_true', help="request chat answers as server-sent events")
+    parser.add_argument('--wait-ingest', action='store_true', help="time uploads until their document is ready")
+    parser.add_argument('--output', default=None, help="result file (default benchmarks/results/<time>.json)")
+    parser.add_argument('--compare', default=None, help="earlier result file to compare against")
+    parser.add_argument('--keep', action='store_true', help="keep the server working directories")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if not GUNICORN_AVAILABLE and (max(args.workers) > 1):
+        logger.warning("gunicorn is not installed; running one multithreaded Werkzeug server process instead")
+        args.workers = [1]
+        args.threads = [args.threads[0]]
+
+    corpus_dir = tempfile.mkdtemp(prefix='studiq-bench-corpus-')
+    corpus = write_corpus(corpus_dir, variants=args.corpus_variants, pages=args.corpus_pages)
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'keep')},
+        'corpus': {kind: len(paths) for kind, paths in corpus.items()},
+        'runs': []
+    }
+    try:
+        for workers in args.workers:
+            for threads in args.threads:
+                results['runs'].append(run_configuration(workers, threads, args, corpus))
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
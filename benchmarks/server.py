@@ -0,0 +1,33 @@
+import os
+import sys
+import argparse
+
+# The real app with fake Gemini, MongoDB and TTS.
+#
+#   gunicorn -w 4 --threads 8 benchmarks.server:app
+#   python -m benchmarks.server --port 8000   (single process, when gunicorn is missing)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+fakes.install()
+
+import app as app_module  # noqa: E402
+
+fakes.seed(app_module)
+app = app_module.app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the app with fake backends using the Werkzeug server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    from werkzeug.serving import run_simple
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
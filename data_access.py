@@ -0,0 +1,387 @@
+import time
+import logging
+import threading
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# MongoDB queries used by the app.
+#
+# Every hot lookup filters on an indexed field and fetches only the fields the
+# caller needs. Existence checks project nothing but the indexed field (and
+# no _id), so MongoDB answers them from the index without reading documents.
+# With diagnostics on, the first run of each query shape is explained and a
+# warning is logged if it scans the whole collection.
+
+# collection -> [(keys, options)]
+INDEXES = {
+    'users': [
+        ([('email', ASCENDING)], {'name': 'email_unique', 'unique': True}),
+        ([('role', ASCENDING), ('email', ASCENDING)], {'name': 'role_email'}),
+        ([('name_key', ASCENDING), ('email', ASCENDING)], {'name': 'name_key_email'})
+    ],
+    'quiz': [
+        ([('user_email', ASCENDING)], {'name': 'user_email'})
+    ],
+    'quizzes': [
+        ([('teacher_email', ASCENDING), ('_id', DESCENDING)], {'name': 'teacher_newest'})
+    ],
+    'quiz_submissions': [
+        ([('quiz_id', ASCENDING), ('student_email', ASCENDING)], {'name': 'quiz_student'}),
+        ([('submitted_at', ASCENDING)], {'name': 'submitted_at'})
+    ],
+    'student_quiz_summaries': [
+        ([('quiz_id', ASCENDING), ('student_email', ASCENDING)], {'name': 'quiz_student'})
+    ],
+    'syllabi': [
+        ([('teacher_email', ASCENDING)], {'name': 'teacher_email'})
+    ]
+}
+
+# Projections
+USER_PUBLIC_FIELDS = {'_id': 0, 'email': 1, 'full_name': 1, 'role': 1}
+USER_LOGIN_FIELDS = {'_id': 0, 'email': 1, 'full_name': 1, 'role': 1, 'password': 1}
+QUIZ_RESULT_FIELDS = {'_id': 0, 'user_email': 0}
+TEACHER_QUIZ_FIELDS = {'questions': 0}  # the list needs titles and ids, not the questions
+QUIZ_SUMMARY_FIELDS = {'total_percent': 0}
+STUDENT_SUMMARY_FIELDS = {'_id': 0, 'quiz_id': 0, 'total_percent': 0}
+
+# Submission summaries.
+#
+# quiz_summaries holds one document per quiz and student_quiz_summaries one
+# per quiz and student, both written by aggregation pipelines ending in
+# $merge (MongoDB 4.2+), so reports read a page of small documents instead
+# of every submission. A new submission refreshes its own quiz and student;
+# refresh_submission_summaries() catches up on anything written since its
+# last run, recomputing whole quizzes so a run can be repeated safely.
+SUMMARY_STATE_ID = 'quiz_submissions'
+SUMMARY_OVERLAP = 30  # seconds re-read on each refresh, for submissions still being written
+
+
+def name_key(full_name):
+    """The lowercased, space-normalized name stored with each user for prefix searches"""
+    return ' '.join((full_name or '').lower().split())
+
+
+def _prefix_range(prefix):
+    # Everything that starts with prefix, as an index range instead of a regex
+    return {'$gte': prefix, '$lt': prefix + '\uffff'}
+
+
+class DataAccess:
+    """Indexed, projected queries over the app's collections"""
+
+    def __init__(self, db, diagnostics=False):
+        self.db = db
+        self.users = db['users']
+        self.quiz_results = db['quiz']
+        self.quizzes = db['quizzes']
+        self.submissions = db['quiz_submissions']
+        self.quiz_summaries = db['quiz_summaries']
+        self.student_summaries = db['student_quiz_summaries']
+        self.summary_state = db['summary_state']
+        self.diagnostics = diagnostics
+        self._explained = set()
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        """Create any missing indexes; returns the number of index specs that failed"""
+        failed = 0
+        for collection_name, indexes in INDEXES.items():
+            collection = self.db[collection_name]
+            for keys, options in indexes:
+                try:
+                    collection.create_index(keys, **options)
+                except ConnectionFailure as e:
+                    logger.error(f"Could not create MongoDB indexes, server unavailable: {str(e)}")
+                    return failed + 1
+                except PyMongoError as e:
+                    # Typically duplicate emails created before the unique index existed
+                    logger.error(f"Could not create index {options['name']} on {collection_name}: {str(e)}")
+                    failed += 1
+        if not failed:
+            logger.info("MongoDB indexes are in place")
+        self.backfill_name_keys()
+        return failed
+
+    def backfill_name_keys(self, batch_size=500):
+        """Give users created before name searches their name_key; returns how many were updated"""
+        updated = 0
+        try:
+            cursor = self.users.find({'name_key': {'$exists': False}}, {'_id': 1, 'full_name': 1}).batch_size(batch_size)
+            batch = []
+            for user in cursor:
+                batch.append(UpdateOne({'_id': user['_id']}, {'$set': {'name_key': name_key(user.get('full_name'))}}))
+                if len(batch) >= batch_size:
+                    updated += self.users.bulk_write(batch, ordered=False).modified_count
+                    batch = []
+            if batch:
+                updated += self.users.bulk_write(batch, ordered=False).modified_count
+        except PyMongoError as e:
+            logger.error(f"Could not add search names to users: {str(e)}")
+        if updated:
+            logger.info(f"Added search names to {updated} users")
+        return updated
+
+    # Users
+
+    def find_user(self, email, fields=USER_PUBLIC_FIELDS):
+        return self._find_one(self.users, {'email': email}, fields)
+
+    def find_user_for_login(self, email):
+        return self._find_one(self.users, {'email': email}, USER_LOGIN_FIELDS)
+
+    def user_exists(self, email):
+        """Covered by the unique email index"""
+        return self._find_one(self.users, {'email': email}, {'_id': 0, 'email': 1}) is not None
+
+    def existing_emails(self, emails):
+        """The subset of `emails` that belong to users, covered by the unique email index"""
+        if not emails:
+            return set()
+        query = {'email': {'$in': list(emails)}}
+        return {user['email'] for user in self._find(self.users, query, {'_id': 0, 'email': 1})}
+
+    def insert_users(self, users):
+        """Insert users with one unordered write; returns {position: 'duplicate' or error message} for failures"""
+        for user in users:
+            user['name_key'] = name_key(user.get('full_name'))
+        try:
+            self.users.insert_many(users, ordered=False)
+        except BulkWriteError as e:
+            return {
+                error['index']: 'duplicate' if error.get('code') == 11000 else error.get('errmsg', 'Write failed')
+                for error in e.details.get('writeErrors', [])
+            }
+        return {}
+
+    def set_roles(self, emails, role):
+        """Change the role of every user in `emails` with one write; returns how many changed"""
+        return self.users.update_many({'email': {'$in': list(emails)}}, {'$set': {'role': role}}).modified_count
+
+    def delete_users(self, emails):
+        """Delete users and their learning style quiz results; returns how many users were deleted"""
+        emails = list(emails)
+        deleted = self.users.delete_many({'email': {'$in': emails}}).deleted_count
+        self.quiz_results.delete_many({'user_email': {'$in': emails}})
+        return deleted
+
+    def page_users(self, limit, after=None, search=None, role=None, fields=USER_PUBLIC_FIELDS):
+        """One page of users in email order and the cursor for the next page (None on the last page)
+
+        `after` is the cursor returned with the previous page: the last email it held.
+        """
+        query = self._user_filter(search, role, after)
+        self._check_plan(self.users, query, fields)
+        users = list(self.users.find(query, fields).sort('email', ASCENDING).limit(limit + 1))
+        next_cursor = users[limit - 1]['email'] if len(users) > limit else None
+        return users[:limit], next_cursor
+
+    def iter_users(self, search=None, role=None, batch_size=500, fields=USER_PUBLIC_FIELDS):
+        """Every matching user in email order, fetched from the server `batch_size` at a time"""
+        query = self._user_filter(search, role, None)
+        self._check_plan(self.users, query, fields)
+        return self.users.find(query, fields).sort('email', ASCENDING).batch_size(batch_size)
+
+    def _user_filter(self, search, role, after):
+        # A search containing '@' is an email prefix, a range on the email index
+        # (role_email with a role); anything else is a prefix of the lowercased
+        # name, a range on name_key_email whose matches are then sorted by email
+        query = {}
+        if role:
+            query['role'] = role
+        email = {'$gt': after} if after else {}
+        search = (search or '').strip()
+        if '@' in search:
+            email.update(_prefix_range(search))
+        elif search:
+            query['name_key'] = _prefix_range(name_key(search))
+        if email:
+            query['email'] = email
+        return query
+
+    # Learning style quiz results
+
+    def find_quiz_results(self, email):
+        return self._find_one(self.quiz_results, {'user_email': email}, QUIZ_RESULT_FIELDS)
+
+    def has_quiz_results(self, email):
+        """Covered by the user_email index"""
+        return self._find_one(self.quiz_results, {'user_email': email}, {'_id': 0, 'user_email': 1}) is not None
+
+    # Teacher quizzes and submissions
+
+    def find_quiz(self, quiz_id, teacher_email=None, fields=None):
+        query = {'_id': quiz_id}
+        if teacher_email is not None:
+            query['teacher_email'] = teacher_email
+        return self._find_one(self.quizzes, query, fields)
+
+    def teacher_quiz_page(self, teacher_email, limit, after=None, fields=TEACHER_QUIZ_FIELDS):
+        """One page of a teacher's quizzes, newest first, and the _id to pass as `after` for the next"""
+        query = {'teacher_email': teacher_email}
+        if after is not None:
+            query['_id'] = {'$lt': after}
+        self._check_plan(self.quizzes, query, fields)
+        quizzes = list(self.quizzes.find(query, fields).sort('_id', DESCENDING).limit(limit + 1))
+        next_cursor = quizzes[limit - 1]['_id'] if len(quizzes) > limit else None
+        return quizzes[:limit], next_cursor
+
+    # Submission summaries
+
+    def find_quiz_summaries(self, quiz_ids, fields=QUIZ_SUMMARY_FIELDS):
+        """{quiz _id: summary} for the quizzes that have submissions"""
+        if not quiz_ids:
+            return {}
+        return {summary['_id']: summary for summary in self._find(self.quiz_summaries, {'_id': {'$in': quiz_ids}}, fields)}
+
+    def student_summary_page(self, quiz_id, limit, after=None, fields=STUDENT_SUMMARY_FIELDS):
+        """One page of per-student results for a quiz in email order, and the cursor for the next"""
+        query = {'quiz_id': quiz_id}
+        if after:
+            query['student_email'] = {'$gt': after}
+        self._check_plan(self.student_summaries, query, fields)
+        students = list(self.student_summaries.find(query, fields).sort('student_email', ASCENDING).limit(limit + 1))
+        next_cursor = students[limit - 1]['student_email'] if len(students) > limit else None
+        return students[:limit], next_cursor
+
+    def add_submission(self, submission):
+        """Store a graded submission and bring its summaries up to date"""
+        submission.setdefault('submitted_at', time.time())
+        result = self.submissions.insert_one(submission)
+        try:
+            self.refresh_summaries({'quiz_id': submission['quiz_id'], 'student_email': submission['student_email']},
+                                   [submission['quiz_id']])
+        except PyMongoError as e:
+            # The periodic refresh picks it up
+            logger.error(f"Could not update submission summaries: {str(e)}")
+        return result.inserted_id
+
+    def refresh_summaries(self, match, quiz_ids):
+        """Recompute the student summaries for submissions matching `match`, then the quizzes' summaries"""
+        now = time.time()
+        list(self.submissions.aggregate(student_summary_pipeline(match, now), allowDiskUse=True))
+        list(self.student_summaries.aggregate(quiz_summary_pipeline(quiz_ids, now), allowDiskUse=True))
+
+    def refresh_submission_summaries(self, every=60):
+        """Recompute the summaries of every quiz submitted to since the last run; returns the number of quizzes
+
+        Every worker calls this, but only the one that takes the lease in
+        summary_state runs it, at most once per `every` seconds. A run that
+        outlasts its lease may overlap the next one, which is harmless since
+        $merge just writes the same summaries again.
+        """
+        started = time.time()
+        try:
+            state = self.summary_state.find_one_and_update(
+                {'_id': SUMMARY_STATE_ID, '$or': [{'lease_until': None}, {'lease_until': {'$lte': started}}]},
+                {'$set': {'lease_until': started + every}},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            ) or {}
+        except DuplicateKeyError:
+            # The state exists and another worker holds the lease
+            return 0
+        query = {}
+        if state.get('submitted_since') is not None:
+            query['submitted_at'] = {'$gte': state['submitted_since']}
+        quiz_ids = self.submissions.distinct('quiz_id', query)
+        for start in range(0, len(quiz_ids), 100):
+            batch = quiz_ids[start:start + 100]
+            self.refresh_summaries({'quiz_id': {'$in': batch}}, batch)
+        self.summary_state.update_one(
+            {'_id': SUMMARY_STATE_ID},
+            {'$set': {'submitted_since': started - SUMMARY_OVERLAP, 'refreshed_at': started}},
+            upsert=True
+        )
+        return len(quiz_ids)
+
+    # Query helpers
+
+    def _find_one(self, collection, query, projection):
+        self._check_plan(collection, query, projection)
+        return collection.find_one(query, projection)
+
+    def _find(self, collection, query, projection):
+        self._check_plan(collection, query, projection)
+        return list(collection.find(query, projection))
+
+    def _check_plan(self, collection, query, projection):
+        """Explain each query shape once and warn about collection scans"""
+        if not self.diagnostics:
+            return
+        shape = (collection.name, tuple(sorted(query)), tuple(sorted(projection or {})))
+        with self._lock:
+            if shape in self._explained:
+                return
+            self._explained.add(shape)
+        try:
+            plan = collection.find(query, projection).explain()
+        except Exception as e:
+            logger.warning(f"Could not explain query on {collection.name}: {str(e)}")
+            return
+        stages = set(_plan_stages(plan.get('queryPlanner', {}).get('winningPlan', {})))
+        if 'COLLSCAN' in stages and query:
+            logger.warning(f"Query on {collection.name} filtering on {', '.join(sorted(query))} scans the whole "
+                           f"collection; check the indexes in data_access.INDEXES")
+        elif 'FETCH' not in stages and 'PROJECTION_COVERED' in stages:
+            logger.info(f"Query on {collection.name} filtering on {', '.join(sorted(query))} is covered by an index")
+
+
+def student_summary_pipeline(match, now):
+    """Per quiz and student: attempts, best, last and average score, merged into student_quiz_summaries"""
+    percent = {'$cond': [
+        {'$gt': [{'$ifNull': ['$total', 0]}, 0]},
+        {'$multiply': [{'$divide': [{'$ifNull': ['$score', 0]}, '$total']}, 100]},
+        0
+    ]}
+    return [
+        {'$match': match},
+        {'$sort': {'submitted_at': ASCENDING}},
+        {'$group': {
+            '_id': {'quiz_id': '$quiz_id', 'student_email': '$student_email'},
+            'quiz_id': {'$first': '$quiz_id'},
+            'student_email': {'$first': '$student_email'},
+            'student_name': {'$last': '$student_name'},
+            'attempts': {'$sum': 1},
+            'total_percent': {'$sum': percent},
+            'best_percent': {'$max': percent},
+            'last_percent': {'$last': percent},
+            'first_submitted_at': {'$first': '$submitted_at'},
+            'last_submitted_at': {'$last': '$submitted_at'}
+        }},
+        {'$set': {'average_percent': {'$divide': ['$total_percent', '$attempts']}, 'updated_at': now}},
+        {'$merge': {'into': 'student_quiz_summaries', 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ]
+
+
+def quiz_summary_pipeline(quiz_ids, now):
+    """Per quiz: submissions, students who completed it and score averages, merged into quiz_summaries"""
+    return [
+        {'$match': {'quiz_id': {'$in': list(quiz_ids)}}},
+        {'$group': {
+            '_id': '$quiz_id',
+            'students': {'$sum': 1},
+            'submissions': {'$sum': '$attempts'},
+            'total_percent': {'$sum': '$total_percent'},
+            'average_best_percent': {'$avg': '$best_percent'},
+            'best_percent': {'$max': '$best_percent'},
+            'last_submitted_at': {'$max': '$last_submitted_at'}
+        }},
+        {'$set': {'average_percent': {'$divide': ['$total_percent', '$submissions']}, 'updated_at': now}},
+        {'$merge': {'into': 'quiz_summaries', 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ]
+
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree"""
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _plan_stages(child)
@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Try to import fcntl so only one worker process deletes files
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Disk lifecycle for generated and uploaded files.
+#
+# Every worker records the files it writes or reuses by appending a line to
+# the directory's journal (.index). The janitor thread of one worker per
+# machine replays the journal into an LRU index and deletes files that are
+# too old or that push the directory over its size budget. The directory
+# itself is only listed once, when a worker takes over the janitor role, to
+# pick up files the journal doesn't know about.
+
+JOURNAL_NAME = '.index'
+LOCK_NAME = '.janitor.lock'
+
+
+class FileIndex:
+    """Size budget and maximum age for the files of one directory"""
+
+    def __init__(self, directory, max_bytes=None, max_age=None, name=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.name = name or os.path.basename(os.path.normpath(directory))
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        self._entries = OrderedDict()  # file name -> [size, last used], least recently used first
+        self._bytes = 0
+        self._offset = 0  # how far the journal has been replayed
+        self._lines = 0
+        self.stats_counters = {'evicted': 0, 'evicted_bytes': 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, path):
+        """Note that a file was written or used; cheap enough to call on the request path"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        line = f"{os.path.basename(path)}\t{size}\t{time.time():.3f}\n"
+        try:
+            # Appends this short are atomic, so workers can share the journal
+            with open(self.journal_path, 'a', encoding='utf-8') as journal:
+                journal.write(line)
+        except OSError as e:
+            logger.error(f"Error recording {path} in the {self.name} index: {str(e)}")
+
+    def scan(self):
+        """Reconcile the index with the directory listing (done once per janitor)"""
+        self.refresh()
+        present = set()
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith((JOURNAL_NAME, LOCK_NAME)) or not entry.is_file():
+                continue
+            present.add(entry.name)
+            if entry.name not in self._entries:
+                stat = entry.stat()
+                self._set(entry.name, stat.st_size, stat.st_mtime)
+        for name in [name for name in self._entries if name not in present]:
+            self._discard(name)
+        # Oldest first, as the replay would have left them
+        self._entries = OrderedDict(sorted(self._entries.items(), key=lambda item: item[1][1]))
+        self.compact()
+
+    def refresh(self):
+        """Replay journal lines written since the last refresh"""
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                journal.seek(0, os.SEEK_END)
+                if journal.tell() < self._offset:
+                    # Compacted by another janitor
+                    self._offset = 0
+                journal.seek(self._offset)
+                for line in journal:
+                    if not line.endswith('\n'):
+                        break  # still being written
+                    self._offset += len(line.encode('utf-8'))
+                    self._lines += 1
+                    try:
+                        name, size, used = line.rstrip('\n').split('\t')
+                        self._set(name, int(size), float(used))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, now=None):
+        """Delete expired files, then least recently used ones until the directory fits its budget"""
+        now = now or time.time()
+        evicted = 0
+        while self._entries:
+            name, (size, used) = next(iter(self._entries.items()))
+            expired = self.max_age is not None and used < now - self.max_age
+            if not expired and (self.max_bytes is None or self._bytes <= self.max_bytes):
+                break
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                self._discard(name)
+                continue
+            if mtime > used:
+                # Used since it was recorded (e.g. by a worker that only touched it)
+                self._set(name, size, mtime)
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error removing {path}: {str(e)}")
+                self._set(name, size, now)  # try again once it ages out again
+                continue
+            self._discard(name)
+            evicted += 1
+            self.stats_counters['evicted'] += 1
+            self.stats_counters['evicted_bytes'] += size
+        if evicted:
+            logger.info(f"Removed {evicted} files from {self.name}, {len(self._entries)} files ({self._bytes} bytes) left")
+        if self._lines > 4 * len(self._entries) + 1000:
+            self.compact()
+        return evicted
+
+    def compact(self):
+        """Rewrite the journal with one line per indexed file"""
+        tmp_path = f"{self.journal_path}.{os.getpid()}.tmp"
+        try:
+            self.refresh()
+            with open(tmp_path, 'w', encoding='utf-8') as journal:
+                for name, (size, used) in self._entries.items():
+                    journal.write(f"{name}\t{size}\t{used:.3f}\n")
+                self._offset = journal.tell()
+            os.replace(tmp_path, self.journal_path)
+            self._lines = len(self._entries)
+        except OSError as e:
+            logger.error(f"Error compacting the {self.name} index: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _set(self, name, size, used):
+        # Re-inserting moves the file to the most recently used end
+        current = self._entries.pop(name, None)
+        if current is not None:
+            self._bytes -= current[0]
+            used = max(used, current[1])
+        self._entries[name] = [size, used]
+        self._bytes += size
+
+    def _discard(self, name):
+        current = self._entries.pop(name, None)
+        if current is not None:
+            self._bytes -= current[0]
+
+    def stats(self):
+        return dict(self.stats_counters, files=len(self._entries), bytes=self._bytes,
+                    max_bytes=self.max_bytes, max_age=self.max_age)
+
+
+class Janitor:
+    """Background thread that runs housekeeping tasks and sweeps file indexes off the request path
+
+    Tasks (such as store.evict_expired) run in every worker process, since
+    memory stores are per process. Files are swept by one worker per machine,
+    the one holding the lock file; the others take over if it exits.
+    """
+
+    def __init__(self, indexes, tasks=(), interval=60, lock_path=None):
+        self.indexes = list(indexes)
+        self.tasks = list(tasks)
+        self.interval = interval
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._scanned = False
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+
+    @property
+    def sweeping(self):
+        return self._lock_file is not None
+
+    def start(self):
+        """Start the thread in this process if it isn't running (safe to call on every request)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked worker inherits neither the thread nor the lock
+            self._pid = os.getpid()
+            self._lock_file = None
+            self._scanned = False
+            threading.Thread(target=self._run, name='janitor', daemon=True).start()
+
+    def run_once(self):
+        """Run the tasks and, if this worker holds the lock, sweep the indexes"""
+        for task in self.tasks:
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Error in janitor task {getattr(task, '__name__', task)}: {str(e)}")
+        if not self._acquire():
+            return
+        for index in self.indexes:
+            try:
+                if not self._scanned:
+                    index.scan()
+                else:
+                    index.refresh()
+                index.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping {index.name}: {str(e)}")
+        self._scanned = True
+
+    def _run(self):
+        while True:
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+        if not FCNTL_AVAILABLE or not self.lock_path:
+            self._lock_file = True
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        logger.info(f"Worker {os.getpid()} is sweeping {', '.join(index.name for index in self.indexes)}")
+        self._lock_file = lock_file
+        return True
+
+    def stats(self):
+        return {
+            'sweeping': self.sweeping,
+            'interval': self.interval,
+            'indexes': {index.name: index.stats() for index in self.indexes}
+        }
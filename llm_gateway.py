@@ -0,0 +1,357 @@
+import time
+import uuid
+import queue
+import hashlib
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Try to import the Google API error types used to spot transient failures
+try:
+    from google.api_core import exceptions as google_exceptions
+    TRANSIENT_ERRORS = (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        TimeoutError,
+        ConnectionError
+    )
+except ImportError:
+    TRANSIENT_ERRORS = (TimeoutError, ConnectionError)
+
+
+class LLMUnavailable(Exception):
+    """The model is not configured, the circuit is open, the gateway is saturated, or retries ran out"""
+
+
+class _Flight:
+    """One upstream call that concurrent identical requests wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LLMGateway:
+    """Guarded access to a generative model (anything with generate_content)
+
+    Calls run on a private thread pool so each attempt can be abandoned at its
+    deadline, and a semaphore caps how many calls are in flight upstream - a
+    timed-out call keeps its slot until the model actually returns. Transient
+    errors are retried with jittered exponential backoff. After
+    `breaker_threshold` consecutive failed calls the circuit opens for
+    `breaker_reset` seconds, then a single trial call decides whether to close it.
+
+    generate() also coalesces identical prompts: concurrent callers in this
+    process share one upstream call. With a `shared_store` (a session_store
+    store visible to every worker) callers in other workers wait for the
+    worker that holds the prompt's lease and read its result from the store.
+
+    `on_call(kind, seconds, prompt_chars, response_chars, error)` is called
+    after every upstream attempt ('generate' or 'stream'), e.g. for metrics.
+    """
+
+    def __init__(self, model, max_concurrent=8, timeout=30, retries=2, backoff=0.5, max_backoff=8,
+                 breaker_threshold=5, breaker_reset=30, queue_timeout=5, transient_errors=TRANSIENT_ERRORS,
+                 shared_store=None, shared_wait=None, poll_interval=0.2, on_call=None):
+        self.model = model
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.queue_timeout = queue_timeout
+        self.transient_errors = transient_errors
+        self.shared_store = shared_store
+        # A lease outlives the longest call it covers (every attempt plus backoff)
+        self.shared_wait = shared_wait or queue_timeout + (retries + 1) * (timeout + max_backoff)
+        self.poll_interval = poll_interval
+        self.on_call = on_call
+        self._flights = {}  # prompt key -> _Flight
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='llm')
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self.stats_counters = {
+            'calls': 0, 'failures': 0, 'retries': 0, 'timeouts': 0, 'rejected': 0,
+            'duplicates': 0, 'coalesced': 0, 'coalesced_remote': 0
+        }
+
+    @property
+    def available(self):
+        """True unless the model is missing or the circuit is open"""
+        if self.model is None:
+            return False
+        with self._lock:
+            return self._opened_at is None or time.time() - self._opened_at >= self.breaker_reset
+
+    def generate(self, prompt, **kwargs):
+        """Return the text of a complete response, sharing it with identical concurrent calls"""
+        key = hashlib.sha256(repr((prompt, sorted(kwargs.items()))).encode('utf-8')).hexdigest()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.stats_counters['duplicates'] += 1
+
+        if not leader:
+            # The leader's call is bounded by its own deadlines and retries
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            self._count('coalesced')
+            return flight.result
+
+        try:
+            flight.result = self._generate_shared(key, prompt, kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+
+    def _generate_shared(self, key, prompt, kwargs):
+        """Make the call, or wait for another worker already making it"""
+        call = lambda: self._generate_once(prompt, kwargs)
+        if self.shared_store is None:
+            return self._call(call)
+
+        # Each lease has its own token and its result is stored under it, so a
+        # waiter never picks up the result of an earlier call for the same prompt
+        lease_key = f"lease:{key}"
+        lease, seen = self._take_lease(lease_key)
+        if lease is None:
+            self._count('duplicates')
+            deadline = time.time() + self.shared_wait
+            while time.time() < deadline:
+                time.sleep(self.poll_interval)
+                current = self.shared_store.get(lease_key)
+                # After a release the result (written before it) is read under the last token seen
+                seen = current or seen
+                result = self.shared_store.get(f"result:{key}:{seen[0]}") if seen else None
+                if result is not None:
+                    self._count('coalesced_remote')
+                    return result
+                if current is None or current[1] < time.time():
+                    break
+            # The other worker failed or is taking too long; make the call here
+            return self._call(call)
+
+        try:
+            result = self._call(call)
+            self.shared_store[f"result:{key}:{lease[0]}"] = result
+            return result
+        finally:
+            # Only release our own lease, not one taken over after ours expired
+            self.shared_store.compare_and_set(lease_key, lease, None)
+
+    def _generate_once(self, prompt, kwargs):
+        started = time.perf_counter()
+        text = None
+        error = None
+        try:
+            text = self.model.generate_content(prompt, **kwargs).text
+            return text
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._observe('generate', started, prompt, len(text) if text else 0, error)
+
+    def _observe(self, kind, started, prompt, response_chars, error):
+        if self.on_call is None:
+            return
+        try:
+            prompt_chars = len(prompt) if isinstance(prompt, str) else 0
+            self.on_call(kind, time.perf_counter() - started, prompt_chars, response_chars, error)
+        except Exception as e:
+            logger.error(f"Error in model call observer: {str(e)}")
+
+    def _take_lease(self, lease_key):
+        """Claim a prompt for this worker, returning (our lease, None) or (None, the other worker's lease)
+
+        Leases are (token, until) pairs. A lease left behind by a dead worker is
+        taken over with a compare-and-set, so only one of several workers
+        finding it expired gets it. The lease seen is returned so a waiter can
+        read the result even if the other call finishes before its first poll.
+        """
+        lease = (uuid.uuid4().hex, time.time() + self.shared_wait)
+        current = None
+        # A lease released between add() and get() leaves nothing to wait on, so try again
+        for _ in range(3):
+            if self.shared_store.add(lease_key, lease):
+                return lease, None
+            current = self.shared_store.get(lease_key)
+            if current is None:
+                continue
+            if current[1] < time.time() and self.shared_store.compare_and_set(lease_key, current, lease):
+                return lease, None
+            break
+        return None, current
+
+    def stream(self, prompt, **kwargs):
+        """Yield response text as it arrives
+
+        Failures before the first chunk are retried; after that they are raised
+        to the caller, since the text already sent can't be taken back. Streams
+        are not coalesced.
+        """
+        trial = self._admit()
+        attempt = 0
+        started = False
+        try:
+            while True:
+                chunks = queue.Queue()
+                if not self._slots.acquire(timeout=self.queue_timeout):
+                    raise self._rejected("too many concurrent model calls")
+                self._executor.submit(self._produce, prompt, kwargs, chunks)
+                error = None
+                while True:
+                    try:
+                        kind, value = chunks.get(timeout=self.timeout)
+                    except queue.Empty:
+                        self._count('timeouts')
+                        kind, value = 'error', TimeoutError(f"No response from model within {self.timeout}s")
+                    if kind == 'chunk':
+                        started = True
+                        yield value
+                    elif kind == 'done':
+                        self._succeeded()
+                        return
+                    else:
+                        error = value
+                        break
+                if started or not self._should_retry(error, attempt):
+                    raise self._failed(error, trial)
+                attempt += 1
+        finally:
+            if trial:
+                self._release_trial()
+
+    def _produce(self, prompt, kwargs, chunks):
+        started = time.perf_counter()
+        response_chars = 0
+        error = None
+        try:
+            self._count('calls')
+            for chunk in self.model.generate_content(prompt, stream=True, **kwargs):
+                if chunk.text:
+                    response_chars += len(chunk.text)
+                    chunks.put(('chunk', chunk.text))
+            chunks.put(('done', None))
+        except Exception as e:
+            error = e
+            chunks.put(('error', e))
+        finally:
+            self._slots.release()
+            self._observe('stream', started, prompt, response_chars, error)
+
+    def _call(self, fn):
+        trial = self._admit()
+        attempt = 0
+        try:
+            while True:
+                if not self._slots.acquire(timeout=self.queue_timeout):
+                    raise self._rejected("too many concurrent model calls")
+                future = self._executor.submit(self._run_in_slot, fn)
+                try:
+                    result = future.result(timeout=self.timeout)
+                    self._succeeded()
+                    return result
+                except FutureTimeoutError:
+                    self._count('timeouts')
+                    error = TimeoutError(f"No response from model within {self.timeout}s")
+                except Exception as e:
+                    error = e
+                if not self._should_retry(error, attempt):
+                    raise self._failed(error, trial)
+                attempt += 1
+        finally:
+            if trial:
+                self._release_trial()
+
+    def _run_in_slot(self, fn):
+        try:
+            self._count('calls')
+            return fn()
+        finally:
+            self._slots.release()
+
+    def _should_retry(self, error, attempt):
+        if attempt >= self.retries or not isinstance(error, self.transient_errors):
+            return False
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        logger.warning(f"Model call failed ({type(error).__name__}: {str(error)}), retrying in {delay:.2f}s")
+        self._count('retries')
+        time.sleep(delay)
+        return True
+
+    def _admit(self):
+        """Check the circuit before a call, returning True if the call is a half-open trial"""
+        if self.model is None:
+            raise self._rejected("model is not configured")
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.time() - self._opened_at < self.breaker_reset or self._trial_running:
+                self.stats_counters['rejected'] += 1
+                raise LLMUnavailable("circuit open")
+            # Half-open: let this call through as a trial
+            self._trial_running = True
+            return True
+
+    def _release_trial(self):
+        with self._lock:
+            self._trial_running = False
+
+    def _succeeded(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Model calls are succeeding again, closing circuit")
+            self._failures = 0
+            self._opened_at = None
+
+    def _failed(self, error, trial=False):
+        """Record a call that failed for good and return the exception to raise
+
+        Only transient errors count towards opening the circuit; errors such as
+        a blocked prompt say nothing about the health of the upstream service.
+        """
+        transient = isinstance(error, self.transient_errors)
+        with self._lock:
+            self.stats_counters['failures'] += 1
+            if transient:
+                self._failures += 1
+                if trial or (self._opened_at is None and self._failures >= self.breaker_threshold):
+                    logger.error(f"{self._failures} consecutive model failures, opening circuit for {self.breaker_reset}s")
+                    self._opened_at = time.time()
+        if transient:
+            return LLMUnavailable(f"{type(error).__name__}: {str(error)}")
+        return error
+
+    def _rejected(self, reason):
+        self._count('rejected')
+        return LLMUnavailable(reason)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats_counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            state = 'closed' if self._opened_at is None else 'open'
+            return dict(self.stats_counters, circuit=state, consecutive_failures=self._failures)
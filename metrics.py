@@ -0,0 +1,227 @@
+import time
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Try to import pymongo's command monitoring
+try:
+    from pymongo import monitoring
+    MONGO_MONITORING_AVAILABLE = True
+except ImportError:
+    MONGO_MONITORING_AVAILABLE = False
+
+# In-process metrics in the Prometheus text format.
+#
+# Counters and histograms are updated on the request path, so an update is a
+# dict lookup and a few additions under a per-metric lock. Gauges can be
+# given a function instead, which is only called when /metrics is scraped.
+# Each worker process keeps its own values; scrape every worker (or run one)
+# for complete numbers.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+TOKEN_BUCKETS = (10, 50, 100, 250, 500, 1000, 2000, 4000, 8000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Value(Metric):
+    """A counter or gauge: updated by the app, or read from `function` at scrape time
+
+    `function` returns a number, or a dict of {label value (or tuple of them): number}.
+    """
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def _samples(self):
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as e:
+                logger.error(f"Error reading metric {self.name}: {str(e)}")
+                return []
+            values = result.items() if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        samples = []
+        for key, value in values:
+            key = key if isinstance(key, tuple) else (key,)
+            samples.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return samples
+
+
+class Counter(Value):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Value):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), then sum and count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = [(key, (list(series[0]), series[1], series[2])) for key, series in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {count}")
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    """A set of metrics rendered together"""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self._add(Counter(self.prefix + name, help, labels, function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self._add(Gauge(self.prefix + name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class RequestStats(threading.local):
+    """Per-thread counters for the request being handled"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+
+
+if MONGO_MONITORING_AVAILABLE:
+    class MongoCommandMetrics(monitoring.CommandListener):
+        """Time every MongoDB command; pass to MongoClient(event_listeners=[...])
+
+        pymongo calls the listener on the thread that runs the command, so the
+        per-request totals in `request_stats` belong to the current request.
+        """
+
+        def __init__(self, registry, request_stats):
+            self.request_stats = request_stats
+            self.commands = registry.histogram(
+                'mongo_command_seconds', "MongoDB command latency", ('command', 'outcome'))
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            self._record(event, 'ok')
+
+        def failed(self, event):
+            self._record(event, 'error')
+
+        def _record(self, event, outcome):
+            seconds = event.duration_micros / 1e6
+            self.commands.observe(seconds, command=event.command_name, outcome=outcome)
+            self.request_stats.mongo_commands += 1
+            self.request_stats.mongo_seconds += seconds
@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import threading
+import pymongo
+from pymongo import monitoring
+from pymongo.database import Database
+
+logger = logging.getLogger(__name__)
+
+# One MongoClient per process, created on first use.
+#
+# A MongoClient opened before gunicorn forks shares its sockets and monitor
+# threads with every worker, which pymongo does not support. The app holds a
+# LazyDatabase instead: each worker builds its own client (with its own
+# connection pool) the first time it runs a query, and a process that finds a
+# client inherited from its parent drops it and builds a new one. Pool events
+# are counted per process and reported by stats().
+
+READ_PREFERENCES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Count connection pool events for one client"""
+
+    def __init__(self, on_checkout=None):
+        self.on_checkout = on_checkout
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.failures = {}
+        self.pool_clears = 0
+        self._started = threading.local()
+        self._lock = threading.Lock()
+
+    # A checkout is started and finished on the thread that runs the command
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            # Nothing idle in the pool: this checkout opens a connection or queues for one
+            waiting = self.in_use >= self.connections_created - self.connections_closed
+        self._started.value = (time.perf_counter(), waiting)
+
+    def connection_checked_out(self, event):
+        seconds, waiting = self._finish_checkout()
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            if waiting:
+                self.waits += 1
+                self.wait_seconds += seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+        if self.on_checkout is not None:
+            try:
+                self.on_checkout(seconds, waiting)
+            except Exception as e:
+                logger.error(f"Error in MongoDB checkout callback: {str(e)}")
+
+    def connection_check_out_failed(self, event):
+        self._finish_checkout()
+        with self._lock:
+            self.failures[event.reason] = self.failures.get(event.reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def _finish_checkout(self):
+        started = getattr(self._started, 'value', None)
+        self._started.value = None
+        if started is None:
+            return 0.0, False
+        return time.perf_counter() - started[0], started[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections_open": self.connections_created - self.connections_closed,
+                "connections_in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "connections_created": self.connections_created,
+                "connections_closed": self.connections_closed,
+                "checkouts": self.checkouts,
+                "checkout_waits": self.waits,
+                "checkout_wait_seconds": round(self.wait_seconds, 6),
+                "max_checkout_wait_seconds": round(self.max_wait_seconds, 6),
+                "checkout_failures": dict(self.failures),
+                "pool_clears": self.pool_clears
+            }
+
+
+class MongoConnection:
+    """A MongoClient per process, built lazily with the given pool options
+
+    `options` are passed to MongoClient (maxPoolSize, waitQueueTimeoutMS,
+    readPreference, ...); None values are left to the URI and pymongo's
+    defaults. `on_checkout(seconds, waited)` is called after each pool checkout.
+    """
+
+    def __init__(self, uri, database_name, event_listeners=(), on_checkout=None, **options):
+        self.uri = uri
+        self.database_name = database_name
+        self.event_listeners = list(event_listeners)
+        self.on_checkout = on_checkout
+        self.options = {name: value for name, value in options.items() if value is not None}
+        read_preference = self.options.get('readPreference')
+        if read_preference is not None and read_preference not in READ_PREFERENCES:
+            raise ValueError(f"Unknown MongoDB read preference: {read_preference}")
+        self.clients_created = 0
+        self._client = None
+        self._database = None
+        self._pool = None
+        self._pid = None
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            self._connect()
+        return self._client
+
+    @property
+    def database(self):
+        if self._client is None or self._pid != os.getpid():
+            self._connect()
+        return self._database
+
+    def collection(self, name):
+        """The collection `name` on this process's client"""
+        database = self.database
+        collection = self._collections.get(name)
+        if collection is None or collection.database is not database:
+            collection = self._collections[name] = database[name]
+        return collection
+
+    def _connect(self):
+        with self._lock:
+            pid = os.getpid()
+            if self._client is not None and self._pid == pid:
+                return
+            if self._client is not None:
+                # Inherited from the parent process: its sockets belong to the
+                # parent, so don't close it here, just stop using it
+                logger.info(f"Replacing the MongoDB client inherited from process {self._pid}")
+            pool = PoolStats(self.on_checkout)
+            # Looked up on the module so tests and benchmarks can swap the client class
+            client = pymongo.MongoClient(self.uri, event_listeners=self.event_listeners + [pool], **self.options)
+            self._pool = pool
+            self._client = client
+            self._database = client[self.database_name]
+            self._collections = {}
+            self._pid = pid
+            self.clients_created += 1
+
+    def close(self):
+        """Close this process's client, if it has one"""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._database = None
+            self._pool = None
+            self._collections = {}
+
+    def stats(self):
+        pool = self._pool if self._pid == os.getpid() else None
+        stats = {
+            "client_created": pool is not None,
+            "pid": os.getpid(),
+            "options": dict(self.options)
+        }
+        if pool is not None:
+            stats.update(pool.stats())
+        return stats
+
+
+class LazyDatabase:
+    """Stands in for a pymongo Database; resolves the current process's client on use"""
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.name = connection.database_name
+
+    def __getitem__(self, name):
+        return LazyCollection(self._connection, name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if hasattr(Database, name):
+            # A Database method (command, list_collection_names, ...), not a collection
+            return getattr(self._connection.database, name)
+        return LazyCollection(self._connection, name)
+
+
+class LazyCollection:
+    """Stands in for a pymongo Collection; every call goes to the current process's client"""
+
+    def __init__(self, connection, name):
+        self._connection = connection
+        self.name = name
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        return getattr(self._connection.collection(self.name), attribute)
+
+    def __repr__(self):
+        return f"LazyCollection({self._connection.database_name}.{self.name})"
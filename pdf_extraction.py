@@ -0,0 +1,157 @@
+import os
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Try to import PDF reader
+try:
+    from PyPDF2 import PdfReader
+    PDF_AVAILABLE = True
+except ImportError:
+    PDF_AVAILABLE = False
+    logging.warning("PyPDF2 not available. PDF processing will be disabled.")
+
+# Extraction settings
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 500))
+PDF_PAGE_TIMEOUT = float(os.getenv('PDF_PAGE_TIMEOUT', 10))  # seconds per page
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 8))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 16))  # smaller files are read by one pool task
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class PageTimeout(Exception):
+    pass
+
+
+def _raise_page_timeout(signum, frame):
+    raise PageTimeout()
+
+
+@contextmanager
+def _page_deadline(seconds):
+    """Interrupt a page that takes longer than `seconds` (only possible on a main thread with SIGALRM)"""
+    if (not seconds or not hasattr(signal, 'setitimer')
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _extract_page(page, number, page_timeout):
+    """Return (text, seconds spent) for one page"""
+    started = time.perf_counter()
+    text = ""
+    try:
+        with _page_deadline(page_timeout):
+            text = page.extract_text() or ""
+    except PageTimeout:
+        logger.warning(f"Timed out extracting PDF page {number + 1}")
+    except Exception as e:
+        logger.warning(f"Error extracting PDF page {number + 1}: {str(e)}")
+    return text, time.perf_counter() - started
+
+
+def _extract_range(pdf_path, start, stop, page_timeout):
+    """Pool task: extract pages [start, stop) of a PDF as (text, seconds) pairs"""
+    reader = PdfReader(pdf_path)
+    return [_extract_page(reader.pages[i], i, page_timeout) for i in range(start, stop)]
+
+
+def _pool_context():
+    """Start workers from a clean fork server so they never inherit app threads, sockets or __main__"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _get_pool():
+    """Create the process pool lazily, once per (possibly forked) worker process"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=max(1, PDF_WORKERS), mp_context=_pool_context())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+def iter_pdf_pages(pdf_path, max_pages=None, page_timeout=None, progress=None, on_page=None):
+    """Yield the text of each page of a PDF, in order
+
+    Pages are extracted by a process pool, whose workers run tasks on their
+    main thread so the per-page timeout (SIGALRM) always applies. Large
+    documents are split into page ranges that are extracted in parallel; pages
+    come back in order as their range completes.
+    Pages beyond max_pages are skipped, and a page that fails or runs past
+    page_timeout yields an empty string instead of stalling the document.
+    progress, if given, is called as progress(done, total) after each page,
+    and on_page(seconds) with the time a worker spent extracting it (pages that
+    never came back from the pool are not reported).
+    """
+    max_pages = PDF_MAX_PAGES if max_pages is None else max_pages
+    page_timeout = PDF_PAGE_TIMEOUT if page_timeout is None else page_timeout
+
+    reader = PdfReader(pdf_path)
+    total = len(reader.pages)
+    if max_pages and total > max_pages:
+        logger.warning(f"{pdf_path} has {total} pages, only extracting the first {max_pages}")
+        total = max_pages
+
+    if not total:
+        return
+
+    pool = _get_pool()
+    # Small files go to the pool as a single task, to keep the timeout without the overhead of splitting
+    pages_per_task = PDF_PAGES_PER_TASK if total >= PDF_PARALLEL_MIN_PAGES else total
+    ranges = [(start, min(start + pages_per_task, total))
+              for start in range(0, total, pages_per_task)]
+    futures = [pool.submit(_extract_range, pdf_path, start, stop, page_timeout)
+               for start, stop in ranges]
+
+    for (start, stop), future in zip(ranges, futures):
+        # Pages time out on their own inside the workers; this only guards against a hung worker
+        range_timeout = page_timeout * (stop - start) + 30 if page_timeout else None
+        try:
+            pages = future.result(timeout=range_timeout)
+        except FutureTimeoutError:
+            logger.warning(f"Timed out extracting pages {start + 1}-{stop} of {pdf_path}")
+            pages = [("", None)] * (stop - start)
+        except BrokenProcessPool as e:
+            logger.error(f"PDF extraction pool failed on pages {start + 1}-{stop} of {pdf_path}: {str(e)}")
+            _reset_pool()
+            pages = [("", None)] * (stop - start)
+        except Exception as e:
+            logger.error(f"Error extracting pages {start + 1}-{stop} of {pdf_path}: {str(e)}")
+            pages = [("", None)] * (stop - start)
+        for i, (page_text, seconds) in enumerate(pages):
+            if on_page and seconds is not None:
+                on_page(seconds)
+            yield page_text
+            if progress:
+                progress(start + i + 1, total)
@@ -0,0 +1,116 @@
+import logging
+from retrieval import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Prompt assembly.
+#
+# A prompt is a list of named sections rendered in order. Fixed sections
+# (instructions, the question) are always kept. Optional sections are made of
+# parts, such as passages or chat messages, and carry a priority. When the
+# prompt is over its token budget, parts are dropped from the lowest priority
+# sections first. Every build reports the size of each section so callers can
+# see where prompt tokens go.
+
+
+class PromptSection:
+    """A named block of prompt text; priority None means the section is never trimmed"""
+
+    def __init__(self, name, parts, priority=None, header='', footer='', separator='\n', drop_from='end'):
+        self.name = name
+        self.parts = list(parts)
+        self.priority = priority
+        self.header = header
+        self.footer = footer
+        self.separator = separator
+        self.drop_from = drop_from
+        self.dropped = 0
+
+    def render(self):
+        if not self.parts:
+            return ''
+        return self.header + self.separator.join(self.parts) + self.footer
+
+    def drop_part(self):
+        if self.drop_from == 'start':
+            self.parts.pop(0)
+        else:
+            self.parts.pop()
+        self.dropped += 1
+
+
+class BuiltPrompt:
+    """The assembled prompt text with per-section size information"""
+
+    def __init__(self, text, sections, token_budget=None):
+        self.text = text
+        self.sections = sections
+        self.tokens = sum(section['tokens'] for section in sections)
+        self.token_budget = token_budget
+        self.truncated = any(section['dropped'] for section in sections)
+
+    def section(self, name):
+        """Size information for one section, or None if it was left out"""
+        for section in self.sections:
+            if section['name'] == name:
+                return section
+        return None
+
+    def describe(self):
+        return ", ".join(f"{section['name']}={section['tokens']}t" for section in self.sections)
+
+
+class PromptBuilder:
+    """Collect prompt sections and render them within a token budget"""
+
+    def __init__(self, token_budget=None):
+        self.token_budget = token_budget
+        self._sections = []
+
+    def add(self, name, text):
+        """Add a fixed section that is always kept"""
+        if text:
+            self._sections.append(PromptSection(name, [text], separator=''))
+        return self
+
+    def add_parts(self, name, parts, priority, header='', footer='', separator='\n', drop_from='end'):
+        """Add a section whose parts may be dropped, lowest priority first, to fit the budget"""
+        if parts:
+            self._sections.append(PromptSection(name, parts, priority, header, footer, separator, drop_from))
+        return self
+
+    def build(self):
+        rendered = [section.render() for section in self._sections]
+        tokens = [estimate_tokens(text) for text in rendered]
+        total = sum(tokens)
+
+        if self.token_budget and total > self.token_budget:
+            trimmable = sorted(
+                (i for i, section in enumerate(self._sections) if section.priority is not None),
+                key=lambda i: self._sections[i].priority
+            )
+            for i in trimmable:
+                section = self._sections[i]
+                while total > self.token_budget and section.parts:
+                    section.drop_part()
+                    rendered[i] = section.render()
+                    total -= tokens[i]
+                    tokens[i] = estimate_tokens(rendered[i])
+                    total += tokens[i]
+                if total <= self.token_budget:
+                    break
+            if total > self.token_budget:
+                logger.warning(f"Prompt needs {total} tokens even after trimming (budget {self.token_budget})")
+
+        sizes = [
+            {
+                'name': section.name,
+                'chars': len(text),
+                'bytes': len(text.encode('utf-8')),
+                'tokens': token_count,
+                'parts': len(section.parts),
+                'dropped': section.dropped
+            }
+            for section, text, token_count in zip(self._sections, rendered, tokens)
+        ]
+        return BuiltPrompt("".join(rendered), sizes, self.token_budget)
@@ -0,0 +1,162 @@
+import re
+import json
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Pre-generated quiz questions.
+#
+# A bank holds questions generated for one document, learning style and set
+# of profile modifiers. Quizzes are sampled from the bank, so a class
+# requesting the same quiz at once costs at most one LLM call. Banks are
+# topped up in the background once they get small or their questions have
+# been served too many times. The served count is kept under its own key, so
+# counting a sample never writes back a bank that a refill has just replaced.
+
+
+def _valid_question(item):
+    if not isinstance(item, dict) or not isinstance(item.get('question'), str):
+        return False
+    options = item.get('options')
+    answer = item.get('correct_answer')
+    return (isinstance(options, list) and len(options) >= 2
+            and isinstance(answer, int) and not isinstance(answer, bool)
+            and 0 <= answer < len(options))
+
+
+# Where an array of objects may start
+ARRAY_START = re.compile(r'\[\s*\{')
+
+
+def parse_quiz_questions(text, max_attempts=20):
+    """Return the valid questions from the first JSON array of question objects in text
+
+    Only positions that look like the start of an array of objects are tried,
+    and at most max_attempts of them, so malformed responses (unclosed or
+    deeply nested brackets) can't make parsing quadratic.
+    """
+    decoder = json.JSONDecoder()
+    match = ARRAY_START.search(text)
+    attempts = 0
+    while match and attempts < max_attempts:
+        attempts += 1
+        try:
+            value, end = decoder.raw_decode(text, match.start())
+        except (ValueError, RecursionError):
+            match = ARRAY_START.search(text, match.start() + 1)
+            continue
+        questions = [item for item in value if _valid_question(item)]
+        if questions:
+            return questions
+        match = ARRAY_START.search(text, end)
+    return []
+
+
+class QuestionBanks:
+    """Question banks kept in a session_store store and refilled by a thread pool
+
+    `generate(params)` is called on a pool thread and must return a list of
+    questions for the bank described by params. Builds are coordinated per
+    process: concurrent requests for a bank that is being built wait for that
+    build instead of starting their own.
+    """
+
+    def __init__(self, store, generate, executor, min_size=10, max_size=40, reuse=3):
+        self.store = store
+        self.generate = generate
+        self.executor = executor
+        self.min_size = min_size
+        self.max_size = max_size
+        self.reuse = reuse
+        self._building = {}  # bank key -> threading.Event set when the build finishes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def served_key(key):
+        return f"{key}:served"
+
+    def needs_refill(self, key, bank):
+        if not bank:
+            return True
+        size = len(bank['questions'])
+        return size < self.min_size or (self.store.get(self.served_key(key)) or 0) >= size * self.reuse
+
+    def building(self, key):
+        """True while this process is building more questions for a bank"""
+        with self._lock:
+            return key in self._building
+
+    def refill(self, key, params):
+        """Start building more questions for a bank, returning an Event set when done"""
+        with self._lock:
+            event = self._building.get(key)
+            if event is not None:
+                return event
+            event = threading.Event()
+            self._building[key] = event
+        try:
+            self.executor.submit(self._build, key, params, event)
+        except Exception:
+            self._finish(key, event)
+            raise
+        return event
+
+    def ensure(self, key, params):
+        """Build a bank ahead of time unless it is already well stocked"""
+        if self.needs_refill(key, self.store.get(key)):
+            self.refill(key, params)
+
+    def sample(self, key, params, count, timeout=None):
+        """Return up to count random questions, waiting up to timeout only for an empty bank to be built
+
+        A bank with fewer than count questions serves what it has and is
+        refilled in the background. Returns None if the bank is still empty,
+        either because the build is still running (see building()) or because
+        it produced no questions.
+        """
+        bank = self.store.get(key)
+        if not bank:
+            self.refill(key, params).wait(timeout)
+            bank = self.store.get(key)
+            if not bank:
+                return None
+
+        questions = random.sample(bank['questions'], min(count, len(bank['questions'])))
+        # Concurrent samples may overwrite each other's count; it only steers refills
+        served_key = self.served_key(key)
+        self.store[served_key] = (self.store.get(served_key) or 0) + len(questions)
+        if len(questions) < count or self.needs_refill(key, bank):
+            self.refill(key, params)
+        return questions
+
+    def _build(self, key, params, event):
+        try:
+            new_questions = self.generate(params)
+            if not new_questions:
+                logger.warning(f"Question bank {key} refill produced no questions")
+                return
+            bank = self.store.get(key) or {'questions': []}
+            seen = set()
+            merged = []
+            # Prefer the newest questions and drop repeats of the same question text
+            for question in reversed(bank['questions'] + new_questions):
+                text = ' '.join(question['question'].lower().split())
+                if text not in seen:
+                    seen.add(text)
+                    merged.append(question)
+            merged = merged[:self.max_size]
+            merged.reverse()
+            self.store[key] = {'questions': merged}
+            self.store.delete(self.served_key(key))
+            logger.info(f"Question bank {key} now holds {len(merged)} questions")
+        except Exception as e:
+            logger.error(f"Error building question bank {key}: {str(e)}")
+        finally:
+            self._finish(key, event)
+
+    def _finish(self, key, event):
+        with self._lock:
+            self._building.pop(key, None)
+        event.set()
@@ -0,0 +1,213 @@
+import re
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Try to import sentence-transformers for the semantic cache
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    SEMANTIC_CACHE_AVAILABLE = True
+except ImportError:
+    SEMANTIC_CACHE_AVAILABLE = False
+    logging.warning("sentence-transformers not available. Semantic response caching will be disabled.")
+
+
+def normalize_question(text):
+    """Normalize a question so trivially different phrasings share a cache entry"""
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    return text.rstrip('?!. ')
+
+
+class ResponseCache:
+    """Cache of model responses keyed by the inputs that shaped the prompt
+
+    Entries live in a session_store store, so TTL/LRU eviction and sharing
+    between workers follow the configured backend. Hit and miss counters are
+    kept per process.
+    """
+
+    def __init__(self, store, enabled=True):
+        self.store = store
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind, *parts):
+        """Build a cache key from JSON-serializable parts"""
+        payload = json.dumps([kind, *parts], sort_keys=True, default=str)
+        return f"{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    def get(self, key):
+        value = self.peek(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Look up an entry without counting a hit or miss (e.g. for semantic cache candidates)"""
+        if not self.enabled:
+            return None
+        try:
+            return self.store.get(key)
+        except Exception as e:
+            logger.error(f"Response cache lookup failed: {str(e)}")
+            return None
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        try:
+            self.store[key] = value
+        except Exception as e:
+            logger.error(f"Response cache write failed: {str(e)}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+class SemanticCache:
+    """Nearest-neighbour index of earlier questions, grouped by scope
+
+    Each scope (the documents, learning style and profile a question was asked
+    against) keeps a matrix of normalized question embeddings, so a lookup is a
+    single matrix-vector product. The index stores whatever value the caller
+    gives it - app.py stores the exact ResponseCache key, so answers still
+    expire with that cache. Adding a value that is already indexed replaces
+    its row, and rows whose value can no longer be loaded are dropped on
+    lookup, so an expired answer never shadows a current one. The index is
+    private to each worker process.
+    """
+
+    def __init__(self, model_name='all-MiniLM-L6-v2', threshold=0.92, max_entries=500,
+                 max_scopes=1000, enabled=True, encoder=None):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.enabled = enabled and (SEMANTIC_CACHE_AVAILABLE or encoder is not None)
+        self.hits = 0
+        self.misses = 0
+        self._encoder = encoder
+        self._scopes = OrderedDict()  # scope -> (matrix, values)
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+
+    def _get_encoder(self):
+        """Load the embedding model on first use and share it between requests"""
+        if self._encoder is None:
+            with self._model_lock:
+                if self._encoder is None:
+                    logger.info(f"Loading sentence embedding model {self.model_name}")
+                    self._encoder = SentenceTransformer(self.model_name)
+        return self._encoder
+
+    def embed(self, text):
+        """Return the normalized embedding of text, or None if it can't be computed"""
+        if not self.enabled:
+            return None
+        try:
+            vector = self._get_encoder().encode([normalize_question(text)])[0]
+        except Exception as e:
+            logger.error(f"Error embedding question: {str(e)}")
+            return None
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def lookup(self, scope, vector, load=None):
+        """Return the value stored for the most similar question in scope, if it clears the threshold
+
+        If load is given, the candidates are tried best first and load(value)
+        of the first one it finds is returned instead; rows it returns None
+        for (an expired or evicted answer) are removed from the index.
+        """
+        if vector is None:
+            return None
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is not None:
+                self._scopes.move_to_end(scope)
+        result = None
+        if entry is not None:
+            matrix, values = entry
+            scores = matrix @ vector
+            for best in np.argsort(-scores):
+                if scores[best] < self.threshold:
+                    break
+                if load is None:
+                    result = values[best]
+                    break
+                result = load(values[best])
+                if result is not None:
+                    break
+                self.discard(scope, values[best])
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def add(self, scope, vector, value):
+        if vector is None:
+            return
+        with self._lock:
+            entry = self._scopes.pop(scope, None)
+            if entry is None:
+                matrix, values = vector[np.newaxis, :], [value]
+            else:
+                matrix, values = self._without(entry, value)
+                # Drop the oldest rows once the scope is full
+                keep = self.max_entries - 1
+                matrix = np.vstack([matrix[-keep:], vector]) if keep > 0 and values else vector[np.newaxis, :]
+                values = (values[-keep:] if keep > 0 else []) + [value]
+            self._scopes[scope] = (matrix, values)
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+
+    def discard(self, scope, value):
+        """Remove the row for value from a scope"""
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is None:
+                return
+            matrix, values = self._without(entry, value)
+            if values:
+                self._scopes[scope] = (matrix, values)
+            else:
+                del self._scopes[scope]
+
+    @staticmethod
+    def _without(entry, value):
+        matrix, values = entry
+        if value not in values:
+            return matrix, values
+        keep = [n for n, other in enumerate(values) if other != value]
+        return matrix[keep], [values[n] for n in keep]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "model_loaded": self._encoder is not None,
+            "scopes": len(self._scopes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,217 @@
+import re
+import math
+import random
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Try to import scikit-learn for TF-IDF scoring
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    SKLEARN_AVAILABLE = True
+except ImportError:
+    SKLEARN_AVAILABLE = False
+    logging.warning("scikit-learn not available. Falling back to BM25 document retrieval.")
+
+TOKEN_PATTERN = re.compile(r'\b\w\w+\b')
+RRF_K = 60  # reciprocal rank fusion constant: a hit ranked r in its document scores 1 / (RRF_K + r)
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting prompts (about 4 characters per token)"""
+    return (len(text) + 3) // 4
+
+
+def chunk_text(text, chunk_size=1200, overlap=200):
+    """Split text into chunks of roughly chunk_size characters on paragraph and sentence boundaries"""
+    # Break the text into pieces no longer than chunk_size, preferring natural boundaries
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= chunk_size:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[.!?])\s+', paragraph):
+            while len(sentence) > chunk_size:
+                pieces.append(sentence[:chunk_size])
+                sentence = sentence[chunk_size:]
+            if sentence:
+                pieces.append(sentence)
+
+    # Pack pieces into chunks, carrying the tail of each chunk into the next one
+    chunks = []
+    current = []
+    current_len = 0
+    for piece in pieces:
+        if current and current_len + len(piece) + 1 > chunk_size:
+            chunks.append("\n".join(current))
+            tail = chunks[-1][-overlap:] if overlap else ""
+            current = [tail] if tail else []
+            current_len = len(tail)
+        current.append(piece)
+        current_len += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class DocumentIndex:
+    """Search index over the chunks of one document"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.token_counts = [estimate_tokens(chunk) for chunk in chunks]
+        self._vectorizer = None
+        self._matrix = None
+        self._bm25 = None
+
+        if not chunks:
+            return
+        if SKLEARN_AVAILABLE:
+            try:
+                self._vectorizer = TfidfVectorizer(stop_words='english', sublinear_tf=True)
+                self._matrix = self._vectorizer.fit_transform(chunks)
+                return
+            except ValueError:
+                # Raised when every chunk only contains stop words
+                self._vectorizer = None
+        self._bm25 = _BM25(chunks)
+
+    @property
+    def cosine_scores(self):
+        """True if search() scores are TF-IDF cosines, comparable between documents"""
+        return self._vectorizer is not None
+
+    def nbytes(self):
+        """Rough memory footprint, for sizing stores of indexes (the matrix usually outweighs the text)"""
+        size = sum(len(chunk) for chunk in self.chunks)
+        if self._matrix is not None:
+            size += self._matrix.data.nbytes + self._matrix.indices.nbytes + self._matrix.indptr.nbytes
+            # Each vocabulary entry is a dict slot plus a short string
+            size += 100 * len(self._vectorizer.vocabulary_) + self._vectorizer.idf_.nbytes
+        elif self._bm25 is not None:
+            size += 100 * (sum(len(tf) for tf in self._bm25.term_freqs) + len(self._bm25.idf))
+        return size
+
+    @classmethod
+    def from_text(cls, text, chunk_size=1200, overlap=200):
+        return cls(chunk_text(text, chunk_size, overlap))
+
+    def search(self, query, top_k=5):
+        """Return (score, chunk_index) pairs for the chunks most relevant to query"""
+        if not self.chunks or not query:
+            return []
+        if self._vectorizer is not None:
+            query_vector = self._vectorizer.transform([query])
+            scores = (self._matrix @ query_vector.T).toarray().ravel().tolist()
+        elif self._bm25 is not None:
+            scores = self._bm25.scores(query)
+        else:
+            return []
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        return [(scores[i], i) for i in ranked[:top_k] if scores[i] > 0]
+
+    def select(self, query, token_budget, top_k=5):
+        """Pick the most relevant chunks that fit in token_budget, in document order"""
+        hits = self.search(query, top_k)
+        if not hits:
+            return self.overview(token_budget)
+
+        selected = []
+        used = 0
+        for _, i in hits:
+            if used + self.token_counts[i] <= token_budget:
+                selected.append(i)
+                used += self.token_counts[i]
+        return [self.chunks[i] for i in sorted(selected)]
+
+    def overview(self, token_budget):
+        """Pick chunks spread evenly across the document that fit in token_budget"""
+        if not self.chunks:
+            return []
+        average = max(1, sum(self.token_counts) // len(self.chunks))
+        count = max(1, min(len(self.chunks), token_budget // average))
+        step = len(self.chunks) / count
+
+        selected = []
+        used = 0
+        for n in range(count):
+            i = int(n * step)
+            if used + self.token_counts[i] <= token_budget:
+                selected.append(self.chunks[i])
+                used += self.token_counts[i]
+        return selected
+
+    def sample(self, token_budget):
+        """Pick random chunks that fit in token_budget, in document order"""
+        order = list(range(len(self.chunks)))
+        random.shuffle(order)
+        selected = []
+        used = 0
+        for i in order:
+            if used + self.token_counts[i] <= token_budget:
+                selected.append(i)
+                used += self.token_counts[i]
+        return [self.chunks[i] for i in sorted(selected)]
+
+
+def select_across(sources, query, token_budget, top_k=5):
+    """Pick the best chunks from several documents that fit in token_budget
+
+    `sources` is a list of (source, DocumentIndex) pairs; each document keeps its
+    own index, so adding a document never requires re-indexing the others.
+    Returns (source, chunk) pairs grouped by source in document order.
+
+    TF-IDF rows are L2-normalized, so their cosine scores are compared as
+    they are. BM25 scores depend on each document's own statistics, so if any
+    document falls back to BM25 the hits are merged by rank instead
+    (reciprocal rank fusion).
+    """
+    fuse = not all(index.cosine_scores for _, index in sources)
+    hits = []
+    for position, (source, index) in enumerate(sources):
+        for rank, (score, i) in enumerate(index.search(query, top_k)):
+            hits.append((1 / (RRF_K + rank) if fuse else score, position, i))
+    hits.sort(key=lambda hit: hit[0], reverse=True)
+
+    selected = []
+    used = 0
+    for _, position, i in hits[:top_k]:
+        tokens = sources[position][1].token_counts[i]
+        if used + tokens <= token_budget:
+            selected.append((position, i))
+            used += tokens
+    selected.sort()
+    return [(sources[position][0], sources[position][1].chunks[i]) for position, i in selected]
+
+
+class _BM25:
+    """Minimal Okapi BM25 scorer used when scikit-learn is unavailable"""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(TOKEN_PATTERN.findall(chunk.lower())) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) or 1
+        doc_freqs = Counter()
+        for tf in self.term_freqs:
+            doc_freqs.update(tf.keys())
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freqs.items()}
+
+    def scores(self, query):
+        terms = [term for term in TOKEN_PATTERN.findall(query.lower()) if term in self.idf]
+        scores = []
+        for tf, length in zip(self.term_freqs, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+            for term in terms:
+                freq = tf.get(term, 0)
+                if freq:
+                    score += self.idf[term] * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
@@ -0,0 +1,558 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Try to import fcntl so disk compare-and-set is atomic across worker processes
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# Key-value stores for per-user sessions and uploaded documents.
+#
+# All backends expose the same small dict-like API (get, [], in, del, pop, len)
+# so app.py can swap them without code changes. add() is an atomic
+# set-if-absent and compare_and_set() an atomic swap, both used to coordinate
+# work between workers; touch() counts an entry as used without loading it.
+# Values are not shared by reference outside the memory backend, so callers
+# must write a value back (store[key] = value) after mutating it.
+#
+# Entries expire after `ttl` seconds without being read or written. Stores can
+# also be bounded by entry count (`max_entries`) and total size (`max_bytes`,
+# measured with `sizeof(value)` or the pickled size), evicting the least
+# recently used entries first. The `on_evict(key, value)` callback runs for
+# every entry dropped by expiry or by the size bounds so the app can delete
+# files that belong to it.
+
+
+class SessionStore:
+    """Base class for session/document storage backends"""
+
+    def __init__(self, ttl=None, max_entries=None, on_evict=None, max_bytes=None, sizeof=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def add(self, key, value):
+        """Store value only if key is absent (or expired), returning True if it was stored"""
+        raise NotImplementedError
+
+    def compare_and_set(self, key, expected, value):
+        """Replace the entry only if it currently holds `expected` (None deletes it); True if it did"""
+        raise NotImplementedError
+
+    def touch(self, key):
+        """Count an entry as used without loading it, for expiry and LRU order; True if it exists"""
+        return self.get(key) is not None
+
+    def delete(self, key):
+        """Remove an entry, returning True if it existed"""
+        raise NotImplementedError
+
+    def evict_expired(self):
+        """Drop expired entries (and any over the size bounds), returning how many were removed"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def count(self):
+        """Number of entries, possibly as of the last eviction pass; cheap enough for metrics"""
+        return len(self)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        if value is None:
+            return default
+        self.delete(key)
+        return value
+
+    def _expires_at(self, now=None):
+        if not self.ttl:
+            return None
+        return (now or time.time()) + self.ttl
+
+    def _size(self, value):
+        if self.sizeof is not None:
+            return self.sizeof(value)
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _evicted(self, key, value):
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(key, value)
+        except Exception as e:
+            logger.error(f"Error in eviction callback for {key}: {str(e)}")
+
+
+class MemorySessionStore(SessionStore):
+    """In-process LRU store with TTL; fast, but private to one worker"""
+
+    def __init__(self, ttl=None, max_entries=None, on_evict=None, max_bytes=None, sizeof=None):
+        super().__init__(ttl, max_entries, on_evict, max_bytes, sizeof)
+        self._data = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value, size = entry
+            if expires_at is not None and expires_at < now:
+                del self._data[key]
+                self._bytes -= size
+                expired = True
+            else:
+                self._data[key] = (self._expires_at(now), value, size)
+                self._data.move_to_end(key)
+                expired = False
+        if expired:
+            self._evicted(key, value)
+            return default
+        return value
+
+    def set(self, key, value):
+        size = self._size(value) if self.max_bytes else 0
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            evicted = self._insert(key, value, size)
+        for old_key, old_value in evicted:
+            self._evicted(old_key, old_value)
+
+    def add(self, key, value):
+        size = self._size(value) if self.max_bytes else 0
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= now):
+                return False
+            if entry is not None:
+                del self._data[key]
+                self._bytes -= entry[2]
+            evicted = self._insert(key, value, size)
+        if entry is not None:
+            self._evicted(key, entry[1])
+        for old_key, old_value in evicted:
+            self._evicted(old_key, old_value)
+        return True
+
+    def touch(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < now):
+                return False
+            self._data[key] = (self._expires_at(now), entry[1], entry[2])
+            self._data.move_to_end(key)
+            return True
+
+    def compare_and_set(self, key, expected, value):
+        size = self._size(value) if self.max_bytes and value is not None else 0
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < now) or entry[1] != expected:
+                return False
+            del self._data[key]
+            self._bytes -= entry[2]
+            evicted = self._insert(key, value, size) if value is not None else []
+        for old_key, old_value in evicted:
+            self._evicted(old_key, old_value)
+        return True
+
+    def _insert(self, key, value, size):
+        """Add an entry and drop the least recently used ones over the bounds; call with the lock held"""
+        self._data[key] = (self._expires_at(), value, size)
+        self._bytes += size
+        evicted = []
+        while len(self._data) > 1 and (
+                (self.max_entries and len(self._data) > self.max_entries)
+                or (self.max_bytes and self._bytes > self.max_bytes)):
+            old_key, (_, old_value, old_size) = self._data.popitem(last=False)
+            self._bytes -= old_size
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return False
+            self._bytes -= entry[2]
+            return True
+
+    def evict_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [(key, value) for key, (expires_at, value, _) in self._data.items()
+                       if expires_at is not None and expires_at < now]
+            for key, _ in expired:
+                self._bytes -= self._data.pop(key)[2]
+        for key, value in expired:
+            self._evicted(key, value)
+        return len(expired)
+
+    def __len__(self):
+        return len(self._data)
+
+
+LOCK_STRIPES = 64  # compare-and-set lock files per disk store; keys share them by hash
+
+
+class DiskSessionStore(SessionStore):
+    """Pickle-file store shared by all workers on the same machine"""
+
+    def __init__(self, directory, ttl=None, max_entries=None, on_evict=None, max_bytes=None, sizeof=None):
+        super().__init__(ttl, max_entries, on_evict, max_bytes, sizeof)
+        self.directory = directory
+        self._stripe_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._counted = None  # entries seen by the last evict_expired()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{digest}.pkl")
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Corrupt store entry {path}: {str(e)}")
+            self._remove(path)
+            return None
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return default
+
+        if self.ttl and mtime + self.ttl < time.time():
+            entry = self._load(path)
+            if self._remove(path) and entry is not None:
+                self._evicted(entry[0], entry[1])
+            return default
+
+        entry = self._load(path)
+        if entry is None:
+            return default
+        # Refresh the modification time so idle expiry and LRU order follow access
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry[1]
+
+    def _write_tmp(self, path, key, value):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        return tmp_path
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.replace(self._write_tmp(path, key, value), path)
+
+    def add(self, key, value):
+        # get() clears an expired entry; linking the new file fails if another writer got there first
+        if self.get(key) is not None:
+            return False
+        path = self._path(key)
+        tmp_path = self._write_tmp(path, key, value)
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            self._remove(tmp_path)
+
+    def touch(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                return False
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def compare_and_set(self, key, expected, value):
+        # Atomic against other compare_and_set() calls on the key (set() overwrites
+        # regardless); the entry stays in place while it is compared, so readers never miss it
+        path = self._path(key)
+        with self._locked(path):
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                return False
+            if self.ttl and mtime + self.ttl < time.time():
+                return False
+            entry = self._load(path)
+            if entry is None or entry[1] != expected:
+                return False
+            if value is None:
+                self._remove(path)
+            else:
+                os.replace(self._write_tmp(path, key, value), path)
+            return True
+
+    @contextmanager
+    def _locked(self, path):
+        """Hold the lock stripe for an entry, shared by threads and processes through a lock file"""
+        stripe = int(os.path.basename(path)[:8], 16) % LOCK_STRIPES
+        with self._stripe_locks[stripe]:
+            if not FCNTL_AVAILABLE:
+                yield
+                return
+            with open(os.path.join(self.directory, f".lock{stripe}"), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def delete(self, key):
+        return self._remove(self._path(key))
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+                except OSError:
+                    pass
+        return entries
+
+    def evict_expired(self):
+        # Disk entries are measured by file size; bounds are enforced here rather than on every write
+        entries = self._entries()
+        doomed = []
+        if self.ttl:
+            threshold = time.time() - self.ttl
+            doomed = [path for mtime, path, _ in entries if mtime < threshold]
+            entries = [entry for entry in entries if entry[0] >= threshold]
+        entries.sort()
+        total = sum(size for _, _, size in entries)
+        while entries and ((self.max_entries and len(entries) > self.max_entries)
+                           or (self.max_bytes and total > self.max_bytes)):
+            _, path, size = entries.pop(0)
+            doomed.append(path)
+            total -= size
+
+        removed = 0
+        for path in doomed:
+            entry = self._load(path)
+            if self._remove(path):
+                removed += 1
+                if entry is not None:
+                    self._evicted(entry[0], entry[1])
+        self._counted = len(entries)
+        return removed
+
+    def __len__(self):
+        return len(self._entries())
+
+    def count(self):
+        # Listing the directory is slow on a big store, so reuse the count from the last eviction pass
+        if self._counted is None:
+            self._counted = len(self)
+        return self._counted
+
+
+class MongoSessionStore(SessionStore):
+    """MongoDB-backed store shared by every worker and machine"""
+
+    def __init__(self, collection, ttl=None, max_entries=None, on_evict=None, max_bytes=None, sizeof=None):
+        super().__init__(ttl, max_entries, on_evict, max_bytes, sizeof)
+        self.collection = collection
+        self._indexed = False
+
+    def get(self, key, default=None):
+        now = time.time()
+        doc = self.collection.find_one({'_id': key})
+        if doc is None:
+            return default
+        if doc.get('expires_at') is not None and doc['expires_at'] < now:
+            if self.collection.delete_one({'_id': key, 'expires_at': doc['expires_at']}).deleted_count:
+                self._evicted(key, pickle.loads(doc['value']))
+            return default
+        # Only push the expiry forward once half the TTL is used, to keep reads cheap
+        if self.ttl and doc.get('expires_at') is not None and doc['expires_at'] - now < self.ttl / 2:
+            self.collection.update_one({'_id': key}, {'$set': {'expires_at': self._expires_at(now), 'accessed_at': now}})
+        return pickle.loads(doc['value'])
+
+    def __contains__(self, key):
+        doc = self.collection.find_one({'_id': key}, {'expires_at': 1})
+        return doc is not None and (doc.get('expires_at') is None or doc['expires_at'] >= time.time())
+
+    def set(self, key, value):
+        now = time.time()
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.collection.replace_one(
+            {'_id': key},
+            {
+                'value': payload,
+                'size': self.sizeof(value) if self.sizeof else len(payload),
+                'expires_at': self._expires_at(now),
+                'accessed_at': now
+            },
+            upsert=True
+        )
+
+    def add(self, key, value):
+        # get() clears an expired entry; the unique _id rejects a concurrent insert
+        if self.get(key) is not None:
+            return False
+        now = time.time()
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            self.collection.insert_one({
+                '_id': key,
+                'value': payload,
+                'size': self.sizeof(value) if self.sizeof else len(payload),
+                'expires_at': self._expires_at(now),
+                'accessed_at': now
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def touch(self, key):
+        now = time.time()
+        doc = self.collection.find_one({'_id': key}, {'expires_at': 1})
+        if doc is None or (doc.get('expires_at') is not None and doc['expires_at'] < now):
+            return False
+        # Like get(), only push the expiry forward once half the TTL is used
+        if self.ttl and doc.get('expires_at') is not None and doc['expires_at'] - now < self.ttl / 2:
+            self.collection.update_one({'_id': key}, {'$set': {'expires_at': self._expires_at(now), 'accessed_at': now}})
+        return True
+
+    def compare_and_set(self, key, expected, value):
+        now = time.time()
+        query = {
+            '_id': key,
+            'value': pickle.dumps(expected, protocol=pickle.HIGHEST_PROTOCOL),
+            '$or': [{'expires_at': None}, {'expires_at': {'$gte': now}}]
+        }
+        if value is None:
+            return self.collection.delete_one(query).deleted_count > 0
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        return self.collection.update_one(query, {'$set': {
+            'value': payload,
+            'size': self.sizeof(value) if self.sizeof else len(payload),
+            'expires_at': self._expires_at(now),
+            'accessed_at': now
+        }}).modified_count > 0
+
+    def delete(self, key):
+        return self.collection.delete_one({'_id': key}).deleted_count > 0
+
+    def _drop(self, query, sort=None, limit=0):
+        removed = 0
+        cursor = self.collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        for doc in cursor:
+            if self.collection.delete_one({'_id': doc['_id']}).deleted_count:
+                removed += 1
+                self._evicted(doc['_id'], pickle.loads(doc['value']))
+        return removed
+
+    def evict_expired(self):
+        # Indexes are only needed by eviction, so avoid touching the server at import time
+        if not self._indexed:
+            self.collection.create_index('expires_at')
+            self.collection.create_index('accessed_at')
+            self._indexed = True
+        removed = 0
+        if self.ttl:
+            removed += self._drop({'expires_at': {'$lt': time.time()}})
+        if self.max_entries:
+            overflow = self.collection.count_documents({}) - self.max_entries
+            if overflow > 0:
+                removed += self._drop({}, sort=[('accessed_at', 1)], limit=overflow)
+        if self.max_bytes:
+            totals = list(self.collection.aggregate([{'$group': {'_id': None, 'total': {'$sum': '$size'}}}]))
+            excess = (totals[0]['total'] if totals else 0) - self.max_bytes
+            doomed = []
+            for doc in self.collection.find({}, {'size': 1}).sort([('accessed_at', 1)]):
+                if excess <= 0:
+                    break
+                doomed.append(doc['_id'])
+                excess -= doc.get('size', 0)
+            if doomed:
+                removed += self._drop({'_id': {'$in': doomed}})
+        return removed
+
+    def __len__(self):
+        return self.collection.estimated_document_count()
+
+
+def create_store(namespace, backend='memory', ttl=None, max_entries=None, on_evict=None,
+                 directory='session_store', database=None, max_bytes=None, sizeof=None):
+    """Create a store for `namespace` using the configured backend"""
+    backend = (backend or 'memory').lower()
+    if backend == 'disk':
+        return DiskSessionStore(os.path.join(directory, namespace), ttl, max_entries, on_evict, max_bytes, sizeof)
+    if backend == 'mongo':
+        if database is None:
+            raise ValueError("The mongo session store backend needs a database")
+        return MongoSessionStore(database[f"store_{namespace}"], ttl, max_entries, on_evict, max_bytes, sizeof)
+    if backend != 'memory':
+        logger.warning(f"Unknown session store backend '{backend}', using in-memory storage")
+    return MemorySessionStore(ttl, max_entries, on_evict, max_bytes, sizeof)
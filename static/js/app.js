@@ -313,6 +313,7 @@ function addMessage(message) {
         }
         
         scrollToBottom();
+        return messageElement;
     } catch (error) {
         console.error('Error adding message:', error);
     }
@@ -368,10 +369,18 @@ async function sendMessage() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                message: content
+                message: content,
+                stream: true
             })
         });
         
+        const contentType = response.headers.get('Content-Type') || '';
+        
+        if (response.ok && contentType.includes('text/event-stream')) {
+            await readChatStream(response);
+            return;
+        }
+        
         // Parse the response
         const data = await response.json();
         
@@ -384,7 +393,8 @@ async function sendMessage() {
                 role: 'assistant',
                 content: data.response,
                 timestamp: data.timestamp || new Date(),
-                audio_url: data.audio_url || null
+                // Audio that is still being generated plays from its progressive stream
+                audio_url: data.audio_url || (data.audio ? data.audio.stream_url : null)
             };
             
             messages.push(aiMessage);
@@ -420,6 +430,90 @@ async function sendMessage() {
     }
 }
 
+// Render a streamed chat response as server-sent events arrive
+async function readChatStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let text = '';
+    let messageElement = null;
+    let finalEvent = null;
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const payload = JSON.parse(event.slice(6));
+            
+            if (payload.error) {
+                throw new Error(payload.error);
+            }
+            
+            if (payload.delta) {
+                text += payload.delta;
+                if (!messageElement) {
+                    hideTypingIndicator();
+                    messageElement = addMessage({
+                        role: 'assistant',
+                        content: text,
+                        timestamp: new Date()
+                    });
+                } else {
+                    messageElement.querySelector('.message-content').innerHTML = formatAIResponse(text);
+                    scrollToBottom();
+                }
+            }
+            
+            if (payload.done) {
+                finalEvent = payload;
+            }
+        }
+    }
+    
+    hideTypingIndicator();
+    
+    if (!finalEvent) {
+        throw new Error('Stream ended unexpectedly');
+    }
+    
+    const aiMessage = {
+        role: 'assistant',
+        content: finalEvent.response,
+        timestamp: finalEvent.timestamp || new Date(),
+        audio_url: finalEvent.audio_url || (finalEvent.audio ? finalEvent.audio.stream_url : null)
+    };
+    messages.push(aiMessage);
+    
+    // Re-render with the final text so audio players are attached
+    if (messageElement) {
+        messageElement.remove();
+    }
+    addMessage(aiMessage);
+}
+
+// Poll an upload job until processing finishes
+async function waitForUploadJob(statusUrl) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        
+        const response = await fetch(statusUrl);
+        const job = await response.json();
+        
+        if (!response.ok) {
+            return { status: 'failed', error: job.error };
+        }
+        if (job.status === 'ready' || job.status === 'failed') {
+            return job;
+        }
+    }
+}
+
 // Upload file to API
 async function uploadFile(file) {
     if (isUploading) {
@@ -441,15 +535,26 @@ async function uploadFile(file) {
         
         const data = await response.json();
         
-        isUploading = false;
-        
         if (response.ok) {
-            showToast(`Document "${data.filename}" uploaded successfully!`, 'success');
+            showToast(`Processing "${data.filename}"...`, 'info');
             
-            // The backend adds the system message, so we don't need to add it here
-            // Just refresh the chat history to get the new message
-            await loadChatHistory();
+            // Extraction and indexing run in the background; wait for the job to finish
+            // unless the same file was already processed
+            const job = data.status === 'ready' ? data : await waitForUploadJob(data.status_url);
+            isUploading = false;
+            
+            if (job.status === 'ready') {
+                showToast(`Document "${job.filename}" uploaded successfully!`, 'success');
+                
+                // The backend adds the system message, so we don't need to add it here
+                // Just refresh the chat history to get the new message
+                await loadChatHistory();
+                await loadDocuments();
+            } else {
+                showToast(`Failed to process document: ${job.error || 'Unknown error'}`, 'error');
+            }
         } else {
+            isUploading = false;
             showToast(`Failed to upload document: ${data.error || 'Unknown error'}`, 'error');
         }
         
@@ -861,6 +966,7 @@ function addMessage(message) {
         }
         
         scrollToBottom();
+        return messageElement;
     } catch (error) {
         console.error('Error adding message:', error);
     }
@@ -939,6 +1045,7 @@ function addMessage(message) {
         }
         
         scrollToBottom();
+        return messageElement;
     } catch (error) {
         console.error('Error adding message:', error);
     }